@@ -0,0 +1,131 @@
+import collections
+import hashlib
+import os
+import tempfile
+import numpy as np
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from cartopy.mpl.path import shapely_to_path
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+import settings
+
+BASEMAP_FORMAT_VERSION = 1
+
+# Natural Earth features drawn on every map
+BASEMAP_FEATURES = dict({'coastline': cfeature.COASTLINE.with_scale('50m'), 'borders': cfeature.BORDERS, 'states': cfeature.STATES})
+
+_projected_paths = collections.OrderedDict()  # In-memory cache: basemap key -> {feature name: list of matplotlib paths}, least recently used first
+
+
+def _basemap_key(projection, extent):
+    """ Returns the cache key for the basemap of a projection and an extent (in the projection's own coordinates). """
+    extent_string = ','.join('%.6f' % value for value in extent)
+    return hashlib.sha1(f'{BASEMAP_FORMAT_VERSION}:{projection.proj4_init}:{extent_string}:{",".join(BASEMAP_FEATURES)}'.encode()).hexdigest()
+
+
+def _project_features(ax):
+    """ Projects the Natural Earth geometries visible in the axes' current extent into matplotlib paths. """
+    feature_paths = dict({})
+    for name, feature in BASEMAP_FEATURES.items():
+        extent = ax.get_extent(feature.crs)
+        feature_paths[name] = [shapely_to_path(ax.projection.project_geometry(geom, feature.crs))
+                               for geom in feature.intersecting_geometries(extent)]
+    return feature_paths
+
+
+def _save_paths(cache_path, feature_paths):
+    """ Writes the projected paths of every feature to one .npz file as concatenated vertex and code arrays. """
+    arrays = dict({})
+    for name, paths in feature_paths.items():
+        arrays[f'{name}_vertices'] = np.concatenate([path.vertices for path in paths]) if paths else np.empty((0, 2))
+        arrays[f'{name}_codes'] = np.concatenate([path.codes if path.codes is not None else np.full(len(path.vertices), Path.LINETO, dtype=Path.code_type)
+                                                  for path in paths]) if paths else np.empty(0, dtype=Path.code_type)
+        arrays[f'{name}_offsets'] = np.cumsum([0] + [len(path.vertices) for path in paths], dtype=np.int64)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _load_paths(cache_path):
+    """ Reads the projected paths written by _save_paths. Returns None if the file does not exist or cannot be read. """
+    try:
+        with np.load(cache_path, allow_pickle=False) as arrays:
+            feature_paths = dict({})
+            for name in BASEMAP_FEATURES:
+                vertices, codes, offsets = arrays[f'{name}_vertices'], arrays[f'{name}_codes'], arrays[f'{name}_offsets']
+                feature_paths[name] = [Path(vertices[start:end], codes[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+    except (OSError, ValueError, KeyError):
+        return None
+    return feature_paths
+
+
+def basemap_paths(ax, cache_dir=settings.basemap_cache_dir):
+    """
+    Returns the projected coastline, border and state paths for the current extent of a map.
+
+    Paths are looked up in memory first (where the settings.basemap_memory_cache_size most recently used extents are
+    kept), then in 'cache_dir', and are only projected from the Natural Earth
+    geometries if neither cache has them.
+
+    Parameters
+    ----------
+    ax: cartopy.mpl.geoaxes.GeoAxes
+        Map whose projection and extent (already set) determine the paths.
+    cache_dir: str or None
+        Directory for the on-disk cache. If None, paths are only cached in memory.
+
+    Returns
+    -------
+    feature_paths: dict
+        Maps each name in BASEMAP_FEATURES to a list of matplotlib paths in the map's projection.
+    """
+    key = _basemap_key(ax.projection, ax.get_extent())
+    feature_paths = _projected_paths.get(key)
+    if feature_paths is not None:
+        _projected_paths.move_to_end(key)
+        return feature_paths
+
+    if feature_paths is None and cache_dir is not None:
+        feature_paths = _load_paths(os.path.join(cache_dir, f'{key}.npz'))
+
+    if feature_paths is None:
+        feature_paths = _project_features(ax)
+        if cache_dir is not None:
+            _save_paths(os.path.join(cache_dir, f'{key}.npz'), feature_paths)
+
+    _projected_paths[key] = feature_paths
+    while len(_projected_paths) > settings.basemap_memory_cache_size:  # Every region and custom extent has its own paths
+        _projected_paths.popitem(last=False)
+    return feature_paths
+
+
+def add_basemap(ax, extent, linewidth=0.4, zorder=9, alpha=0.15):
+    """
+    Sets the extent of a map and draws the cached coastlines, borders and states on it.
+
+    Parameters
+    ----------
+    ax: cartopy.mpl.geoaxes.GeoAxes
+        Map on which the basemap will be drawn.
+    extent: iterable with 4 ints
+        Extent of the map in the format of [min lon, max lon, min lat, max lat].
+    linewidth: float
+        Thickness of coastlines and the borders of states and countries.
+    zorder: float
+        zorder of the basemap lines.
+    alpha: float
+        Opacity of the basemap lines.
+    """
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    for paths in basemap_paths(ax).values():
+        if len(paths) > 0:
+            ax.add_collection(PathCollection(paths, facecolor='none', edgecolor='black', linewidth=linewidth, zorder=zorder, alpha=alpha),
+                              autolim=False)
@@ -0,0 +1,393 @@
+import argparse
+import datetime
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import settings
+
+CONVECTIVE_PRODUCTS = ('cat', 'torn', 'wind', 'hail')
+ALL_PRODUCTS = CONVECTIVE_PRODUCTS + ('fire', )
+
+
+class RenderJob:
+    """ One outlook issuance and the products to render from it. """
+    __slots__ = ('outlook_day', 'date', 'time', 'products')
+
+    def __init__(self, outlook_day, date, time, products):
+        """
+        outlook_day: int
+        date: datetime.date
+        time: int (HHMM)
+        products: tuple of str
+        """
+        self.outlook_day = outlook_day
+        self.date = date
+        self.time = time
+        self.products = products
+
+    def __repr__(self):
+        return f"RenderJob(day{self.outlook_day} {self.date:%Y-%m-%d} %04d UTC: {', '.join(self.products)})" % self.time
+
+
+class RenderResult:
+    """ Outcome of a RenderJob. 'status' is 'ok', 'missing' (the archive file does not exist) or 'error'. """
+    __slots__ = ('job', 'status', 'message')
+
+    def __init__(self, job, status, message=None):
+        self.job = job
+        self.status = status
+        self.message = message
+
+    def __repr__(self):
+        message = f': {self.message.strip().splitlines()[-1]}' if self.message else ''
+        return f'{self.job!r} -> {self.status}{message}'
+
+
+def build_jobs(start_date, end_date, outlook_days, times=None, products=ALL_PRODUCTS):
+    """
+    Builds the render jobs for every issuance in a date range.
+
+    Parameters
+    ----------
+    start_date, end_date: datetime.date
+        First and last dates of the range (inclusive).
+    outlook_days: iterable of ints
+        Outlook days to render.
+    times: iterable of ints or None
+        Issuance times (HHMM UTC). If None, every valid time for each outlook day is used.
+    products: iterable of str
+        Products to render: any of 'cat', 'torn', 'wind', 'hail', 'fire'.
+
+    Returns
+    -------
+    jobs: list of RenderJob
+
+    Raises
+    ------
+    ValueError
+        - If a product is unknown, an outlook day has none of the products, or a time is not valid for a given outlook day
+          (see settings.valid_convective_outlook_times and settings.valid_fire_outlook_times).
+    """
+    unknown_products = set(products) - set(ALL_PRODUCTS)
+    if len(unknown_products) > 0:
+        raise ValueError(f"Unknown products: {', '.join(sorted(unknown_products))}")
+
+    convective_products = tuple(product for product in CONVECTIVE_PRODUCTS if product in products)
+    convective_days = range(1, len(settings.valid_convective_outlook_times) + 1) if len(convective_products) > 0 else range(0)
+    fire_days = range(1, len(settings.valid_fire_outlook_times) + 1) if 'fire' in products else range(0)
+    invalid_days = [outlook_day for outlook_day in outlook_days if outlook_day not in convective_days and outlook_day not in fire_days]
+    if len(invalid_days) > 0:
+        raise ValueError(f"No requested product has a day {', '.join(str(outlook_day) for outlook_day in invalid_days)} outlook. Convective "
+                         f"outlooks go out to day {len(settings.valid_convective_outlook_times)} and fire weather outlooks to day "
+                         f"{len(settings.valid_fire_outlook_times)}.")
+
+    issuances = []  # (outlook_day, time, products)
+    used_times = set()
+    for outlook_day in outlook_days:
+        if outlook_day in convective_days:
+            valid_times = settings.valid_convective_outlook_times[outlook_day - 1]
+            day_times = [time for time in valid_times if times is None or time in times]
+            issuances.extend((outlook_day, time, convective_products) for time in day_times)
+            used_times.update(day_times)
+        if outlook_day in fire_days:
+            valid_times = settings.valid_fire_outlook_times[outlook_day - 1]
+            day_times = [time for time in valid_times if times is None or time in times]
+            issuances.extend((outlook_day, time, ('fire', )) for time in day_times)
+            used_times.update(day_times)
+
+    if times is not None:
+        invalid_times = [time for time in times if time not in used_times]
+        if len(invalid_times) > 0:
+            raise ValueError(f"No requested outlook is released at {', '.join('%04d' % time for time in invalid_times)} UTC. Valid times are "
+                             f"listed in settings.valid_convective_outlook_times and settings.valid_fire_outlook_times.")
+
+    jobs = []
+    date = start_date
+    while date <= end_date:
+        jobs.extend(RenderJob(outlook_day, date, time, job_products) for outlook_day, time, job_products in issuances)
+        date += datetime.timedelta(days=1)
+    return jobs
+
+
+def _import_plotting():
+    """ Imports the plotting stack once per process so every job after the first starts warm. """
+    global plot_outlooks
+    import plot_outlooks
+
+
+def _init_worker(instrument_format=None):
+    """
+    Initializer of the render processes, which never show a figure. The instrumentation format of the parent is passed
+    explicitly, since processes that are spawned rather than forked re-import settings.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    settings.instrument_format = instrument_format
+    _import_plotting()
+
+
+def run_job(job, outlook_kmz_dir, image_dir, folders=None, **plot_kwargs):
+    """
+    Renders one job and returns a RenderResult instead of raising, so a single bad issuance does not stop a batch.
+
+    'folders' is the already parsed outlook of the job (a list of kml.Folder or an outlook.Outlook), or None to download and parse it here.
+    **plot_kwargs are passed to plot_outlooks.render_convective_products (include_reports, filtered_reports, remove_unknowns, profiles,
+    region). Only 'profiles' and 'region' apply to fire weather outlooks.
+    """
+    if 'plot_outlooks' not in globals():  # Rendering in the caller's process, whose backend is left to render.py
+        _import_plotting()
+    year, month, day = job.date.year, job.date.month, job.date.day
+    try:
+        if job.products == ('fire', ):
+            plot_outlooks.fire_outlook(job.outlook_day, year, month, day, job.time, outlook_kmz_dir, image_dir, folders=folders,
+                profiles=plot_kwargs.get('profiles'), region=plot_kwargs.get('region'))
+        else:
+            plot_outlooks.render_convective_products(job.outlook_day, year, month, day, job.time, outlook_kmz_dir, image_dir,
+                products=job.products, folders=folders, **plot_kwargs)
+    except FileNotFoundError as e:
+        return RenderResult(job, 'missing', str(e))
+    except Exception:
+        return RenderResult(job, 'error', traceback.format_exc())
+    return RenderResult(job, 'ok')
+
+
+def render_batch(jobs, outlook_kmz_dir, image_dir, max_workers=settings.batch_max_workers, **plot_kwargs):
+    """
+    Renders a list of jobs across a process pool.
+
+    Parameters
+    ----------
+    jobs: list of RenderJob
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    image_dir: str
+        Directory where the images will be stored.
+    max_workers: int or None
+        Number of worker processes. If None, one per CPU is used. If 1, the jobs run in this process.
+    **plot_kwargs
+        Passed to plot_outlooks.render_convective_products.
+
+    Yields
+    ------
+    result: RenderResult
+        One result per job, in the order the jobs finish.
+    """
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(outlook_kmz_dir, exist_ok=True)
+
+    if max_workers == 1:
+        for job in jobs:
+            yield run_job(job, outlook_kmz_dir, image_dir, **plot_kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(settings.instrument_format, )) as executor:
+        futures = dict({})  # Future -> RenderJob
+        unsubmitted = []  # Results of the jobs that could not be submitted once the pool is broken
+        for n, job in enumerate(jobs):
+            try:
+                futures[executor.submit(run_job, job, outlook_kmz_dir, image_dir, **plot_kwargs)] = job
+            except BrokenProcessPool:
+                broken = traceback.format_exc()
+                unsubmitted = [RenderResult(job, 'error', broken) for job in jobs[n:]]
+                break
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:  # run_job catches everything, so only a crashed render process gets here
+                result = RenderResult(futures[future], 'error', traceback.format_exc())
+            yield result
+        yield from unsubmitted
+
+
+def _fetch_job(job, outlook_kmz_dir, include_reports=False, filtered_reports=False, **plot_kwargs):
+    """
+    Downloads the outlook of a job, and its storm reports into the report cache, then returns the local kmz path and
+    the name of the kml file inside it. Only reports older than a couple of days are cached (see utils.StormReports),
+    so the render stage downloads the others itself.
+    """
+    import download
+    import outlook
+    import utils
+    year, month, day = job.date.year, job.date.month, job.date.day
+    if job.products == ('fire', ):
+        local_filename = outlook.fire_outlook_filename(job.outlook_day, year, month, day, job.time)
+        server_path = download.fire_outlook_path(year, local_filename)
+    else:
+        local_filename = outlook.convective_outlook_filename(job.outlook_day, year, month, day, job.time)
+        server_path = download.convective_outlook_path(year, local_filename)
+    full_path = download.fetch(server_path, f'{outlook_kmz_dir}/{local_filename}')
+
+    if include_reports and job.products != ('fire', ):
+        storm_reports = utils.StormReports(year, month, day)
+        for filtered in {False, filtered_reports}:  # The tornado and hail outlooks always use the raw reports
+            storm_reports.load_tornado_reports(filtered=filtered)
+    return full_path, local_filename.replace('kmz', 'kml')
+
+
+def render_pipeline(jobs, outlook_kmz_dir, image_dir, fetch_workers=settings.pipeline_fetch_workers, parse_workers=settings.pipeline_parse_workers,
+                    render_workers=settings.batch_max_workers, queue_size=settings.pipeline_queue_size, **plot_kwargs):
+    """
+    Renders a list of jobs with the downloads, the kml parsing and the rendering running at the same time.
+
+    Downloads run on a thread pool, parsing on a few threads and rendering on a process pool. The stages are connected by
+    bounded queues: downloads wait once 'queue_size' outlooks are waiting to be parsed, parsing waits once 'queue_size'
+    parsed outlooks are waiting for a render worker, so memory stays bounded however long the batch is.
+
+    Parameters
+    ----------
+    jobs: list of RenderJob
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    image_dir: str
+        Directory where the images will be stored.
+    fetch_workers: int
+        Number of simultaneous downloads.
+    parse_workers: int
+        Number of parsing threads.
+    render_workers: int or None
+        Number of render processes. If None, one per CPU is used.
+    queue_size: int
+        Maximum number of outlooks waiting between two stages.
+    **plot_kwargs
+        Passed to plot_outlooks.render_convective_products.
+
+    Yields
+    ------
+    result: RenderResult
+        One result per job, in the order the jobs finish.
+    """
+    import outlook
+    import outlook_cache
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(outlook_kmz_dir, exist_ok=True)
+
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    fetched = queue.Queue(maxsize=queue_size)  # (job, kmz path, kml name)
+    parsed = queue.Queue(maxsize=queue_size)  # (job, outlook.Outlook)
+    results = queue.Queue()  # RenderResult of every job, including the ones that failed before rendering
+    done = object()  # Sent down the queues once a stage is finished
+
+    def fetch_stage():
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fetched.put((job, ) + _fetch_job(job, outlook_kmz_dir, **plot_kwargs))
+            except FileNotFoundError as e:
+                results.put(RenderResult(job, 'missing', str(e)))
+            except Exception:
+                results.put(RenderResult(job, 'error', traceback.format_exc()))
+
+    def parse_stage():
+        while True:
+            item = fetched.get()
+            if item is done:
+                parsed.put(done)
+                return
+            job, full_path, kml_name = item
+            try:
+                folders = outlook_cache.read_kmz(full_path, kml_name)
+                kind = 'fire' if job.products == ('fire', ) else 'convective'
+                # Outlooks pickle as a few flat arrays, so handing them to the render processes costs little
+                parsed.put((job, outlook.Outlook.from_folders(folders, kind, job.outlook_day, job.date, job.time)))
+            except Exception:
+                results.put(RenderResult(job, 'error', traceback.format_exc()))
+
+    def close_fetch_stage(fetch_threads):
+        for thread in fetch_threads:
+            thread.join()
+        for _ in range(parse_workers):
+            fetched.put(done)
+
+    in_flight = threading.Semaphore(render_workers or os.cpu_count())
+
+    def render_finished(future, job):
+        in_flight.release()
+        try:
+            results.put(future.result())
+        except Exception:  # run_job catches everything, so only a crashed render process gets here
+            results.put(RenderResult(job, 'error', traceback.format_exc()))
+
+    def render_stage(executor):
+        remaining_parsers = parse_workers
+        broken = None  # Traceback of the failed submit once the pool is broken (e.g. a render process was killed)
+        while remaining_parsers > 0:
+            item = parsed.get()
+            if item is done:
+                remaining_parsers -= 1
+                continue
+            job, job_outlook = item
+            if broken is not None:  # Keep draining the parsers so every job still gets a result
+                results.put(RenderResult(job, 'error', broken))
+                continue
+            in_flight.acquire()  # Leave the parsed outlooks in the queue until a render worker is free
+            try:
+                future = executor.submit(run_job, job, outlook_kmz_dir, image_dir, job_outlook, **plot_kwargs)
+            except Exception:
+                in_flight.release()
+                broken = traceback.format_exc()
+                results.put(RenderResult(job, 'error', broken))
+                continue
+            future.add_done_callback(lambda future, job=job: render_finished(future, job))
+
+    with ProcessPoolExecutor(max_workers=render_workers, initializer=_init_worker, initargs=(settings.instrument_format, )) as executor:
+        executor.submit(os.getpid).result()  # Start the render processes before any thread, so they are never forked mid-download
+        # Fetch workers wait on the parse queue as soon as it is full, so they never get more than 'queue_size' outlooks ahead
+        fetch_threads = [threading.Thread(target=fetch_stage, daemon=True) for _ in range(fetch_workers)]
+        threads = fetch_threads + [threading.Thread(target=close_fetch_stage, args=(fetch_threads, ), daemon=True)]
+        threads += [threading.Thread(target=parse_stage, daemon=True) for _ in range(parse_workers)]
+        threads.append(threading.Thread(target=render_stage, args=(executor, ), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        for _ in range(len(jobs)):
+            yield results.get()
+        for thread in threads:
+            thread.join()
+
+
+def _parse_date(date_string):
+    return datetime.datetime.strptime(date_string, '%Y%m%d').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render SPC outlooks for a range of dates.')
+    parser.add_argument('start_date', type=_parse_date, help='First date to render (YYYYMMDD).')
+    parser.add_argument('end_date', type=_parse_date, help='Last date to render (YYYYMMDD), inclusive.')
+    parser.add_argument('--outlook_kmz_dir', required=True, help='Directory where the outlook kmz files will be stored.')
+    parser.add_argument('--image_dir', required=True, help='Directory where the images will be stored.')
+    parser.add_argument('--days', type=int, nargs='+', default=[1], help='Outlook days to render.')
+    parser.add_argument('--times', type=int, nargs='+', help='Issuance times (HHMM UTC). Defaults to every valid time.')
+    parser.add_argument('--products', nargs='+', default=list(ALL_PRODUCTS), choices=ALL_PRODUCTS, help='Products to render.')
+    parser.add_argument('--workers', type=int, default=settings.batch_max_workers, help='Number of worker processes.')
+    parser.add_argument('--fetch_workers', type=int, default=settings.pipeline_fetch_workers, help='Number of simultaneous downloads.')
+    parser.add_argument('--parse_workers', type=int, default=settings.pipeline_parse_workers, help='Number of parsing threads.')
+    parser.add_argument('--queue_size', type=int, default=settings.pipeline_queue_size, help='Maximum number of outlooks waiting between two stages.')
+    parser.add_argument('--include_reports', action='store_true', help='Include storm reports on top of the outlooks.')
+    parser.add_argument('--filtered_reports', action='store_true', help='Use filtered storm reports.')
+    parser.add_argument('--remove_unknowns', action='store_true', help='Remove wind reports with unknown speeds.')
+    parser.add_argument('--profiles', nargs='+', choices=list(settings.render_profiles), help='Render profiles to save. Defaults to each product\'s profiles in settings.py.')
+    parser.add_argument('--region', help='Region of the maps: a name in settings.regions, or "min_lon,max_lon,min_lat,max_lat". Defaults to CONUS.')
+    parser.add_argument('--instrument', choices=('jsonl', 'prometheus'), help='Record the timing and memory of every render in settings.instrument_dir.')
+    args = parser.parse_args()
+    if args.instrument is not None:
+        settings.instrument_format = args.instrument  # Passed on to the render processes by _init_worker
+    region = args.region
+    if region is not None and ',' in region:
+        region = [float(value) for value in region.split(',')]
+
+    jobs = build_jobs(args.start_date, args.end_date, args.days, args.times, args.products)
+    num_failed = 0
+    for result in render_pipeline(jobs, args.outlook_kmz_dir, args.image_dir, fetch_workers=args.fetch_workers, parse_workers=args.parse_workers,
+                                  render_workers=args.workers, queue_size=args.queue_size, include_reports=args.include_reports,
+                                  filtered_reports=args.filtered_reports, remove_unknowns=args.remove_unknowns, profiles=args.profiles, region=region):
+        print(result)
+        num_failed += result.status != 'ok'
+    print(f'{len(jobs) - num_failed}/{len(jobs)} jobs rendered')
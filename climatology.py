@@ -0,0 +1,311 @@
+"""
+Outlook climatologies: how often each grid cell was in a risk area, by month and issuance time.
+
+Outlooks are streamed through rasterize.py into running per-cell counters, so memory use only depends on the grid and
+the number of risk areas tracked, never on the length of the archive.
+"""
+
+import datetime
+import functools
+import json
+import os
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import outlook
+import rasterize
+import settings
+
+CLIMATOLOGY_FORMAT_VERSION = 1
+
+# Risk areas counted by default. Each one maps to the (field, minimum value) conditions a cell must all meet (see rasterize.py for the fields).
+DEFAULT_AREAS = dict({'SLGT+': [('cat', 3)], 'ENH+': [('cat', 4)], 'MDT+': [('cat', 5)], 'TOR10+': [('torn', 10)], 'SIGTOR10+': [('torn', 10), ('torn_sig', 1)],
+                      'WIND30+': [('wind', 30)], 'HAIL30+': [('hail', 30)]})
+
+
+def _issuance_key(date, time):
+    return (date.year * 10000 + date.month * 100 + date.day) * 10000 + time
+
+
+class ClimatologyAccumulator:
+    """
+    Running counts of the issuances in which each grid cell was inside each risk area, by month and issuance time.
+
+    counts has shape (num areas, 12, num times, ny, nx) and issuances (12, num times) holds the number of issuances
+    added to each month and time. Every added issuance is remembered so a resumed run can skip it.
+    """
+    __slots__ = ('outlook_day', 'areas', 'times', 'spacing', 'extent', 'counts', 'issuances', 'done')
+
+    def __init__(self, outlook_day=1, areas=None, spacing=settings.raster_grid_spacing, extent=settings.raster_extent):
+        """
+        outlook_day: int
+            Outlook day of the issuances that will be added.
+        areas: dict or None
+            Maps the name of each risk area to its list of (field, minimum value) conditions. If None, DEFAULT_AREAS is used.
+        spacing: int
+            Grid spacing in km.
+        extent: iterable with 4 floats
+            Area covered by the grid, [min lon, max lon, min lat, max lat].
+        """
+        self.outlook_day = outlook_day
+        self.areas = {name: [tuple(condition) for condition in conditions] for name, conditions in (DEFAULT_AREAS if areas is None else areas).items()}
+        self.times = list(settings.valid_convective_outlook_times[outlook_day - 1])
+        self.spacing = spacing
+        self.extent = list(extent)
+        shape = self.grid.shape
+        self.counts = np.zeros((len(self.areas), 12, len(self.times)) + shape, dtype=np.uint32)
+        self.issuances = np.zeros((12, len(self.times)), dtype=np.uint32)
+        self.done = set()
+
+    @property
+    def grid(self):
+        return rasterize.get_grid(self.spacing, self.extent)
+
+    @property
+    def products(self):
+        """ Products that must be rasterized to evaluate every area. """
+        fields = {field for conditions in self.areas.values() for field, _ in conditions}
+        return tuple(product for product in rasterize.CONVECTIVE_PRODUCTS if any(field in fields for field in rasterize.field_names([product])))
+
+    def add(self, fields, date, time):
+        """
+        Adds one rasterized issuance. Issuances that were already added are ignored.
+
+        Parameters
+        ----------
+        fields: dict
+            Fields returned by rasterize.rasterize_outlook.
+        date: datetime.date
+            Issuance date.
+        time: int
+            Issuance time in UTC. HHMM
+        """
+        key = _issuance_key(date, time)
+        if key in self.done:
+            return
+        t = self.times.index(time)
+        for a, conditions in enumerate(self.areas.values()):
+            inside = np.ones(self.counts.shape[-2:], dtype=bool)
+            for field, minimum in conditions:
+                inside &= fields[field] >= minimum
+            self.counts[a, date.month - 1, t] += inside
+        self.issuances[date.month - 1, t] += 1
+        self.done.add(key)
+
+    def merge(self, other):
+        """ Adds the counts of another accumulator built with the same settings (e.g. by another worker) to this one. """
+        if (other.outlook_day, other.areas, other.spacing, other.extent) != (self.outlook_day, self.areas, self.spacing, self.extent):
+            raise ValueError("Climatologies with different outlook days, areas or grids cannot be merged")
+        overlap = self.done & other.done
+        if len(overlap) > 0:
+            raise ValueError(f"{len(overlap)} issuances were added to both climatologies")
+        self.counts += other.counts
+        self.issuances += other.issuances
+        self.done |= other.done
+        return self
+
+    def frequency(self, area, months=None, times=None):
+        """
+        Returns the fraction of issuances in which each cell was inside a risk area.
+
+        Parameters
+        ----------
+        area: str
+            Name of the risk area.
+        months: iterable of ints or None
+            Months (1-12) to include. If None, every month is included.
+        times: iterable of ints or None
+            Issuance times (HHMM UTC) to include. If None, every time is included.
+
+        Returns
+        -------
+        frequency: np.ndarray
+            (ny, nx) array, NaN everywhere if no issuance matches.
+        """
+        m = slice(None) if months is None else [month - 1 for month in months]
+        t = slice(None) if times is None else [self.times.index(time) for time in times]
+        counts = self.counts[list(self.areas).index(area)][m][:, t].sum(axis=(0, 1), dtype=np.float64)
+        num_issuances = self.issuances[m][:, t].sum()
+        return counts / num_issuances if num_issuances > 0 else np.full(counts.shape, np.nan)
+
+    def save(self, path, date_range=None):
+        """
+        Writes the accumulator to an .npz checkpoint, atomically so an interrupted run never leaves a broken file.
+        date_range, a (start date, end date) tuple, is recorded in the header of the checkpoints of accumulate's workers.
+        """
+        header = dict(version=CLIMATOLOGY_FORMAT_VERSION, outlook_day=self.outlook_day, areas=self.areas, spacing=self.spacing, extent=self.extent)
+        if date_range is not None:
+            header['date_range'] = [date.isoformat() for date in date_range]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, header=np.array(json.dumps(header)), counts=self.counts, issuances=self.issuances,
+                         done=np.array(sorted(self.done), dtype=np.int64))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """ Reads an accumulator written by save. """
+        with np.load(path, allow_pickle=False) as arrays:
+            header = json.loads(str(arrays['header']))
+            if header['version'] != CLIMATOLOGY_FORMAT_VERSION:
+                raise ValueError(f"{path} was written by an incompatible version of climatology.py")
+            accumulator = cls(header['outlook_day'], header['areas'], header['spacing'], header['extent'])
+            accumulator.counts = arrays['counts']
+            accumulator.issuances = arrays['issuances']
+            accumulator.done = set(arrays['done'].tolist())
+        return accumulator
+
+
+def _read_header(path):
+    with np.load(path, allow_pickle=False) as arrays:
+        return json.loads(str(arrays['header']))
+
+
+def _accumulate_range(start_date, end_date, checkpoint_path, outlook_kmz_dir, outlook_day, areas, checkpoint_every):
+    """
+    Adds every issuance in a date range to the accumulator checkpointed at 'checkpoint_path', resuming from it if it exists
+    and covers the same range.
+
+    Returns the accumulator and a list of (issuance, traceback) tuples for the issuances that could not be added.
+    """
+    date_range = (start_date, end_date)
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path) and \
+            _read_header(checkpoint_path).get('date_range') == [date.isoformat() for date in date_range]:
+        accumulator = ClimatologyAccumulator.load(checkpoint_path)
+    else:  # Checkpoints of other ranges (e.g. left by a run with other dates or workers) would be merged twice, so they are started over
+        accumulator = ClimatologyAccumulator(outlook_day, areas)
+    grid, products = accumulator.grid, accumulator.products
+
+    failures = []
+    num_added = 0
+    date = start_date
+    while date <= end_date:
+        for time in accumulator.times:
+            if _issuance_key(date, time) in accumulator.done:
+                continue
+            try:
+                folders = outlook.load_convective_outlook(outlook_day, date.year, date.month, date.day, time, outlook_kmz_dir)
+                accumulator.add(rasterize.rasterize_outlook(folders, products, grid), date, time)
+            except Exception:
+                failures.append(((outlook_day, date, time), traceback.format_exc()))
+                continue
+            num_added += 1
+            if checkpoint_path is not None and num_added % checkpoint_every == 0:
+                accumulator.save(checkpoint_path, date_range)
+        date += datetime.timedelta(days=1)
+
+    if checkpoint_path is not None:
+        accumulator.save(checkpoint_path, date_range)
+    return accumulator, failures
+
+
+def accumulate(start_date, end_date, outlook_kmz_dir, checkpoint_path=None, outlook_day=1, areas=None, checkpoint_every=500,
+    max_workers=settings.batch_max_workers):
+    """
+    Builds the climatology of every issuance of an outlook day in a date range (inclusive).
+
+    The range is split into one contiguous block of days per worker process. Each worker keeps its own accumulator,
+    checkpointed every 'checkpoint_every' issuances to '<checkpoint_path>.part<N>.npz', and the partial results are
+    merged at the end. Calling this again with the same arguments after an interruption resumes from the checkpoints.
+    Checkpoints that cover another block of days (e.g. after changing the dates or max_workers) are started over.
+    Issuances missing from the SPC archive are skipped (and retried on the next call).
+
+    Parameters
+    ----------
+    start_date, end_date: datetime.date
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    checkpoint_path: str or None
+        Path of the merged climatology. If None, nothing is written to disk.
+    outlook_day: int
+        Outlook day (1-3).
+    areas: dict or None
+        Risk areas to count (see ClimatologyAccumulator).
+    checkpoint_every: int
+        Number of issuances added by a worker between two checkpoints.
+    max_workers: int or None
+        Number of worker processes. If None, one per CPU is used. If 1, the climatology is built in this process.
+
+    Returns
+    -------
+    accumulator: ClimatologyAccumulator
+    failures: list of (issuance, str) tuples
+        Issuances that could not be added and their tracebacks.
+    """
+    num_days = (end_date - start_date).days + 1
+    num_parts = min(num_days, max_workers or os.cpu_count() or 1)
+    bounds = np.linspace(0, num_days, num_parts + 1).astype(int)
+    parts = [(start_date + datetime.timedelta(days=int(first)), start_date + datetime.timedelta(days=int(last) - 1),
+              None if checkpoint_path is None else f'{checkpoint_path}.part{n}.npz') for n, (first, last) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    accumulate_part = functools.partial(_accumulate_range, outlook_kmz_dir=outlook_kmz_dir, outlook_day=outlook_day, areas=areas,
+                                        checkpoint_every=checkpoint_every)
+    if num_parts == 1:
+        results = [accumulate_part(*parts[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=num_parts) as executor:
+            results = list(executor.map(accumulate_part, *zip(*parts)))
+
+    accumulator, failures = results[0]
+    for partial, partial_failures in results[1:]:
+        accumulator.merge(partial)
+        failures.extend(partial_failures)
+
+    if checkpoint_path is not None:
+        accumulator.save(checkpoint_path)
+    return accumulator, failures
+
+
+def plot_climatology(accumulator, area, image_base, months=None, times=None, profiles=None):
+    """
+    Maps the frequency of a risk area with the same background as the outlook plots.
+
+    Parameters
+    ----------
+    accumulator: ClimatologyAccumulator
+    area: str
+        Name of the risk area.
+    image_base: str
+        Path of the image without its extension (see render.save_figure).
+    months, times: iterable of ints or None
+        See ClimatologyAccumulator.frequency.
+    profiles: iterable of str or None
+        Render profiles (settings.render_profiles) to save. If None, settings.product_render_profiles['climatology'] is used.
+
+    Returns
+    -------
+    paths: list of str
+        Paths of the saved images.
+    """
+    import cartopy.crs as ccrs  # Imported here so accumulating in worker processes loads neither cartopy nor pyplot
+    import matplotlib.pyplot as plt
+    import plot_outlooks
+    import render
+
+    grid = accumulator.grid
+    frequency = accumulator.frequency(area, months, times)
+    dx = grid.spacing * 1000.
+
+    crs = ccrs.Miller(central_longitude=250)
+    fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
+    mesh = ax.pcolormesh(np.append(grid.x - dx / 2, grid.x[-1] + dx / 2), np.append(grid.y - dx / 2, grid.y[-1] + dx / 2),
+                         np.ma.masked_less_equal(100 * frequency, 0), cmap='YlOrRd', vmin=0, transform=grid.projection, zorder=1)
+    plot_outlooks.plot_background(accumulator.extent, ax=ax)
+    plt.colorbar(mesh, ax=ax, orientation='horizontal', shrink=0.6, pad=0.04).set_label(f'Issuances in {area} (%)', fontsize=6)
+
+    subset = []
+    if months is not None:
+        subset.append('months ' + ', '.join(str(month) for month in months))
+    if times is not None:
+        subset.append('issued at ' + ', '.join('%04d UTC' % time for time in times))
+    title_text = f'Day {accumulator.outlook_day} {area} Frequency ({int(accumulator.issuances.sum())} issuances{"; " if subset else ""}{"; ".join(subset)})'
+
+    plt.title(title_text, fontsize=8)
+    return render.save_figure(image_base, 'climatology', profiles)
+
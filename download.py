@@ -0,0 +1,177 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import instrument
+import settings
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the requests session shared by every download in this process.
+
+    The session keeps a pool of connections open to the SPC server and retries failed requests with exponential backoff.
+    A new session is created after a fork so worker processes never share sockets with their parent.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=settings.download_retries, backoff_factor=settings.download_backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET', ))
+            adapter = HTTPAdapter(pool_connections=settings.download_max_workers, pool_maxsize=settings.download_max_workers, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pid = os.getpid()
+    return _session
+
+
+def _read_metadata(full_path):
+    try:
+        with open(f'{full_path}.meta', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict({})
+
+
+def _write_atomic(full_path, content):
+    """ Writes a file through a temporary file in the same directory, so readers never see a partial file. """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _lock_path(full_path):
+    """ Lock file of a download, in settings.download_lock_dir so the data directories only hold data. """
+    name = hashlib.sha1(os.path.abspath(full_path).encode()).hexdigest()
+    return os.path.join(settings.download_lock_dir, f'{name}.lock')
+
+
+def fetch(path, full_path, base_url=None, revalidate=False):
+    """
+    Downloads a file from the SPC website to a local path, unless it is already there.
+
+    Parameters
+    ----------
+    path: str
+        Path of the file on the server, relative to the base url (e.g. 'products/outlook/archive/2024/day1otlk_20240426_1300.kmz').
+    full_path: str
+        Local path of the file.
+    base_url: str or None
+        Server to download from. If None, settings.spc_base_url is used. Tests can point this at a local HTTP server.
+    revalidate: bool
+        If the file already exists, ask the server whether it changed (using the stored ETag / Last-Modified headers)
+        instead of using the local copy as-is.
+
+    Returns
+    -------
+    full_path: str
+
+    Raises
+    ------
+    FileNotFoundError
+        - If the server does not have the file (HTTP 404).
+    ConnectionError
+        - If the server answered with any other error, e.g. one still left after the retries.
+    """
+    if base_url is None:
+        base_url = settings.spc_base_url
+    link = f'{base_url.rstrip("/")}/{path}'
+
+    if os.path.isfile(full_path) and not revalidate:
+        return full_path
+
+    os.makedirs(os.path.dirname(full_path) or '.', exist_ok=True)
+    os.makedirs(settings.download_lock_dir, exist_ok=True)
+
+    # Only one thread or process downloads a given file at a time. Others wait, then find the file already written.
+    # Lock files are never removed: deleting one while another process waits on it would let a third lock a new file.
+    with open(_lock_path(full_path), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            exists = os.path.isfile(full_path)
+            if exists and not revalidate:
+                return full_path
+
+            headers = dict({})
+            if exists:
+                metadata = _read_metadata(full_path)
+                if 'etag' in metadata:
+                    headers['If-None-Match'] = metadata['etag']
+                if 'last_modified' in metadata:
+                    headers['If-Modified-Since'] = metadata['last_modified']
+
+            with instrument.stage('fetch'):
+                response = get_session().get(link, headers=headers, timeout=settings.download_timeout)
+
+            if response.status_code == 304:
+                return full_path
+            if response.status_code == 404:
+                raise FileNotFoundError(f'{link} not found')
+            if response.status_code != 200:  # Not an answer about the file, so callers must not treat it as missing from the archive
+                raise ConnectionError(f'{link} returned HTTP {response.status_code}')
+
+            _write_atomic(full_path, response.content)
+            metadata = {key: response.headers[header] for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')) if header in response.headers}
+            if len(metadata) > 0:
+                _write_atomic(f'{full_path}.meta', json.dumps(metadata).encode())
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return full_path
+
+
+def fetch_many(files, base_url=None, revalidate=False, max_workers=settings.download_max_workers):
+    """
+    Downloads several files concurrently over the shared connection pool.
+
+    Parameters
+    ----------
+    files: iterable of (str, str) tuples
+        (server path, local path) of each file.
+    base_url: str or None
+        See fetch.
+    revalidate: bool
+        See fetch.
+    max_workers: int
+        Maximum number of simultaneous downloads.
+
+    Returns
+    -------
+    results: dict
+        Maps each local path to None if it was downloaded (or already present), or to the exception raised for it.
+    """
+    def _fetch(file):
+        try:
+            fetch(file[0], file[1], base_url=base_url, revalidate=revalidate)
+        except Exception as e:
+            return file[1], e
+        return file[1], None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(_fetch, files))
+
+
+def convective_outlook_path(year, local_filename):
+    """ Server path of a convective outlook kmz file. """
+    return f'products/outlook/archive/{year}/{local_filename}'
+
+
+def fire_outlook_path(year, local_filename):
+    """ Server path of a fire weather outlook kmz file. """
+    return f'products/fire_wx/{year}/{local_filename}'
@@ -0,0 +1,274 @@
+"""
+Fingerprints of outlook hazard layers, used to skip drawing maps that did not change since a previous issuance.
+
+SPC often reissues an outlook where a hazard layer is identical to the one it replaces (e.g. the 1630 UTC tornado
+probabilities after the 1300 UTC outlook). A render fingerprint hashes the normalized vertices and level names of the layer
+with everything else that changes the image (region, render profiles, storm reports). When a map with the same fingerprint
+was already saved in the image directory, its images are reused: copied with the new title drawn over the old one, or
+symlinked (settings.render_dedupe).
+
+Every saved or reused image is recorded in a JSON lines manifest in its image directory (settings.render_manifest_filename),
+which is also where previous renders are looked up. Render fingerprints include a hash of the drawing code and of the
+settings it reads (see renderer_fingerprint), so maps drawn by another version are drawn again rather than reused.
+
+Deduplication is opt-in: it is off while settings.render_dedupe is None.
+"""
+
+import fcntl
+import functools
+import hashlib
+import importlib.metadata
+import json
+import os
+import numpy as np
+import pandas as pd
+import matplotlib
+import matplotlib.pyplot as plt
+import outlook
+import render
+import settings
+
+_manifests = dict({})  # Manifest path -> RenderManifest, kept between plots in this process
+_RENDERER_MODULES = ('basemap', 'fingerprint', 'outlook', 'plot_outlooks', 'regions', 'render', 'simplify', 'utils')  # Code that changes the images
+
+
+def _normalized_ring(ring):
+    """
+    Returns the (lon, lat) vertices of a ring rounded to about 10 cm, without the repeated closing vertex and starting at
+    its smallest vertex, so the same polygon written from another starting point has the same bytes.
+    """
+    xy = np.round(np.asarray(ring, dtype=np.float64)[:, :2], 6)
+    if len(xy) > 1 and (xy[0] == xy[-1]).all():
+        xy = xy[:-1]
+    if len(xy) == 0:
+        return xy
+    start = np.lexsort((xy[:, 1], xy[:, 0]))[0]
+    return np.ascontiguousarray(np.roll(xy, -start, axis=0))
+
+
+def layer_fingerprint(folders, product):
+    """
+    Returns the fingerprint of one hazard layer of a parsed outlook.
+
+    Parameters
+    ----------
+    folders: list of kml.Folder
+        Parsed outlook.
+    product: str
+        'cat', 'torn', 'wind', 'hail' or 'fire'.
+
+    Returns
+    -------
+    fingerprint: str
+        Hex digest of the level names and normalized rings of every level, and of the significant severe rings. The order
+        of the placemarks and of the rings within a level does not matter.
+    """
+    levels, significant_rings = outlook.risk_levels(folders, product)
+    digest = hashlib.sha1(product.encode())
+    for name, rings in list(levels.items()) + [('significant', significant_rings)]:
+        ring_bytes = sorted(_normalized_ring(ring).tobytes() for ring in rings)
+        digest.update(f'{name}:{len(ring_bytes)}'.encode())
+        for data in ring_bytes:
+            digest.update(len(data).to_bytes(8, 'little'))
+            digest.update(data)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _code_fingerprint():
+    """ Hash of the source of the modules that draw the maps and of the versions of the plotting libraries. Computed once per process. """
+    digest = hashlib.sha1(f"matplotlib {matplotlib.__version__} cartopy {importlib.metadata.version('cartopy')}".encode())
+    for name in _RENDERER_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def renderer_fingerprint():
+    """
+    Returns a hash of everything besides its inputs that decides how a map looks: the drawing code, the plotting library
+    versions, and the settings the drawing code reads. Maps recorded with another renderer fingerprint are never reused.
+    """
+    drawing_settings = [settings.colors, settings.hatch_linewidth, settings.region_clip_padding, settings.lod_tolerance_pixels]
+    return hashlib.sha1((_code_fingerprint() + json.dumps(drawing_settings, sort_keys=True)).encode()).hexdigest()
+
+
+def render_fingerprint(folders, product, profiles=None, extent=None, reports=None, **options):
+    """
+    Returns the fingerprint of a map: two maps with the same fingerprint only differ by their title.
+
+    Parameters
+    ----------
+    folders: list of kml.Folder
+        Parsed outlook.
+    product: str
+        'cat', 'torn', 'wind', 'hail' or 'fire'.
+    profiles: iterable of str or None
+        Render profiles of the images (see render.save_figure).
+    extent: iterable with 4 floats or None
+        Extent of the map.
+    reports: list of pd.DataFrame or None
+        Storm reports drawn on the map. Reports of the current day keep changing, so they are hashed rather than their date.
+    **options
+        Other drawing options (e.g. remove_unknowns). Values must be JSON serializable.
+
+    Returns
+    -------
+    fingerprint: str
+    """
+    digest = hashlib.sha1((renderer_fingerprint() + layer_fingerprint(folders, product)).encode())
+    profile_settings = render.product_profiles(product, profiles)
+    digest.update(json.dumps([profile_settings, None if extent is None else [float(value) for value in extent], options], sort_keys=True).encode())
+    for report_frame in reports or []:
+        digest.update(pd.util.hash_pandas_object(report_frame, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+class RenderManifest:
+    __slots__ = ('path', '_offset', '_renders')
+
+    def __init__(self, path):
+        """
+        path: str
+            Path of the JSON lines manifest. It is created on the first record.
+        """
+        self.path = path
+        self._offset = 0  # Bytes of the manifest already read
+        self._renders = dict({})  # Fingerprint -> latest record of images with that fingerprint
+
+    def _refresh(self):
+        """ Reads the records appended since the last read, by this or any other process. """
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        complete = data[:data.rfind(b'\n') + 1]  # A record being appended by another process is read next time
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            record = json.loads(line)
+            if record['layout'] is not None:
+                self._renders[record['fingerprint']] = record
+
+    def find(self, fingerprint):
+        """ Returns the latest record of images with a fingerprint that still exist, or None. """
+        self._refresh()
+        record = self._renders.get(fingerprint)
+        if record is None or not all(os.path.isfile(path) for path in record['paths']):
+            return None
+        return record
+
+    def record(self, fingerprint, paths, title, layout, status, source_paths=None):
+        """
+        Appends a record to the manifest.
+
+        Parameters
+        ----------
+        fingerprint: str
+        paths: list of str
+            Saved images.
+        title: str
+        layout: dict or None
+            Title layout of the images (see render.title_layout). Images without a layout are never reused.
+        status: str
+            'rendered', 'retitled', 'linked' or 'unchanged'.
+        source_paths: list of str or None
+            Images that were reused.
+        """
+        record = dict(fingerprint=fingerprint, paths=paths, title=title, layout=layout, status=status, source_paths=source_paths)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # One line per write, so concurrent batch workers never interleave records
+            try:
+                f.write(json.dumps(record) + '\n')
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_manifest(image_dir):
+    """ Returns the manifest of an image directory. """
+    path = os.path.join(image_dir, settings.render_manifest_filename)
+    if path not in _manifests:
+        _manifests[path] = RenderManifest(path)
+    return _manifests[path]
+
+
+def _image_paths(image_base, product, profiles):
+    return [f"{image_base}{profile.get('suffix', '')}.{render.EXTENSIONS[profile['format']]}" for profile in render.product_profiles(product, profiles).values()]
+
+
+def _symlink(source_path, path):
+    """ Points 'path' at 'source_path' with a relative symlink, replacing any existing file. """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.symlink(os.path.relpath(source_path, os.path.dirname(path) or '.'), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def reuse_images(fingerprint, image_base, product, profiles, title):
+    """
+    Saves the images of a map from a previous render with the same fingerprint, if there is one.
+
+    Parameters
+    ----------
+    fingerprint: str or None
+        Render fingerprint of the map (see render_fingerprint). If None, nothing is reused.
+    image_base: str
+        Path of the images without their suffix and extension (see render.save_figure).
+    product: str
+    profiles: iterable of str or None
+    title: str
+        Title of the new map.
+
+    Returns
+    -------
+    paths: list of str or None
+        Paths of the saved images, or None if the map has to be drawn.
+    """
+    if fingerprint is None or settings.render_dedupe is None:
+        return None
+    manifest = get_manifest(os.path.dirname(image_base) or '.')
+    source = manifest.find(fingerprint)
+    if source is None:
+        return None
+
+    paths = _image_paths(image_base, product, profiles)
+    if paths == source['paths'] and title == source['title']:
+        status = 'unchanged'  # Same map saved again, nothing to write
+    elif settings.render_dedupe == 'link' or title == source['title']:
+        for source_path, path in zip(source['paths'], paths):
+            if os.path.realpath(source_path) != os.path.realpath(path):
+                _symlink(os.path.realpath(source_path), path)
+        status = 'linked'
+    elif render.retitle(source['paths'], paths, product, profiles, title, source['layout']):
+        status = 'retitled'
+    else:
+        return None
+
+    # Linked images keep the title of their source
+    manifest.record(fingerprint, paths, title if status == 'retitled' else source['title'], source['layout'], status, source['paths'])
+    return paths
+
+
+def save_figure(fingerprint, image_base, product, profiles=None):
+    """
+    Saves the current figure with render.save_figure and records it in the manifest of its image directory.
+
+    Parameters
+    ----------
+    fingerprint: str or None
+        Render fingerprint of the map. If None, the images are saved without being recorded.
+    image_base: str
+    product: str
+    profiles: iterable of str or None
+
+    Returns
+    -------
+    paths: list of str
+    """
+    if fingerprint is None or settings.render_dedupe is None:
+        return render.save_figure(image_base, product, profiles)
+    fig = plt.gcf()
+    title, layout = fig.axes[0].get_title(), render.title_layout(fig)
+    paths = render.save_figure(image_base, product, profiles, fig=fig)
+    get_manifest(os.path.dirname(image_base) or '.').record(fingerprint, paths, title, layout, 'rendered')
+    return paths
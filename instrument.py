@@ -0,0 +1,278 @@
+"""
+Per-stage timing and memory instrumentation of renders.
+
+Product functions decorated with @instrument.render are recorded as one render each, and the slow stages they go through
+(downloads, KMZ parsing, polygons, background, storm reports, savefig...) are timed with instrument.stage. Every record holds
+the wall and CPU time of each stage, the resident set size after it, the peak resident set size of the process, the
+number of artists, paths, vertices and report markers in the saved figure, and optionally the peak Python allocations of
+each stage (tracemalloc).
+
+Records are written to settings.instrument_dir, either appended to a JSON lines file shared by all processes
+('jsonl'), or aggregated per process into a Prometheus text file for the node exporter's textfile collector ('prometheus').
+Instrumentation is disabled when settings.instrument_format is None, in which case a stage costs one settings lookup.
+
+Stages that run outside of a render (e.g. in the download and parsing threads of batch.render_pipeline) are not recorded.
+Renders started inside another render (e.g. the products of plot_outlooks.render_convective_products) get their own
+record, and their stages are not counted again in the enclosing render.
+"""
+
+import contextlib
+import datetime
+import fcntl
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import settings
+
+STAGES = ('fetch', 'fetch_reports', 'parse', 'cache_read', 'load_reports', 'dedupe', 'polygons', 'background', 'reports', 'savefig', 'retitle')
+FORMATS = ('jsonl', 'prometheus')
+_ISSUANCE_ARGS = ('outlook_day', 'year', 'month', 'day', 'time')
+
+_local = threading.local()  # Stack of the renders running in this thread
+_metrics = dict({})  # (metric, labels) -> value, the Prometheus metrics of this process
+_metrics_lock = threading.Lock()
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def _renders():
+    if not hasattr(_local, 'renders'):
+        _local.renders = []
+    return _local.renders
+
+
+def _rss_bytes():
+    """ Current resident set size of this process, or None where /proc is not available. """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_bytes():
+    """ Peak resident set size of this process since it started. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Bytes on macOS, kilobytes on Linux
+
+
+class RenderRecord:
+    __slots__ = ('product', 'issuance', 'parent', 'stages', 'figure', 'started', '_wall', '_cpu', '_rss', '_traced')
+
+    def __init__(self, product, issuance=None, parent=None):
+        """
+        product: str
+            Product of the render ('cat', 'torn', 'wind', 'hail', 'fire', or 'convective' for several products at once).
+        issuance: dict or None
+            Outlook day, date and time of the rendered outlook.
+        parent: str or None
+            Product of the enclosing render, if any.
+        """
+        self.product = product
+        self.issuance = issuance
+        self.parent = parent
+        self.stages = dict({})  # Stage name -> dict of its totals
+        self.figure = None  # Counts of the saved figure (see count_figure)
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._wall, self._cpu, self._rss = time.perf_counter(), time.process_time(), _rss_bytes()
+        self._traced = False
+        if settings.instrument_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._traced = True  # Stopped when this render ends
+
+    def add_stage(self, name, wall, cpu, traced_peak):
+        totals = self.stages.setdefault(name, dict(calls=0, seconds=0., cpu_seconds=0.))
+        totals['calls'] += 1
+        totals['seconds'] += wall
+        totals['cpu_seconds'] += cpu
+        totals['rss_bytes'] = _rss_bytes()
+        if traced_peak is not None:
+            totals['tracemalloc_peak_bytes'] = max(totals.get('tracemalloc_peak_bytes', 0), traced_peak)
+
+    def finish(self, paths=None, error=None):
+        """ Returns the record of the render as a JSON serializable dict. """
+        if self._traced:
+            tracemalloc.stop()
+        record = dict(time=self.started.isoformat(timespec='milliseconds'), pid=os.getpid(), product=self.product, issuance=self.issuance,
+                      parent=self.parent, status='ok' if error is None else 'error', error=error, seconds=time.perf_counter() - self._wall,
+                      cpu_seconds=time.process_time() - self._cpu, stages=self.stages, rss_bytes_start=self._rss, rss_bytes=_rss_bytes(),
+                      peak_rss_bytes=_peak_rss_bytes(), figure=self.figure, paths=paths)
+        return record
+
+
+def _traced_stages():
+    if not hasattr(_local, 'traced_stages'):
+        _local.traced_stages = []
+    return _local.traced_stages
+
+
+@contextlib.contextmanager
+def _timed_stage(record, name):
+    traced = tracemalloc.is_tracing()
+    if traced:
+        # The peak is reset for every stage, so the stages running in this thread keep their own [start, peak] on a
+        # stack: a stage hands its peak to the enclosing one before resetting it, and again when it ends
+        stages = _traced_stages()
+        current, peak = tracemalloc.get_traced_memory()
+        if len(stages) > 0:
+            stages[-1][1] = max(stages[-1][1], peak)
+        tracemalloc.reset_peak()
+        stages.append([current, current])
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        traced_peak = None
+        if traced:
+            start, peak = stages.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0)
+            if len(stages) > 0:
+                stages[-1][1] = max(stages[-1][1], peak)
+            traced_peak = peak - start  # Allocated by the stage on top of what was already there
+        record.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu, traced_peak)
+
+
+def stage(name):
+    """
+    Returns a context manager timing a stage of the current render.
+
+    Parameters
+    ----------
+    name: str
+        Name of the stage, one of STAGES. A stage run several times in a render (e.g. one scatter per report class) is
+        summed up.
+    """
+    if settings.instrument_format is None:
+        return _NULL_STAGE
+    renders = _renders()
+    if len(renders) == 0:
+        return _NULL_STAGE
+    return _timed_stage(renders[-1], name)
+
+
+def count_figure(fig):
+    """
+    Counts the artists, paths, vertices and markers of a figure into the current render. Called by render.save_figure
+    before the figure is saved.
+    """
+    if settings.instrument_format is None or len(_renders()) == 0:
+        return
+    artists, paths, vertices, markers = 0, 0, 0, 0
+    for artist in fig.findobj():
+        artists += 1
+        if hasattr(artist, 'get_offsets') and hasattr(artist, 'get_paths'):  # Collections
+            artist_paths = artist.get_paths()
+            if hasattr(artist, 'get_sizes') and len(artist.get_sizes()) > 0:  # A scatter: one marker path stamped at every offset
+                markers += len(artist.get_offsets())
+        elif hasattr(artist, 'get_path'):  # Patches and lines
+            artist_paths = [artist.get_path()]
+        else:
+            continue
+        paths += len(artist_paths)
+        vertices += sum(len(path.vertices) for path in artist_paths)
+    _renders()[-1].figure = dict(artists=artists, paths=paths, vertices=vertices, markers=markers)
+
+
+def _append_jsonl(record):
+    path = os.path.join(settings.instrument_dir, settings.instrument_jsonl_filename)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # One line per write, so the records of concurrent workers never interleave
+        try:
+            f.write(json.dumps(record) + '\n')
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(labels.items()))
+
+
+def _add_metric(metric, labels, value, gauge=False):
+    key = (metric, labels)
+    _metrics[key] = value if gauge else _metrics.get(key, 0) + value
+
+
+def _write_prometheus(record):
+    """ Adds a render to the metrics of this process and rewrites its Prometheus text file. """
+    pid, product = os.getpid(), record['product']
+    with _metrics_lock:
+        render_labels = _labels(pid=pid, product=product)
+        _add_metric('spc_render_seconds_sum', render_labels, record['seconds'])
+        _add_metric('spc_render_seconds_count', render_labels, 1)
+        _add_metric('spc_render_errors_total', render_labels, int(record['status'] != 'ok'))
+        for name, totals in record['stages'].items():
+            stage_labels = _labels(pid=pid, product=product, stage=name)
+            _add_metric('spc_render_stage_seconds_sum', stage_labels, totals['seconds'])
+            _add_metric('spc_render_stage_seconds_count', stage_labels, totals['calls'])
+        for name, value in (record['figure'] or dict({})).items():
+            _add_metric(f'spc_render_figure_{name}', render_labels, value, gauge=True)  # Counts of the latest figure
+        _add_metric('spc_render_peak_rss_bytes', _labels(pid=pid), record['peak_rss_bytes'], gauge=True)
+
+        lines = []
+        for metric, help_text, metric_type in (('spc_render_seconds', 'Wall time of renders.', 'summary'),
+                                               ('spc_render_errors_total', 'Renders that raised an exception.', 'counter'),
+                                               ('spc_render_stage_seconds', 'Wall time of the stages of renders.', 'summary'),
+                                               ('spc_render_figure_artists', 'Artists in the latest saved figure.', 'gauge'),
+                                               ('spc_render_figure_paths', 'Paths in the latest saved figure.', 'gauge'),
+                                               ('spc_render_figure_vertices', 'Vertices in the latest saved figure.', 'gauge'),
+                                               ('spc_render_figure_markers', 'Storm report markers in the latest saved figure.', 'gauge'),
+                                               ('spc_render_peak_rss_bytes', 'Peak resident set size of the render process.', 'gauge')):
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {metric_type}']
+            for (name, labels), value in sorted(_metrics.items()):
+                if name == metric or (metric_type == 'summary' and name in (f'{metric}_sum', f'{metric}_count')):
+                    lines.append('%s{%s} %s' % (name, labels, repr(float(value)) if isinstance(value, float) else value))
+        content = '\n'.join(lines) + '\n'
+
+    # The textfile collector reads every *.prom file, so each process writes its own and replaces it atomically
+    path = os.path.join(settings.instrument_dir, f'render_metrics_{pid}.prom')
+    fd, tmp_path = tempfile.mkstemp(dir=settings.instrument_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def emit(record):
+    """ Writes a finished render record in settings.instrument_format. """
+    if settings.instrument_format not in FORMATS:
+        raise ValueError(f"Unknown instrumentation format: {settings.instrument_format}. Valid formats: {', '.join(FORMATS)}")
+    os.makedirs(settings.instrument_dir, exist_ok=True)
+    if settings.instrument_format == 'jsonl':
+        _append_jsonl(record)
+    else:
+        _write_prometheus(record)
+
+
+def render(product):
+    """
+    Decorates a product function so each call is recorded as one render of 'product'. The outlook day, date and time of
+    the render are taken from the function's arguments of the same names.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if settings.instrument_format is None:
+                return function(*args, **kwargs)
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            issuance = {name: arguments[name] for name in _ISSUANCE_ARGS if name in arguments}
+            renders = _renders()
+            record = RenderRecord(product, issuance, renders[-1].product if len(renders) > 0 else None)
+            renders.append(record)
+            try:
+                paths = function(*args, **kwargs)
+            except BaseException as e:
+                renders.pop()
+                emit(record.finish(error=f'{type(e).__name__}: {e}'))
+                raise
+            renders.pop()
+            emit(record.finish(paths=paths))
+            return paths
+        return wrapper
+    return decorator
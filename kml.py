@@ -0,0 +1,135 @@
+import re
+from zipfile import ZipFile
+import numpy as np
+from lxml import etree
+
+
+class Placemark:
+    """ A single KML Placemark: its name, the values of its SimpleData fields, and its decoded coordinate rings. """
+    __slots__ = ('name', 'simpledata', 'rings')
+
+    def __init__(self, name, simpledata, rings):
+        """
+        name: str or None
+        simpledata: dict mapping SimpleData 'name' attributes to their text, in document order
+        rings: list of float64 arrays with shape (N, 2) or (N, 3)
+        """
+        self.name = name
+        self.simpledata = simpledata
+        self.rings = rings
+
+    @property
+    def label(self):
+        """ Text of the first SimpleData field (the DN value in SPC outlooks). """
+        return next(iter(self.simpledata.values()), '')
+
+    @property
+    def extendeddata(self):
+        """ All SimpleData text joined together, equivalent to the text content of the ExtendedData element. """
+        return ''.join(self.simpledata.values())
+
+
+class Folder:
+    """ A KML Folder and the placemarks directly inside it. """
+    __slots__ = ('name', 'placemarks')
+
+    def __init__(self, name, placemarks):
+        self.name = name
+        self.placemarks = placemarks
+
+
+_COMMA_SPACES = re.compile(r'\s*,\s*')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_coordinates(text):
+    """
+    Decodes the text of a KML <coordinates> element in one vectorized pass.
+
+    Parameters
+    ----------
+    text: str
+        Whitespace-separated coordinate tuples, e.g. "lon,lat lon,lat" or "lon,lat,alt lon,lat,alt". Whitespace around
+        the commas inside a tuple is tolerated.
+
+    Returns
+    -------
+    coordinates: np.ndarray of shape (N, 2) or (N, 3)
+        Float64 coordinates with one row per tuple.
+    """
+    if text is None or not text.strip():
+        return np.empty((0, 2), dtype=np.float64)
+    text = _COMMA_SPACES.sub(',', text.strip())
+    ncols = text.split(None, 1)[0].count(',') + 1
+    values = np.fromstring(text.replace(',', ' '), dtype=np.float64, sep=' ')
+    return values.reshape(-1, ncols)
+
+
+def iter_kml(kml_file):
+    """
+    Streams Folder records out of a KML document without building the full element tree.
+
+    Parameters
+    ----------
+    kml_file: file-like object or str
+        Open binary file or path of the KML document.
+
+    Yields
+    ------
+    folder: Folder
+        Each folder as soon as its closing tag is read. Placemarks are assigned to the innermost folder containing them.
+    """
+    open_folders = []
+    for event, elem in etree.iterparse(kml_file, events=('start', 'end')):
+        tag = _local_name(elem.tag)
+
+        if tag == 'Folder':
+            if event == 'start':
+                open_folders.append(Folder(None, []))
+            else:
+                folder = open_folders.pop()
+                folder.name = elem.findtext('{*}name', '')
+                elem.clear()
+                yield folder
+
+        elif tag == 'Placemark' and event == 'end':
+            simpledata = {sd.get('name'): sd.text or '' for sd in elem.iter('{*}SimpleData')}
+            rings = [parse_coordinates(coord.text) for coord in elem.iter('{*}coordinates')]
+            if open_folders:
+                open_folders[-1].placemarks.append(Placemark(elem.findtext('{*}name'), simpledata, rings))
+
+            # Free the placemark and any placemarks already processed so memory does not grow with the document
+            elem.clear()
+            for sibling in list(elem.itersiblings(preceding=True)):
+                if _local_name(sibling.tag) == 'Placemark':
+                    elem.getparent().remove(sibling)
+
+
+def iter_kmz(kmz_path, kml_name=None):
+    """
+    Streams Folder records out of the KML document inside a KMZ archive.
+
+    Parameters
+    ----------
+    kmz_path: str
+        Path to the KMZ file.
+    kml_name: str or None
+        Name of the KML member inside the archive. If None, the first member ending in '.kml' is used.
+
+    Yields
+    ------
+    folder: Folder
+    """
+    with ZipFile(kmz_path, 'r') as kmz:
+        if kml_name is None:
+            kml_name = next(name for name in kmz.namelist() if name.endswith('.kml'))
+        with kmz.open(kml_name, 'r') as kml_file:
+            yield from iter_kml(kml_file)
+
+
+def read_kmz(kmz_path, kml_name=None):
+    """ Returns a list of all Folder records in a KMZ archive, in the order their closing tags appear. """
+    return list(iter_kmz(kmz_path, kml_name))
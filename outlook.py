@@ -0,0 +1,381 @@
+"""
+Loading SPC outlooks, grouping their rings by risk level, and the array-backed Outlook / HazardLayer geometry model shared
+by the plots, caches and analysis code. Nothing here needs matplotlib or cartopy.
+
+Levels are named like the keys of settings.colors ('TSTM', 'MRGL', ..., 'TOR2', ..., 'HAIL60', 'Elevated', ...) and are always
+listed from the lowest to the highest risk.
+"""
+
+import datetime
+import json
+import os
+import numpy as np
+import download
+import outlook_cache
+
+CATEGORICAL_LEVELS = ('TSTM', 'MRGL', 'SLGT', 'ENH', 'MDT', 'HIGH')
+CATEGORICAL_DESCRIPTIONS = ('General Thunder', 'Marginal Risk', 'Slight Risk', 'Enhanced Risk', 'Moderate Risk', 'High Risk')
+PROBABILITIES = dict(torn=(2, 5, 10, 15, 30, 45, 60), wind=(5, 15, 30, 45, 60), hail=(5, 15, 30, 45, 60))
+LEVEL_PREFIXES = dict(torn='TOR', wind='WIND', hail='HAIL')
+FIRE_LEVELS = ('Elevated', 'Critical', 'Extreme')
+DRY_THUNDER_LEVELS = ('Iso DryT', 'Scattered DryT')
+
+PRODUCT_LEVELS = dict(cat=CATEGORICAL_LEVELS, fire=FIRE_LEVELS + DRY_THUNDER_LEVELS,
+                      **{product: tuple(f'{LEVEL_PREFIXES[product]}{p}' for p in PROBABILITIES[product]) for product in PROBABILITIES})
+SIGNIFICANT_LEVELS = dict(torn='SIGTOR', wind='SIGWIND', hail='SIGHAIL')  # Hatched significant severe areas
+CONVECTIVE_PRODUCTS = ('cat', 'torn', 'wind', 'hail')
+KIND_PRODUCTS = dict(convective=CONVECTIVE_PRODUCTS, fire=('fire', ))
+
+# Every level of every product, ordered by product and then from the lowest to the highest risk. Outlook.ring_levels holds
+# indexes into this tuple, so the rings of a product, and of each of its levels, are contiguous.
+LEVELS = tuple(level for product in CONVECTIVE_PRODUCTS + ('fire', ) for level in PRODUCT_LEVELS[product] + ((SIGNIFICANT_LEVELS[product], ) if product in SIGNIFICANT_LEVELS else ()))
+LEVEL_CODES = {level: code for code, level in enumerate(LEVELS)}
+OUTLOOK_FORMAT_VERSION = 1
+
+
+def convective_outlook_filename(outlook_day, year, month, day, time):
+    """ Returns the name of the SPC kmz file for a convective outlook. Day 4-8 outlooks do not have a time in their name. """
+    timestring = '_%04d' % time if 0 < outlook_day < 4 else ''
+    return f'day{outlook_day}otlk_{year}%02d%02d{timestring}.kmz' % (month, day)
+
+
+def fire_outlook_filename(outlook_day, year, month, day, time):
+    """ Returns the name of the SPC kmz file for a fire weather outlook. """
+    return '%s%02d%02d_%04d_day%dfirewx.kmz' % (str(year)[2:], month, day, time, outlook_day)
+
+
+def load_convective_outlook(outlook_day, year, month, day, time, outlook_kmz_dir):
+    """
+    Downloads an SPC convective outlook if it is not already in 'outlook_kmz_dir', then returns its parsed folders.
+
+    Parameters
+    ----------
+    outlook_day: int
+        Outlook day.
+    year: int
+        YYYY
+    month: int
+        MM
+    day: int
+        DD
+    time: int
+        Time in UTC. HHMM
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+
+    Returns
+    -------
+    folders: list of kml.Folder
+    """
+    local_filename = convective_outlook_filename(outlook_day, year, month, day, time)
+    full_path = f'{outlook_kmz_dir}/{local_filename}'
+
+    download.fetch(download.convective_outlook_path(year, local_filename), full_path)
+
+    return outlook_cache.read_kmz(full_path, local_filename.replace('kmz', 'kml'))
+
+
+def load_fire_outlook(outlook_day, year, month, day, time, outlook_kmz_dir):
+    """ Downloads an SPC fire weather outlook if it is not already in 'outlook_kmz_dir', then returns its parsed folders. """
+    local_filename = fire_outlook_filename(outlook_day, year, month, day, time)
+    full_path = f'{outlook_kmz_dir}/{local_filename}'
+
+    download.fetch(download.fire_outlook_path(year, local_filename), full_path)
+
+    return outlook_cache.read_kmz(full_path, local_filename.replace('kmz', 'kml'))
+
+
+def _placemark_percent(placemark):
+    """ Name of a probabilistic placemark, e.g. '15 %'. Some archives leave the name out, in which case it is rebuilt from the DN value. """
+    return placemark.name if placemark.name is not None else f'{placemark.label} %'
+
+
+def _probabilistic_folders(folders, product):
+    """ Returns the placemarks of the probability and significant severe folders of a hazard. """
+    if product == 'torn':
+        pm, pm_sig = None, []
+        for folder in folders:
+            if '_torn' in folder.name:
+                pm = folder.placemarks
+            if '_sigtorn' in folder.name:
+                pm_sig = folder.placemarks
+        return pm, pm_sig
+    index = dict(wind=3, hail=5)[product]  # Wind and hail are always the 4th/5th and 6th/7th folders of a convective outlook
+    if len(folders) <= index + 1:
+        return None, []
+    return folders[index].placemarks, folders[index + 1].placemarks
+
+
+def risk_levels(folders, product):
+    """
+    Groups the rings of a parsed outlook by risk level.
+
+    Parameters
+    ----------
+    folders: list of kml.Folder or Outlook
+        Parsed outlook. The rings of an Outlook are views of its arrays, with (lon, lat) vertices only.
+    product: str
+        'cat', 'torn', 'wind', 'hail' or 'fire'.
+
+    Returns
+    -------
+    levels: dict
+        Maps every level of the product (PRODUCT_LEVELS[product], lowest to highest) to its list of (N, 2) or (N, 3) rings.
+    significant_rings: list of np.ndarray
+        Rings of the hatched significant severe area (always empty for the categorical and fire outlooks).
+
+    Raises
+    ------
+    ValueError
+        - If the outlook has no data for the product, or has a level this module does not know.
+    """
+    if isinstance(folders, Outlook):
+        layer = folders.layer(product)
+        return layer.level_rings(), layer.rings(SIGNIFICANT_LEVELS[product]) if product in SIGNIFICANT_LEVELS else []
+
+    levels = {level: [] for level in PRODUCT_LEVELS[product]}
+    significant_rings = []
+
+    if product == 'cat':
+        for placemark in folders[0].placemarks:  # Index 0 of the folders contains the categorical outlook data
+            extendeddata = placemark.extendeddata
+            for level, description in zip(CATEGORICAL_LEVELS, CATEGORICAL_DESCRIPTIONS):
+                if description in extendeddata:
+                    levels[level].extend(placemark.rings)
+                    break
+
+    elif product == 'fire':
+        for folder in folders:
+            for placemark in folder.placemarks:
+                name = placemark.name or ''
+                if 'dryltg' in folder.name:
+                    level = 'Iso DryT' if 'Isolated' in name else 'Scattered DryT' if 'Scattered' in name else None
+                else:
+                    level = next((level for level in FIRE_LEVELS if level in name), None)
+                if level is not None:
+                    levels[level].extend(placemark.rings)
+
+    else:
+        pm, pm_sig = _probabilistic_folders(folders, product)
+        if pm is None:
+            raise ValueError(f"No {product} data found in the outlook")
+        for placemark in pm:
+            percent = _placemark_percent(placemark)
+            if product != 'torn' and percent in ('10 %', '0 %'):  # Significant wind/hail area stored with the probabilities
+                continue
+            try:
+                probability = int(percent.rstrip(' %'))
+            except ValueError:
+                raise ValueError(f"Unknown {product} risk category: {percent}")
+            level = f'{LEVEL_PREFIXES[product]}{probability}'
+            if level not in levels:
+                raise ValueError(f"Unknown {product} risk category: {percent}")
+            levels[level].extend(placemark.rings)
+        significant_rings = [ring for placemark in pm_sig for ring in placemark.rings]
+
+    return levels, significant_rings
+
+
+def _has_product(folders, product):
+    """ Whether parsed folders hold data for a product (the categorical and fire products are always present). """
+    return product in ('cat', 'fire') or _probabilistic_folders(folders, product)[0] is not None
+
+
+def _split_rings(vertices, ring_offsets, start, stop):
+    """ Views of the vertices of rings start to stop - 1. """
+    return [vertices[ring_offsets[r]:ring_offsets[r + 1]] for r in range(start, stop)]
+
+
+class HazardLayer:
+    """
+    Rings of one product of an outlook (e.g. its tornado probabilities), sorted by risk level. The arrays are views of
+    the Outlook's, so a layer costs nothing to make.
+    """
+    __slots__ = ('product', 'vertices', 'ring_offsets', 'ring_levels')
+
+    def __init__(self, product, vertices, ring_offsets, ring_levels):
+        """
+        product: str
+            'cat', 'torn', 'wind', 'hail' or 'fire'.
+        vertices: np.ndarray
+            (N, 2) (lon, lat) vertices of every ring.
+        ring_offsets: np.ndarray of int64
+            Ring r holds vertices[ring_offsets[r]:ring_offsets[r + 1]].
+        ring_levels: np.ndarray of int16
+            Level of every ring, as an index into LEVELS.
+        """
+        self.product = product
+        self.vertices = vertices
+        self.ring_offsets = ring_offsets
+        self.ring_levels = ring_levels
+
+    @property
+    def levels(self):
+        """ Levels of the product, from the lowest to the highest risk. """
+        return PRODUCT_LEVELS[self.product]
+
+    def rings(self, level=None):
+        """
+        Returns views of the rings of one level (a name in PRODUCT_LEVELS[product] or SIGNIFICANT_LEVELS[product]), or of
+        every ring if 'level' is None.
+        """
+        if level is None:
+            return _split_rings(self.vertices, self.ring_offsets, 0, len(self))
+        if level not in self.levels and level != SIGNIFICANT_LEVELS.get(self.product):
+            raise ValueError(f"{level} is not a level of the {self.product} outlook")
+        start, stop = np.searchsorted(self.ring_levels, [LEVEL_CODES[level], LEVEL_CODES[level] + 1])
+        return _split_rings(self.vertices, self.ring_offsets, start, stop)
+
+    def level_rings(self):
+        """ Maps every level of the product, from the lowest to the highest risk, to its rings (see risk_levels). """
+        return {level: self.rings(level) for level in self.levels}
+
+    def __len__(self):
+        return len(self.ring_levels)
+
+    def __repr__(self):
+        return f'HazardLayer({self.product}: {len(self)} rings, {len(self.vertices)} vertices)'
+
+
+class Outlook:
+    """
+    Geometry of a parsed outlook in three flat arrays, plus its issuance.
+
+    The rings of every product are concatenated into one vertex array and sorted by product and risk level, so a product's
+    HazardLayer, and each of its levels, is a contiguous slice. Outlooks pickle as a handful of buffers, which makes them
+    cheap to send to worker processes, and can be saved to and memory-mapped from a directory of .npy files.
+    """
+    __slots__ = ('kind', 'outlook_day', 'date', 'time', 'products', 'vertices', 'ring_offsets', 'ring_levels')
+
+    def __init__(self, kind, outlook_day, date, time, products, vertices, ring_offsets, ring_levels):
+        """
+        kind: str
+            'convective' or 'fire'.
+        outlook_day: int or None
+        date: datetime.date or None
+        time: int (HHMM) or None
+        products: tuple of str
+            Products the outlook has data for.
+        vertices: np.ndarray of float64
+            (N, 2) (lon, lat) vertices of every ring.
+        ring_offsets: np.ndarray of int64
+            (num rings + 1) start of every ring in 'vertices', and the total number of vertices.
+        ring_levels: np.ndarray of int16
+            Level of every ring, as an index into LEVELS. Sorted.
+        """
+        self.kind = kind
+        self.outlook_day = outlook_day
+        self.date = date
+        self.time = time
+        self.products = products
+        self.vertices = vertices
+        self.ring_offsets = ring_offsets
+        self.ring_levels = ring_levels
+
+    @classmethod
+    def from_folders(cls, folders, kind='convective', outlook_day=None, date=None, time=None):
+        """
+        Builds an Outlook from parsed KML folders.
+
+        Parameters
+        ----------
+        folders: list of kml.Folder
+        kind: str
+            'convective' or 'fire'.
+        outlook_day, date, time:
+            Issuance of the outlook, if known.
+
+        Raises
+        ------
+        ValueError
+            - If the outlook has a level this module does not know.
+        """
+        products = tuple(product for product in KIND_PRODUCTS[kind] if _has_product(folders, product))
+        rings, codes = [], []
+        for product in products:
+            levels, significant_rings = risk_levels(folders, product)
+            if product in SIGNIFICANT_LEVELS:
+                levels[SIGNIFICANT_LEVELS[product]] = significant_rings
+            for level, level_rings in levels.items():
+                rings.extend(ring[:, :2] for ring in level_rings)
+                codes.extend([LEVEL_CODES[level]] * len(level_rings))
+
+        order = np.argsort(codes, kind='stable')  # Levels in LEVELS order, rings in placemark order within each level
+        rings = [rings[i] for i in order]
+        ring_offsets = np.cumsum([0] + [len(ring) for ring in rings], dtype=np.int64)
+        vertices = np.concatenate(rings).astype(np.float64) if rings else np.empty((0, 2), dtype=np.float64)
+        return cls(kind, outlook_day, date, time, products, vertices, ring_offsets, np.asarray(codes, dtype=np.int16)[order])
+
+    def layer(self, product):
+        """
+        Returns the HazardLayer of a product.
+
+        Raises
+        ------
+        ValueError
+            - If the outlook has no data for the product.
+        """
+        if product not in self.products:
+            raise ValueError(f"No {product} data found in the outlook")
+        product_codes = [LEVEL_CODES[level] for level in PRODUCT_LEVELS[product] + ((SIGNIFICANT_LEVELS[product], ) if product in SIGNIFICANT_LEVELS else ())]
+        start, stop = np.searchsorted(self.ring_levels, [min(product_codes), max(product_codes) + 1])
+        vertex_start, vertex_stop = self.ring_offsets[start], self.ring_offsets[stop]
+        return HazardLayer(product, self.vertices[vertex_start:vertex_stop], self.ring_offsets[start:stop + 1] - vertex_start, self.ring_levels[start:stop])
+
+    def save(self, path):
+        """ Saves the outlook to a directory: one .npy file per array and its issuance in outlook.json. """
+        os.makedirs(path, exist_ok=True)
+        for name in ('vertices', 'ring_offsets', 'ring_levels'):
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        metadata = dict(version=OUTLOOK_FORMAT_VERSION, kind=self.kind, outlook_day=self.outlook_day, date=None if self.date is None else self.date.isoformat(),
+                        time=self.time, products=list(self.products), levels=list(LEVELS))
+        with open(os.path.join(path, 'outlook.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Loads an outlook saved with Outlook.save.
+
+        Parameters
+        ----------
+        path: str
+        mmap_mode: str or None
+            Passed to np.load, e.g. 'r' to memory-map the arrays instead of reading them.
+
+        Raises
+        ------
+        ValueError
+            - If the outlook was saved with other levels or by an incompatible version.
+        """
+        with open(os.path.join(path, 'outlook.json'), 'r') as f:
+            metadata = json.load(f)
+        if metadata['version'] != OUTLOOK_FORMAT_VERSION or tuple(metadata['levels']) != LEVELS:
+            raise ValueError(f'{path} was saved by an incompatible version')
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in ('vertices', 'ring_offsets', 'ring_levels')}
+        date = None if metadata['date'] is None else datetime.date.fromisoformat(metadata['date'])
+        return cls(metadata['kind'], metadata['outlook_day'], date, metadata['time'], tuple(metadata['products']), **arrays)
+
+    def __repr__(self):
+        issuance = '' if self.date is None else f" day{self.outlook_day} {self.date:%Y-%m-%d}" + ('' if self.time is None else ' %04d UTC' % self.time)
+        return f"Outlook({self.kind}{issuance}: {', '.join(self.products)}; {len(self.ring_levels)} rings, {len(self.vertices)} vertices)"
+
+
+def load_outlook(kind, outlook_day, year, month, day, time, outlook_kmz_dir):
+    """
+    Downloads an SPC outlook if it is not already in 'outlook_kmz_dir', then returns it as an Outlook.
+
+    Parameters
+    ----------
+    kind: str
+        'convective' or 'fire'.
+    outlook_day, year, month, day, time, outlook_kmz_dir:
+        See load_convective_outlook.
+
+    Returns
+    -------
+    outlook: Outlook
+    """
+    load = load_fire_outlook if kind == 'fire' else load_convective_outlook
+    folders = load(outlook_day, year, month, day, time, outlook_kmz_dir)
+    return Outlook.from_folders(folders, kind, outlook_day, datetime.date(year, month, day), time)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import instrument
+import kml
+import settings
+
+CACHE_FORMAT_VERSION = 1
+
+
+def _encode(folders):
+    """
+    Packs parsed KML folders into flat arrays.
+
+    Every ring's vertices are concatenated into one float64 array. Offset arrays map folders to placemarks, placemarks
+    to rings and rings to vertices, so the geometry of the whole outlook is stored in a handful of contiguous buffers.
+    Names and SimpleData values are kept in a small JSON header.
+    """
+    rings = [ring for folder in folders for placemark in folder.placemarks for ring in placemark.rings]
+
+    folder_offsets = np.cumsum([0] + [len(folder.placemarks) for folder in folders], dtype=np.int64)
+    placemark_offsets = np.cumsum([0] + [len(placemark.rings) for folder in folders for placemark in folder.placemarks], dtype=np.int64)
+    vertex_offsets = np.cumsum([0] + [ring.size for ring in rings], dtype=np.int64)
+    ring_ncols = np.array([ring.shape[1] for ring in rings], dtype=np.int8)
+    vertices = np.concatenate([ring.ravel() for ring in rings]) if rings else np.empty(0, dtype=np.float64)
+
+    header = {'version': CACHE_FORMAT_VERSION,
+              'folders': [folder.name for folder in folders],
+              'placemarks': [[placemark.name, list(placemark.simpledata.items())] for folder in folders for placemark in folder.placemarks]}
+
+    return dict(header=np.array(json.dumps(header)), folder_offsets=folder_offsets, placemark_offsets=placemark_offsets,
+                vertex_offsets=vertex_offsets, ring_ncols=ring_ncols, vertices=vertices)
+
+
+def _decode(arrays):
+    """ Rebuilds the list of kml.Folder records from the arrays written by _encode. """
+    header = json.loads(str(arrays['header']))
+    folder_offsets = arrays['folder_offsets']
+    placemark_offsets = arrays['placemark_offsets']
+    vertex_offsets = arrays['vertex_offsets']
+    ring_ncols = arrays['ring_ncols']
+    vertices = arrays['vertices']
+
+    rings = [vertices[vertex_offsets[r]:vertex_offsets[r + 1]].reshape(-1, ring_ncols[r]) for r in range(len(ring_ncols))]
+    placemarks = [kml.Placemark(name, dict(simpledata), rings[placemark_offsets[p]:placemark_offsets[p + 1]])
+                  for p, (name, simpledata) in enumerate(header['placemarks'])]
+    return [kml.Folder(name, placemarks[folder_offsets[f]:folder_offsets[f + 1]]) for f, name in enumerate(header['folders'])]
+
+
+class ParsedOutlookCache:
+    def __init__(self, cache_dir, max_bytes=settings.parsed_outlook_cache_max_bytes):
+        """
+        cache_dir: str
+            Directory where the parsed outlooks are stored. It is created if it does not exist.
+        max_bytes: int or None
+            Maximum total size of the cache. The least recently used entries are removed once it is exceeded.
+            If None, the cache is not size-bounded.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, kmz_path, kml_name=None):
+        """ Returns the cache key for a KMZ file, a hash of its contents and the name of the KML member. """
+        digest = hashlib.sha1(f'{CACHE_FORMAT_VERSION}:{kml_name}:'.encode())
+        with open(kmz_path, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, kmz_path, kml_name=None, key=None):
+        """
+        Returns the cached list of kml.Folder records for a KMZ file, or None if it has not been cached. 'key' is the
+        file's cache key if it was already computed (see key).
+        """
+        entry = self._entry_path(self.key(kmz_path, kml_name) if key is None else key)
+        try:
+            with np.load(entry, allow_pickle=False) as arrays:
+                folders = _decode(arrays)
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(entry)  # Mark the entry as recently used
+        except OSError:  # Evicted by another process since it was read
+            pass
+        return folders
+
+    def put(self, kmz_path, folders, kml_name=None, key=None):
+        """ Stores the parsed folders of a KMZ file, then evicts old entries if the cache is over its size limit. 'key' is as in get. """
+        entry = self._entry_path(self.key(kmz_path, kml_name) if key is None else key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **_encode(folders))
+            os.replace(tmp_path, entry)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def read_kmz(self, kmz_path, kml_name=None):
+        """ Returns the parsed folders of a KMZ file, parsing and caching it only if there is no cached copy. """
+        with instrument.stage('cache_read'):
+            key = self.key(kmz_path, kml_name)  # Hashing the whole file once, for both the lookup and the store
+            folders = self.get(kmz_path, kml_name, key)
+        if folders is None:
+            with instrument.stage('parse'):  # Reading the KML out of the zip archive is streamed into the parser
+                folders = kml.read_kmz(kmz_path, kml_name)
+            self.put(kmz_path, folders, kml_name, key)
+        return folders
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits within max_bytes. """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def read_kmz(kmz_path, kml_name=None, cache_dir=None):
+    """
+    Returns the parsed folders of a KMZ file through the parsed outlook cache.
+
+    Parameters
+    ----------
+    kmz_path: str
+        Path to the KMZ file.
+    kml_name: str or None
+        Name of the KML member inside the archive.
+    cache_dir: str or None
+        Cache directory. If None, the 'settings.parsed_outlook_cache_dir' subdirectory of the folder holding the KMZ file is used.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(kmz_path)), settings.parsed_outlook_cache_dir)
+    return ParsedOutlookCache(cache_dir).read_kmz(kmz_path, kml_name)
@@ -1,14 +1,19 @@
-from zipfile import ZipFile
+import datetime
 import numpy as np
-from lxml import html
 import cartopy.crs as ccrs
-import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-import requests
-import os.path
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+import basemap
+import fingerprint
+import instrument
+import outlook
+import regions
+import render
+import simplify
 import utils
 import settings
+from outlook import Outlook, convective_outlook_filename, fire_outlook_filename, load_convective_outlook, load_fire_outlook  # Loaders used to live here
 
 
 def plot_background(extent, ax=None, linewidth=0.4):
@@ -31,15 +36,135 @@ def plot_background(extent, ax=None, linewidth=0.4):
         crs = ccrs.Miller(central_longitude=250)
         ax = plt.axes(projection=crs)
     else:
-        ax.add_feature(cfeature.COASTLINE.with_scale('50m'), linewidth=linewidth, zorder=9, alpha=0.15)
-        ax.add_feature(cfeature.BORDERS, linewidth=linewidth, zorder=9, alpha=0.15)
-        ax.add_feature(cfeature.STATES, linewidth=linewidth, zorder=9, alpha=0.15)
-        ax.set_extent(extent, crs=ccrs.PlateCarree())
+        with instrument.stage('background'):
+            basemap.add_basemap(ax, extent, linewidth=linewidth)  # Projected coastlines, borders and states are cached between plots
     return ax
 
 
+def _clip_reports(reports, extent):
+    """ Returns the storm reports inside a map extent. """
+    return reports[regions.points_in_extent(reports['Lon'].values, reports['Lat'].values, extent)]
+
+
+def _reused_images(folders, product, image_base, title_text, profiles, extent, reports=(), **options):
+    """
+    Returns the render fingerprint of a map (see fingerprint.render_fingerprint) and, if a previous issuance already drew
+    the same map, the paths of its reused images. The fingerprint is None when render deduplication is disabled, and the
+    paths are None when the map has to be drawn.
+    """
+    if settings.render_dedupe is None:
+        return None, None
+    with instrument.stage('dedupe'):
+        map_fingerprint = fingerprint.render_fingerprint(folders, product, profiles, extent, [_clip_reports(frame, extent) for frame in reports], **options)
+    return map_fingerprint, fingerprint.reuse_images(map_fingerprint, image_base, product, profiles, title_text)
+
+
+def _as_outlook(folders, kind, outlook_day, year, month, day, time, outlook_kmz_dir):
+    """ Returns the Outlook of parsed folders, or downloads (if needed) and parses it if 'folders' is None. Outlooks are returned as they are. """
+    if isinstance(folders, Outlook):
+        return folders
+    if folders is None:
+        load = load_fire_outlook if kind == 'fire' else load_convective_outlook
+        folders = load(outlook_day, year, month, day, time, outlook_kmz_dir)
+    return Outlook.from_folders(folders, kind, outlook_day, datetime.date(year, month, day), time)
+
+
+def _hazard_level_rings(layer, levels=None):
+    """
+    Returns the rings of the levels of a HazardLayer for _level_layers, keyed by zorder: each level is drawn above the
+    lower ones. 'levels' defaults to all the levels of the layer's product. Levels without rings are left out.
+    """
+    level_rings = dict({})
+    for zorder, level in enumerate(layer.levels):
+        rings = layer.rings(level)
+        if (levels is None or level in levels) and len(rings) > 0:
+            level_rings[zorder] = (settings.colors[level], rings)
+    return level_rings
+
+
+def _scatter_reports(lons, lats, mask=None, **kwargs):
+    """
+    Plots a class of storm reports as a single PathCollection.
+
+    Parameters
+    ----------
+    lons, lats: np.ndarray
+        Longitudes and latitudes of all reports of one hazard.
+    mask: np.ndarray of bools or None
+        Reports to plot. If None, all reports are plotted.
+    **kwargs
+        Marker styling passed to plt.scatter.
+    """
+    if mask is not None:
+        lons, lats = lons[mask], lats[mask]
+    if len(lons) > 0:
+        with instrument.stage('reports'):
+            plt.scatter(lons, lats, linewidth=0.2, transform=ccrs.PlateCarree(), **kwargs)
+
+
+def _lod_tolerance(ax, product, profiles, extent):
+    """
+    Returns the largest outline displacement that is invisible in any of a product's images, in map projection units.
+
+    The tolerance is settings.lod_tolerance_pixels pixels at the highest dpi among the render profiles that will be saved,
+    or None if simplification is disabled.
+    """
+    if settings.lod_tolerance_pixels is None:
+        return None
+    dpi = max(profile['dpi'] for profile in render.product_profiles(product, profiles).values())
+    corners = ax.projection.transform_points(ccrs.PlateCarree(), np.array([extent[0], extent[1], extent[0], extent[1], (extent[0] + extent[1]) / 2]),
+                                             np.array([extent[2], extent[2], extent[3], extent[3], extent[3]]))
+    width, height = np.ptp(corners[:, 0]), np.ptp(corners[:, 1])
+    width_inches, height_inches = ax.figure.get_size_inches() * ax.get_position().size
+    return settings.lod_tolerance_pixels * max(width / (width_inches * dpi), height / (height_inches * dpi))
+
+
+def _level_layers(level_rings, **kwargs):
+    """ Returns one layer per risk level for _add_layers. 'level_rings' maps each zorder to the level's colors and rings. """
+    return [(rings, dict(facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], zorder=zorder, **kwargs))
+            for zorder, (polygon_colors, rings) in level_rings.items()]
+
+
+def _add_layers(ax, layers, tolerance=None, extent=None):
+    """
+    Projects the rings of several layers into the map projection in one vectorized transform, simplifies them together
+    and draws each layer as a single PathCollection.
+
+    Parameters
+    ----------
+    ax: cartopy.mpl.geoaxes.GeoAxes
+        Axis on which the polygons will be drawn.
+    layers: list of (list of np.ndarray, dict) tuples
+        Rings of (lon, lat) coordinates of each layer and the styling passed to its PathCollection.
+    tolerance: float or None
+        Simplification tolerance in projection units (see simplify.simplify_rings). If None, the rings are drawn as they are.
+    extent: iterable with 4 floats or None
+        Extent of the map. Rings are clipped to it (see regions.clip_rings) before being projected. If None, rings are not clipped.
+    """
+    with instrument.stage('polygons'):  # Clipping, projection, simplification and PathCollections
+        if extent is not None:
+            layers = [(regions.clip_rings(layer_rings, extent), style) for layer_rings, style in layers]
+        rings = [ring for layer_rings, _ in layers for ring in layer_rings]
+        if len(rings) == 0:
+            return
+        vertices = np.concatenate([ring[:, :2] for ring in rings])
+        projected = ax.projection.transform_points(ccrs.PlateCarree(), vertices[:, 0], vertices[:, 1])[:, :2]
+        projected_rings = np.split(projected, np.cumsum([len(ring) for ring in rings])[:-1])
+
+        projected_layers = []
+        for layer_rings, _ in layers:
+            projected_layers.append(projected_rings[:len(layer_rings)])
+            projected_rings = projected_rings[len(layer_rings):]
+
+        for layer_rings, (_, style) in zip(simplify.simplify_rings(projected_layers, tolerance), layers):
+            if len(layer_rings) > 0:
+                paths = [Path(np.vstack([xy, xy[:1]]), closed=True) for xy in layer_rings]
+                ax.add_collection(PathCollection(paths, **style), autolim=False)
+
+
+@instrument.render('cat')
 def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=False, filtered_reports=False,
-    remove_unknowns=False):
+    remove_unknowns=False, folders=None, storm_reports=None, profiles=None, region=None):
     """
     Plots and saves an SPC categorical convective outlook
 
@@ -61,6 +186,20 @@ def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_
         Directory where the images will be stored.
     include_reports: bool
         Include storm reports on top of the outlook.
+    folders: list of kml.Folder, outlook.Outlook, or None
+        Already parsed outlook. If None, the outlook is downloaded (if needed) and parsed.
+    storm_reports: utils.StormReports or None
+        Storm reports shared with other products. If None, the reports are loaded for this plot only.
+    profiles: iterable of str or None
+        Render profiles (settings.render_profiles) to save. If None, settings.product_render_profiles['cat'] is used.
+    region: str, iterable with 4 floats, or None
+        Name of a region in settings.regions, or extent of the map ([min lon, max lon, min lat, max lat]). Polygons and
+        reports are clipped to it. If None, the whole CONUS is drawn. See regions.resolve_region for the image names.
+
+    Returns
+    -------
+    paths: list of str
+        Paths of the saved images.
 
     Raises
     ------
@@ -70,72 +209,38 @@ def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_
 
     if 0 < outlook_day < 4:
         valid_times = settings.valid_convective_outlook_times[outlook_day - 1]
-        timestring = '_%04d' % time
         if time not in valid_times:
             valid_times = [str(x) for x in valid_times]
             raise ValueError(f"Day {outlook_day} convective outlooks are not released at %04d UTC. Valid times for day 1 "
                              f"convective outlooks: {', '.join(valid_times)}." % time)
-    else:
-        timestring = ''
 
-    local_filename = f'day{outlook_day}otlk_{year}%02d%02d{timestring}.kmz' % (month, day)
-    full_path = f'{outlook_kmz_dir}/{local_filename}'
+    hazard_outlook = _as_outlook(folders, 'convective', outlook_day, year, month, day, time, outlook_kmz_dir)
+    extent, region_suffix = regions.resolve_region(region)
 
-    if not os.path.isfile(full_path):
-        link = f'https://www.spc.noaa.gov/products/outlook/archive/{year}/day{outlook_day}otlk_{year}%02d%02d{timestring}.kmz' % (month, day)
-        outlook_file = requests.get(link)
-
-        if outlook_file.status_code != 200:
-            raise FileNotFoundError(f'{link} not found')
-        with open(full_path, 'wb') as f:
-            f.write(outlook_file.content)
+    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook' % (month, day, time)
 
-    kmz = ZipFile(full_path, 'r')
-    kml = kmz.open(local_filename.replace('kmz', 'kml'), 'r').read()
+    if time is not None:
+        outlook_plot_file = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_cat{region_suffix}' % (month, day, time)
+    else:
+        outlook_plot_file = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_cat{region_suffix}' % (month, day)
 
-    doc = html.fromstring(kml)
+    reports = []
+    if include_reports:
+        if storm_reports is None:
+            storm_reports = utils.StormReports(year, month, day)
+        reports = [storm_reports.load_tornado_reports(filtered=filtered_reports), storm_reports.load_hail_reports(filtered=filtered_reports),
+                   storm_reports.load_wind_reports(filtered=filtered_reports)]
+    map_fingerprint, paths = _reused_images(hazard_outlook, 'cat', outlook_plot_file, title_text, profiles, extent, reports, include_reports=include_reports,
+                                            filtered_reports=filtered_reports, remove_unknowns=remove_unknowns)
+    if paths is not None:
+        return paths
 
     crs = ccrs.Miller(central_longitude=250)
     fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
     handles, labels = plt.gca().get_legend_handles_labels()
 
-    pm = doc.cssselect('Folder')[0].cssselect('Placemark')  # Index 0 of the folders contains the categorical outlook data
-
-    for i in range(len(pm)):
-
-        extendeddata = pm[i].cssselect('extendeddata')[0].text_content()
-        simpledata = pm[i].cssselect('simpledata')[0].text_content()
-        coord_sets = pm[i].cssselect('coordinates')
-
-        if 'General Thunder' in extendeddata or 'Marginal Risk' in extendeddata or 'Slight Risk' in extendeddata or 'Enhanced Risk' in extendeddata \
-                or 'Moderate Risk' in extendeddata or 'High Risk' in extendeddata:
-
-            if 'General Thunder' in extendeddata:
-                zorder = 0
-                polygon_colors = settings.colors['TSTM']
-            elif 'Marginal Risk' in extendeddata:
-                zorder = 1
-                polygon_colors = settings.colors['MRGL']
-            elif 'Slight Risk' in extendeddata:
-                zorder = 2
-                polygon_colors = settings.colors['SLGT']
-            elif 'Enhanced Risk' in extendeddata:
-                zorder = 3
-                polygon_colors = settings.colors['ENH']
-            elif 'Moderate Risk' in extendeddata:
-                zorder = 4
-                polygon_colors = settings.colors['MDT']
-            else:
-                zorder = 5
-                polygon_colors = settings.colors['HIGH']
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.5, zorder=zorder, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
+    level_rings = _hazard_level_rings(hazard_outlook.layer('cat'))  # Rings of each risk level, keyed by zorder
+    _add_layers(ax, _level_layers(level_rings, linewidth=0.5), _lod_tolerance(ax, 'cat', profiles, extent), extent)
 
     # Add polygons + labels to the legend
     handles.extend([utils.poly_TSTM]), labels.extend(['TSTM'])
@@ -145,57 +250,41 @@ def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_
     handles.extend([utils.poly_MDT]), labels.extend(['MDT (4/5)'])
     handles.extend([utils.poly_HIGH]), labels.extend(['HIGH (5/5)'])
 
-    plot_background([233, 295, 20, 50], ax=ax)  # Plot background on main subplot containing fronts and probabilities
+    plot_background(extent, ax=ax)  # Plot background on main subplot containing fronts and probabilities
 
     if include_reports:
 
-        storm_reports = utils.StormReports(year, month, day)
-        tornado_reports = storm_reports.load_tornado_reports(filtered=filtered_reports)[['Lat', 'Lon']].values
-        hail_reports = storm_reports.load_hail_reports(filtered=filtered_reports)[['Size', 'Lat', 'Lon']]
-        wind_reports = storm_reports.load_wind_reports(filtered=filtered_reports)[['Speed', 'Lat', 'Lon']]
+        tornado_reports = _clip_reports(reports[0], extent)[['Lat', 'Lon']].values
+        hail_reports = _clip_reports(reports[1], extent)[['Size', 'Lat', 'Lon']]
+        wind_reports = _clip_reports(reports[2], extent)[['Speed', 'Lat', 'Lon']]
 
-        marker = 'o'
-        facecolor = 'red'
-        edgecolor = 'black'
-        num_tornado_reports = 0
-        for report in tornado_reports:
-            plt.scatter(report[1], report[0], s=3, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=15)
-            num_tornado_reports += 1
+        num_tornado_reports = len(tornado_reports)
+        _scatter_reports(tornado_reports[:, 1], tornado_reports[:, 0], s=3, marker='o', edgecolor='black', facecolor='red', zorder=15)
 
         if remove_unknowns:
-            wind_reports = wind_reports[wind_reports['Speed'] != 'UNK']
+            wind_reports = wind_reports.dropna(subset=['Speed'])
+        else:
+            wind_reports = wind_reports.fillna({'Speed': 58})
+
+        wind_speeds = np.array(wind_reports['Speed'].values, dtype=int)
+        wind_lats, wind_lons = wind_reports['Lat'].values, wind_reports['Lon'].values
+        try:
+            max_wind = int(np.max(wind_speeds))
+        except ValueError:  # No wind reports in the map
+            max_wind = 'N/A'
+            is_maxwind = np.zeros(0, dtype=bool)
         else:
-            wind_reports = wind_reports.replace(to_replace={'UNK': '58'})
-
-        wind_reports['Speed'] = np.array(wind_reports['Speed'].values, dtype=int)
-        wind_reports_values = wind_reports.values
-        num_wind_reports = 0
-        num_sigwind_reports = 0
-        max_wind = int(np.max(wind_reports_values))
-        for report in wind_reports_values:
-            if report[0] == max_wind:
-                marker = '*'
-                facecolor = 'blue'
-                edgecolor = 'black'
-                if report[0] > 74:
-                    num_sigwind_reports += 1
-                zorder = 13
-                s = 10
-            elif report[0] > 74:
-                marker = 's'
-                facecolor = 'black'
-                edgecolor = 'gray'
-                num_sigwind_reports += 1
-                zorder = 12
-                s = 4
-            else:
-                marker = 'o'
-                facecolor = 'blue'
-                edgecolor = 'black'
-                num_wind_reports += 1
-                zorder = 11
-                s = 3
-            plt.scatter(report[2], report[1], s=s, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=zorder)
+            is_maxwind = wind_speeds == max_wind
+
+        # The highest wind report is only counted if it is also a significant wind report
+        is_sigwind = ~is_maxwind & (wind_speeds > 74)
+        is_wind = ~is_maxwind & (wind_speeds <= 74)
+        num_wind_reports = int(np.sum(is_wind))
+        num_sigwind_reports = int(np.sum(wind_speeds > 74))
+
+        _scatter_reports(wind_lons, wind_lats, is_wind, s=3, marker='o', edgecolor='black', facecolor='blue', zorder=11)
+        _scatter_reports(wind_lons, wind_lats, is_sigwind, s=4, marker='s', edgecolor='gray', facecolor='black', zorder=12)
+        _scatter_reports(wind_lons, wind_lats, is_maxwind, s=10, marker='*', edgecolor='black', facecolor='blue', zorder=13)
 
         wind_report_label = f'Wind ({num_wind_reports})'
         if remove_unknowns:
@@ -208,41 +297,26 @@ def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_
         if remove_unknowns:
             plt.text(-16, 19.5, '* wind reports only include measured or estimated winds (no UNK reports)', fontdict={'fontsize': 4})
 
-        hail_reports['Size'] = np.array(hail_reports['Size'].values, dtype=int)
-        hail_reports = hail_reports.values
+        hail_sizes = np.array(hail_reports['Size'].values, dtype=int)
+        hail_lats, hail_lons = hail_reports['Lat'].values, hail_reports['Lon'].values
         num_hail_reports = 0
         num_sighail_reports = 0
         try:
-            max_hail = np.round(np.max(hail_reports, axis=0)[0]/100, 2)
+            max_hail = np.round(np.max(hail_sizes)/100, 2)
         except ValueError:
             max_hail = 'N/A'
             pass
         else:
-            for report in hail_reports:
-                if report[0]/100 == max_hail:
-                    marker = '*'
-                    facecolor = 'green'
-                    edgecolor = 'black'
-                    if report[0] >= 200:
-                        num_sighail_reports += 1
-                    zorder = 13
-                    size = 10
-                elif report[0] >= 200:
-                    marker = '^'
-                    facecolor = 'black'
-                    edgecolor = 'gray'
-                    num_sighail_reports += 1
-                    zorder = 12
-                    size = 4
-                else:
-                    marker = 'o'
-                    facecolor = 'green'
-                    edgecolor = 'black'
-                    num_hail_reports += 1
-                    zorder = 11
-                    size = 3
-
-                plt.scatter(report[2], report[1], s=size, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=zorder)
+            # The largest hail report is only counted if it is also a significant hail report
+            is_maxhail = hail_sizes/100 == max_hail
+            is_sighail = ~is_maxhail & (hail_sizes >= 200)
+            is_hail = ~is_maxhail & (hail_sizes < 200)
+            num_hail_reports = int(np.sum(is_hail))
+            num_sighail_reports = int(np.sum(hail_sizes >= 200))
+
+            _scatter_reports(hail_lons, hail_lats, is_hail, s=3, marker='o', edgecolor='black', facecolor='green', zorder=11)
+            _scatter_reports(hail_lons, hail_lats, is_sighail, s=4, marker='^', edgecolor='gray', facecolor='black', zorder=12)
+            _scatter_reports(hail_lons, hail_lats, is_maxhail, s=10, marker='*', edgecolor='black', facecolor='green', zorder=13)
 
         report_HAIL = plt.scatter(0, 0, s=8, marker='o', edgecolor='black', linewidth=0.2, facecolor='green', transform=ccrs.PlateCarree(), label=f'Hail ({num_hail_reports})')
         report_SIGHAIL = plt.scatter(0, 0, s=10, marker='^', edgecolor='gray', linewidth=0.2, facecolor='black', transform=ccrs.PlateCarree(), label=f'Sig. Hail ({num_sighail_reports})')
@@ -266,114 +340,49 @@ def categorical_convective_outlook(outlook_day, year, month, day, time, outlook_
     plt.legend(handles=handles, labels=labels, loc='lower right', ncol=3, fontsize=5, framealpha=1, title='Categorical risk', title_fontsize=7).set_zorder(10)
     ####################################################################################################################
 
-    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook' % (month, day, time)
-
-    if time is not None:
-        outlook_plot_file = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_cat.png' % (month, day, time)
-    else:
-        outlook_plot_file = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_cat.png' % (month, day)
-
     plt.title(title_text)
-    plt.savefig(outlook_plot_file, bbox_inches='tight', dpi=1000)
-    plt.close()
-
+    return fingerprint.save_figure(map_fingerprint, outlook_plot_file, 'cat', profiles)
 
-def tornado_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=True):
 
-    local_filename = f'day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-    full_path = f'{outlook_kmz_dir}/{local_filename}'
+@instrument.render('torn')
+def tornado_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=True, folders=None, storm_reports=None, profiles=None, region=None):
 
-    if not os.path.isfile(full_path):
-        link = f'https://www.spc.noaa.gov/products/outlook/archive/{year}/day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-        outlook_file = requests.get(link)
+    hazard_outlook = _as_outlook(folders, 'convective', outlook_day, year, month, day, time, outlook_kmz_dir)
+    extent, region_suffix = regions.resolve_region(region)
 
-        if outlook_file.status_code != 200:
-            raise FileNotFoundError(f'{link} not found')
-        with open(full_path, 'wb') as f:
-            f.write(outlook_file.content)
-
-    kmz = ZipFile(full_path, 'r')
-    kml = kmz.open(local_filename.replace('kmz', 'kml'), 'r').read()
+    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Tornado' % (month, day, time)
+    image_base = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_torn{region_suffix}' % (month, day, time)
 
-    doc = html.fromstring(kml)
+    reports = []
+    if include_reports:
+        if storm_reports is None:
+            storm_reports = utils.StormReports(year, month, day)
+        reports = [storm_reports.load_tornado_reports(filtered=False)]
+    map_fingerprint, paths = _reused_images(hazard_outlook, 'torn', image_base, title_text, profiles, extent, reports, include_reports=include_reports)
+    if paths is not None:
+        return paths
 
     crs = ccrs.Miller(central_longitude=250)
     fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
     handles, labels = plt.gca().get_legend_handles_labels()
 
-    folders = doc.cssselect('Folder')
-
-    pm, pm_sig = None, None
-    for folder in folders:
-        if '_torn' in folder.cssselect('name')[0].text_content():
-            pm = folder.cssselect('Placemark')
-        if '_sigtorn' in folder.cssselect('name')[0].text_content():
-            pm_sig = folder.cssselect('Placemark')
-
-    if pm is None:
-        raise ValueError(f"No tornado data found in {local_filename}")
-
-    for i in range(len(pm)):
-        name = pm[i].cssselect('name')[0].text_content()
-        simpledata = pm[i].cssselect('simpledata')[0].text_content()
-        coord_sets = pm[i].cssselect('coordinates')
-
-        if name == '2 %':
-            zorder = 0
-            polygon_colors = settings.colors['TOR2']
-        elif name == '5 %':
-            zorder = 1
-            polygon_colors = settings.colors['TOR5']
-        elif name == '10 %':
-            zorder = 2
-            polygon_colors = settings.colors['TOR10']
-        elif name == '15 %':
-            zorder = 3
-            polygon_colors = settings.colors['TOR15']
-        elif name == '30 %':
-            zorder = 4
-            polygon_colors = settings.colors['TOR30']
-        elif name == '45 %':
-            zorder = 5
-            polygon_colors = settings.colors['TOR45']
-        else:
-            zorder = 6
-            polygon_colors = settings.colors['TOR60']
-
-        for coord_set in coord_sets:
-            coord_pairs = coord_set.text_content().split(' ')
-            for coord_pair in range(len(coord_pairs)):
-                coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-            coordinates = np.array(coord_pairs, dtype=float)
-            poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.5, zorder=zorder, transform=ccrs.PlateCarree())
-            ax.add_patch(poly)
-
-    if len(pm_sig) > 0:
-        for j in range(len(pm_sig)):
-            coord_sets = pm_sig[j].cssselect('coordinates')
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    plot_background([233, 295, 20, 50], ax=ax)  # Plot background on main subplot containing fronts and probabilities
-
-    marker = 'o'
-    facecolor = 'red'
-    edgecolor = 'black'
+    if 'torn' not in hazard_outlook.products:
+        raise ValueError(f"No tornado data found in {convective_outlook_filename(outlook_day, year, month, day, time)}")
+    layer = hazard_outlook.layer('torn')
+
+    level_rings = _hazard_level_rings(layer)  # Rings of each risk level, keyed by zorder
+    sig_rings = layer.rings(outlook.SIGNIFICANT_LEVELS['torn'])
+    layers = _level_layers(level_rings, linewidth=0.5)
+    layers.append((sig_rings, dict(facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7)))
+    _add_layers(ax, layers, _lod_tolerance(ax, 'torn', profiles, extent), extent)
+
+    plot_background(extent, ax=ax)  # Plot background on main subplot containing fronts and probabilities
 
     if include_reports:
-        num_tornado_reports = 0
-        storm_reports = utils.StormReports(year, month, day)
-        tornado_reports = storm_reports.load_tornado_reports(filtered=False)[['Lat', 'Lon']].values
+        tornado_reports = _clip_reports(reports[0], extent)[['Lat', 'Lon']].values
 
-        for report in tornado_reports:
-            num_tornado_reports += 1
-            plt.scatter(report[1], report[0], s=3, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=11)
+        num_tornado_reports = len(tornado_reports)
+        _scatter_reports(tornado_reports[:, 1], tornado_reports[:, 0], s=3, marker='o', edgecolor='black', facecolor='red', zorder=11)
 
         report_TOR = plt.scatter(0, 0, s=8, marker='o', edgecolor='black', linewidth=0.2, facecolor='red', transform=ccrs.PlateCarree(), label=f'Tornado reports ({num_tornado_reports})')
 
@@ -393,132 +402,74 @@ def tornado_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_
     plt.legend(handles=handles, labels=labels, loc='lower right', ncol=4, fontsize=5, framealpha=1, title='Probability of a tornado within 25 miles of a point', title_fontsize=6).set_zorder(10)
     ####################################################################################################################
 
-    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Tornado' % (month, day, time)
-
     plt.title(title_text)
-    plt.savefig(f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_torn.png' % (month, day, time), bbox_inches='tight', dpi=1000)
-    plt.close()
+    return fingerprint.save_figure(map_fingerprint, image_base, 'torn', profiles)
 
 
+@instrument.render('wind')
 def wind_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=False, remove_unknowns=False,
-    filtered_reports=False):
-
-    local_filename = f'day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-    full_path = f'{outlook_kmz_dir}/{local_filename}'
+    filtered_reports=False, folders=None, storm_reports=None, profiles=None, region=None):
 
-    if not os.path.isfile(full_path):
-        link = f'https://www.spc.noaa.gov/products/outlook/archive/{year}/day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-        outlook_file = requests.get(link)
+    hazard_outlook = _as_outlook(folders, 'convective', outlook_day, year, month, day, time, outlook_kmz_dir)
+    extent, region_suffix = regions.resolve_region(region)
 
-        if outlook_file.status_code != 200:
-            raise FileNotFoundError(f'{link} not found')
-        with open(full_path, 'wb') as f:
-            f.write(outlook_file.content)
-
-    kmz = ZipFile(full_path, 'r')
-    kml = kmz.open(local_filename.replace('kmz', 'kml'), 'r').read()
+    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Wind' % (month, day, time)
+    image_base = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_wind{region_suffix}' % (month, day, time)
 
-    doc = html.fromstring(kml)
+    reports = []
+    if include_reports:
+        if storm_reports is None:
+            storm_reports = utils.StormReports(year, month, day)
+        reports = [storm_reports.load_wind_reports(filtered=filtered_reports)]
+    map_fingerprint, paths = _reused_images(hazard_outlook, 'wind', image_base, title_text, profiles, extent, reports, include_reports=include_reports,
+                                            filtered_reports=filtered_reports, remove_unknowns=remove_unknowns)
+    if paths is not None:
+        return paths
 
     crs = ccrs.Miller(central_longitude=250)
     fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
     handles, labels = plt.gca().get_legend_handles_labels()
 
-    folders = doc.cssselect('Folder')
-    pm_wind = folders[3].cssselect('Placemark')  # Wind placemarks
-    pm_sigwind = folders[4].cssselect('Placemark')  # Sig wind placemarks
-
-    if pm_wind is None:
-        raise ValueError(f"No wind data found in {local_filename}")
+    if 'wind' not in hazard_outlook.products:
+        raise ValueError(f"No wind data found in {convective_outlook_filename(outlook_day, year, month, day, time)}")
+    layer = hazard_outlook.layer('wind')
 
-    for i in range(len(pm_wind)):
-        simpledata = pm_wind[i].cssselect('simpledata')[0].text_content()
-        coord_sets = pm_wind[i].cssselect('coordinates')
+    level_rings = _hazard_level_rings(layer)  # Rings of each risk level, keyed by zorder
+    sig_rings = layer.rings(outlook.SIGNIFICANT_LEVELS['wind'])
+    layers = _level_layers(level_rings, linewidth=0.5)
+    layers.append((sig_rings, dict(facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7)))
+    _add_layers(ax, layers, _lod_tolerance(ax, 'wind', profiles, extent), extent)
 
-        try:
-            name = pm_wind[i].cssselect('name')[0].text_content()
-        except:
-            name = str(simpledata) + ' %'
-
-        if name != '10 %':  # Ignore the significant wind risk area until later
-            if name == '5 %':
-                zorder = 0
-                polygon_colors = settings.colors['WIND5']
-            elif name == '15 %':
-                zorder = 1
-                polygon_colors = settings.colors['WIND15']
-            elif name == '30 %':
-                zorder = 2
-                polygon_colors = settings.colors['WIND30']
-            elif name == '45 %':
-                zorder = 3
-                polygon_colors = settings.colors['WIND45']
-            elif name == '60 %':
-                zorder = 4
-                polygon_colors = settings.colors['WIND60']
-            else:
-                raise ValueError(f"Unkown wind risk category: {name}")
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.5, zorder=zorder, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    if len(pm_sigwind) > 0:
-        for j in range(len(pm_sigwind)):
-            coord_sets = pm_sigwind[j].cssselect('coordinates')
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    plot_background([233, 295, 20, 50], ax=ax)  # Plot background on main subplot containing fronts and probabilities
+    plot_background(extent, ax=ax)  # Plot background on main subplot containing fronts and probabilities
 
     if include_reports:
 
-        storm_reports = utils.StormReports(year, month, day)
-        wind_reports = storm_reports.load_wind_reports(filtered=filtered_reports)[['Speed', 'Lat', 'Lon']]
+        wind_reports = _clip_reports(reports[0], extent)[['Speed', 'Lat', 'Lon']]
 
         if remove_unknowns:
-            wind_reports = wind_reports[wind_reports['Speed'] != 'UNK']
+            wind_reports = wind_reports.dropna(subset=['Speed'])
+        else:
+            wind_reports = wind_reports.fillna({'Speed': 58})
+
+        wind_speeds = np.array(wind_reports['Speed'].values, dtype=int)
+        wind_lats, wind_lons = wind_reports['Lat'].values, wind_reports['Lon'].values
+        try:
+            max_wind = int(np.max(wind_speeds))
+        except ValueError:  # No wind reports in the map
+            max_wind = 'N/A'
+            is_maxwind = np.zeros(0, dtype=bool)
         else:
-            wind_reports = wind_reports.replace(to_replace={'UNK': '58'})
-
-        wind_reports['Speed'] = np.array(wind_reports['Speed'].values, dtype=int)
-        wind_reports_values = wind_reports.values
-        num_wind_reports = 0
-        num_sigwind_reports = 0
-        max_wind = int(np.max(wind_reports_values))
-        for report in wind_reports_values:
-            if report[0] == max_wind:
-                marker = '*'
-                facecolor = 'blue'
-                edgecolor = 'black'
-                num_sigwind_reports += 1
-                zorder = 13
-                s = 10
-            elif report[0] > 74:
-                marker = 's'
-                facecolor = 'black'
-                edgecolor = 'gray'
-                num_sigwind_reports += 1
-                zorder = 12
-                s = 4
-            else:
-                marker = 'o'
-                facecolor = 'blue'
-                edgecolor = 'black'
-                num_wind_reports += 1
-                zorder = 11
-                s = 3
-            plt.scatter(report[2], report[1], s=s, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=zorder)
+            is_maxwind = wind_speeds == max_wind
+
+        # The highest wind report is always counted as a significant wind report
+        is_sigwind = ~is_maxwind & (wind_speeds > 74)
+        is_wind = ~is_maxwind & (wind_speeds <= 74)
+        num_wind_reports = int(np.sum(is_wind))
+        num_sigwind_reports = int(np.sum(is_sigwind | is_maxwind))
+
+        _scatter_reports(wind_lons, wind_lats, is_wind, s=3, marker='o', edgecolor='black', facecolor='blue', zorder=11)
+        _scatter_reports(wind_lons, wind_lats, is_sigwind, s=4, marker='s', edgecolor='gray', facecolor='black', zorder=12)
+        _scatter_reports(wind_lons, wind_lats, is_maxwind, s=10, marker='*', edgecolor='black', facecolor='blue', zorder=13)
 
         report_WIND = plt.scatter(0, 0, s=8, marker='o', edgecolor='black', linewidth=0.2, facecolor='blue', transform=ccrs.PlateCarree(), label=f'Wind ({num_wind_reports})')
         report_SIGWIND = plt.scatter(0, 0, s=10, marker='s', edgecolor='gray', linewidth=0.2, facecolor='black', transform=ccrs.PlateCarree(), label=f'Sig. Wind ({num_sigwind_reports})')
@@ -547,124 +498,64 @@ def wind_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir
     plt.legend(handles=handles, labels=labels, loc='lower right', ncol=3, fontsize=5, framealpha=1, title='Probability of severe winds (≥ 58 mph) within 25 miles of a point', title_fontsize=4.5).set_zorder(10)
     ####################################################################################################################
 
-    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Wind' % (month, day, time)
-
     plt.title(title_text)
-    plt.savefig(f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_wind.png' % (month, day, time), bbox_inches='tight', dpi=1000)
-    plt.close()
+    return fingerprint.save_figure(map_fingerprint, image_base, 'wind', profiles)
 
 
-def hail_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=False):
+@instrument.render('hail')
+def hail_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=False, folders=None, storm_reports=None, profiles=None, region=None):
 
-    local_filename = f'day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-    full_path = f'{outlook_kmz_dir}/{local_filename}'
+    hazard_outlook = _as_outlook(folders, 'convective', outlook_day, year, month, day, time, outlook_kmz_dir)
+    extent, region_suffix = regions.resolve_region(region)
 
-    if not os.path.isfile(full_path):
-        link = f'https://www.spc.noaa.gov/products/outlook/archive/{year}/day{outlook_day}otlk_{year}%02d%02d_%04d.kmz' % (month, day, time)
-        outlook_file = requests.get(link)
-
-        if outlook_file.status_code != 200:
-            raise FileNotFoundError(f'{link} not found')
-        with open(full_path, 'wb') as f:
-            f.write(outlook_file.content)
-
-    kmz = ZipFile(full_path, 'r')
-    kml = kmz.open(local_filename.replace('kmz', 'kml'), 'r').read()
+    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Hail' % (month, day, time)
+    image_base = f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_hail{region_suffix}' % (month, day, time)
 
-    doc = html.fromstring(kml)
+    reports = []
+    if include_reports:
+        if storm_reports is None:
+            storm_reports = utils.StormReports(year, month, day)
+        reports = [storm_reports.load_hail_reports(filtered=False)]
+    map_fingerprint, paths = _reused_images(hazard_outlook, 'hail', image_base, title_text, profiles, extent, reports, include_reports=include_reports)
+    if paths is not None:
+        return paths
 
     crs = ccrs.Miller(central_longitude=250)
     fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
     handles, labels = plt.gca().get_legend_handles_labels()
 
-    folders = doc.cssselect('Folder')
-    pm_hail = folders[5].cssselect('Placemark')  # hail placemarks
-    pm_sighail = folders[6].cssselect('Placemark')  # Sig hail placemarks
+    if 'hail' not in hazard_outlook.products:
+        raise ValueError(f"No hail data found in {convective_outlook_filename(outlook_day, year, month, day, time)}")
+    layer = hazard_outlook.layer('hail')
 
-    if pm_hail is None:
-        raise ValueError(f"No hail data found in {local_filename}")
+    level_rings = _hazard_level_rings(layer)  # Rings of each risk level, keyed by zorder
+    sig_rings = layer.rings(outlook.SIGNIFICANT_LEVELS['hail'])
+    layers = _level_layers(level_rings, linewidth=0.5)
+    layers.append((sig_rings, dict(facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7)))
+    _add_layers(ax, layers, _lod_tolerance(ax, 'hail', profiles, extent), extent)
 
-    for i in range(len(pm_hail)):
-        simpledata = pm_hail[i].cssselect('simpledata')[0].text_content()
-        coord_sets = pm_hail[i].cssselect('coordinates')
-
-        try:
-            name = pm_hail[i].cssselect('name')[0].text_content()
-        except:
-            name = str(simpledata) + ' %'
-
-        if name != '10 %' and name != '0 %':  # Ignore the significant hail polygon until later
-            if name == '5 %':
-                zorder = 0
-                polygon_colors = settings.colors['HAIL5']
-            elif name == '15 %':
-                zorder = 1
-                polygon_colors = settings.colors['HAIL15']
-            elif name == '30 %':
-                zorder = 2
-                polygon_colors = settings.colors['HAIL30']
-            elif name == '45 %':
-                zorder = 3
-                polygon_colors = settings.colors['HAIL45']
-            elif name == '60 %':
-                zorder = 4
-                polygon_colors = settings.colors['HAIL60']
-            else:
-                raise ValueError(f"Unknown hail risk category: {name}")
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.5, zorder=zorder, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    if len(pm_sighail) > 0:
-        for j in range(len(pm_sighail)):
-            coord_sets = pm_sighail[j].cssselect('coordinates')
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5, zorder=7, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    plot_background([233, 295, 20, 50], ax=ax)  # Plot background on main subplot containing fronts and probabilities
+    plot_background(extent, ax=ax)  # Plot background on main subplot containing fronts and probabilities
 
     if include_reports:
-        storm_reports = utils.StormReports(year, month, day)
-        hail_reports = storm_reports.load_hail_reports(filtered=False)[['Size', 'Lat', 'Lon']]
-        hail_reports['Size'] = np.array(hail_reports['Size'].values, dtype=int)
-        hail_reports = hail_reports.values
-        num_hail_reports = 0
-        num_sighail_reports = 0
-        max_hail = np.round(np.max(hail_reports, axis=0)[0]/100, 2)
-        for report in hail_reports:
-            if report[0] < 200:
-                marker = 'o'
-                facecolor = 'green'
-                edgecolor = 'black'
-                num_hail_reports += 1
-                zorder = 11
-                size = 3
-            elif report[0]/100 != max_hail:
-                marker = '^'
-                facecolor = 'black'
-                edgecolor = 'gray'
-                num_sighail_reports += 1
-                zorder = 12
-                size = 4
-            else:
-                marker = '*'
-                facecolor = 'green'
-                edgecolor = 'black'
-                num_sighail_reports += 1
-                zorder = 13
-                size = 10
-            plt.scatter(report[2], report[1], s=size, marker=marker, edgecolor=edgecolor, linewidth=0.2, facecolor=facecolor, transform=ccrs.PlateCarree(), zorder=zorder)
+        hail_reports = _clip_reports(reports[0], extent)[['Size', 'Lat', 'Lon']]
+        hail_sizes = np.array(hail_reports['Size'].values, dtype=int)
+        hail_lats, hail_lons = hail_reports['Lat'].values, hail_reports['Lon'].values
+        is_hail = hail_sizes < 200
+        try:
+            max_hail = np.round(np.max(hail_sizes)/100, 2)
+        except ValueError:  # No hail reports in the map
+            max_hail = 'N/A'
+            is_maxhail = np.zeros(0, dtype=bool)
+        else:
+            # The largest hail report is only highlighted if it is also a significant hail report
+            is_maxhail = ~is_hail & (hail_sizes/100 == max_hail)
+        is_sighail = ~is_hail & ~is_maxhail
+        num_hail_reports = int(np.sum(is_hail))
+        num_sighail_reports = int(np.sum(~is_hail))
+
+        _scatter_reports(hail_lons, hail_lats, is_hail, s=3, marker='o', edgecolor='black', facecolor='green', zorder=11)
+        _scatter_reports(hail_lons, hail_lats, is_sighail, s=4, marker='^', edgecolor='gray', facecolor='black', zorder=12)
+        _scatter_reports(hail_lons, hail_lats, is_maxhail, s=10, marker='*', edgecolor='black', facecolor='green', zorder=13)
         report_HAIL = plt.scatter(0, 0, s=8, marker='o', edgecolor='black', linewidth=0.2, facecolor='green', transform=ccrs.PlateCarree(), label=f'Hail ({num_hail_reports})')
         report_SIGHAIL = plt.scatter(0, 0, s=10, marker='^', edgecolor='gray', linewidth=0.2, facecolor='black', transform=ccrs.PlateCarree(), label=f'Sig. Hail ({num_sighail_reports})')
         report_MAXHAIL = plt.scatter(0, 0, s=14, marker='*', edgecolor='black', linewidth=0.2, facecolor='green', transform=ccrs.PlateCarree(), label=f'Largest hail report ({max_hail}")')
@@ -683,94 +574,32 @@ def hail_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir
     plt.legend(handles=handles, labels=labels, loc='lower right', ncol=3, fontsize=5, framealpha=1, title='Probability of severe hail (≥ 1" diameter) within 25 miles of a point', title_fontsize=4.5).set_zorder(10)
     ####################################################################################################################
 
-    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Convective Outlook: Hail' % (month, day, time)
-
     plt.title(title_text)
-    plt.savefig(f'{image_dir}/day{outlook_day}otlk_{year}%02d%02d_%04d_hail.png' % (month, day, time), bbox_inches='tight', dpi=1000)
-    plt.close()
-
-
-def fire_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir):
-
-    local_filename = '%s%02d%02d_%04d_day%dfirewx.kmz' % (str(year)[2:], month, day, time, outlook_day)
-    full_path = f'{outlook_kmz_dir}/{local_filename}'
+    return fingerprint.save_figure(map_fingerprint, image_base, 'hail', profiles)
 
-    if not os.path.isfile(full_path):
-        link = f'https://www.spc.noaa.gov/products/fire_wx/{year}/%s%02d%02d_%04d_day%dfirewx.kmz' % (str(year)[2:], month, day, time, outlook_day)
-        outlook_file = requests.get(link)
 
-        if outlook_file.status_code != 200:
-            raise FileNotFoundError(f'{link} not found')
-        with open(full_path, 'wb') as f:
-            f.write(outlook_file.content)
+@instrument.render('fire')
+def fire_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, folders=None, profiles=None, region=None):
 
-    kmz = ZipFile(full_path, 'r')
-    kml = kmz.open(local_filename.replace('kmz', 'kml'), 'r').read()
+    hazard_outlook = _as_outlook(folders, 'fire', outlook_day, year, month, day, time, outlook_kmz_dir)
+    extent, region_suffix = regions.resolve_region(region)
 
-    doc = html.fromstring(kml)
+    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Fire Weather Outlook' % (month, day, time)
+    image_base = f'{image_dir}/firewx_day{outlook_day}otlk_{year}%02d%02d_%04d{region_suffix}' % (month, day, time)
+    map_fingerprint, paths = _reused_images(hazard_outlook, 'fire', image_base, title_text, profiles, extent)
+    if paths is not None:
+        return paths
 
     crs = ccrs.Miller(central_longitude=250)
     fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
     handles, labels = plt.gca().get_legend_handles_labels()
 
-    folders = doc.cssselect('Folder')
+    layer = hazard_outlook.layer('fire')
+    layers = _level_layers(_hazard_level_rings(layer, outlook.FIRE_LEVELS), linewidth=0.5)
+    layers += _level_layers(_hazard_level_rings(layer, outlook.DRY_THUNDER_LEVELS), linewidth=0.7, linestyle='--')
+    _add_layers(ax, layers, _lod_tolerance(ax, 'fire', profiles, extent), extent)
 
-    pm, pm_ltg = None, None
-    for folder in folders:
-        if 'dryltg' in folder.cssselect('name')[0].text_content():
-            pm_ltg = folder.cssselect('Placemark')
-        else:
-            pm = folder.cssselect('Placemark')
-
-    if pm is None and pm_ltg is None:
-        raise ValueError(f"No fire data found in {local_filename}")
-
-    if len(pm) > 1:
-        for i in range(len(pm)):
-            name = pm[i].cssselect('name')[0].text_content()
-            simpledata = pm[i].cssselect('simpledata')[0].text_content()
-            coord_sets = pm[i].cssselect('coordinates')
-
-            if 'Elevated' in name:
-                zorder = 0
-                polygon_colors = settings.colors['Elevated']
-            elif 'Critical' in name:
-                zorder = 1
-                polygon_colors = settings.colors['Critical']
-            elif 'Extreme' in name:
-                zorder = 2
-                polygon_colors = settings.colors['Extreme']
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.5, zorder=zorder, transform=ccrs.PlateCarree())
-                ax.add_patch(poly)
-
-    if len(pm_ltg) > 1:
-        for i in range(len(pm_ltg)):
-            name = pm_ltg[i].cssselect('name')[0].text_content()
-            simpledata = pm_ltg[i].cssselect('simpledata')[0].text_content()
-            coord_sets = pm_ltg[i].cssselect('coordinates')
-
-            if 'Isolated' in name:
-                zorder = 3
-                polygon_colors = settings.colors['Iso DryT']
-            elif 'Scattered' in name:
-                zorder = 4
-                polygon_colors = settings.colors['Scattered DryT']
-
-            for coord_set in coord_sets:
-                coord_pairs = coord_set.text_content().split(' ')
-                for coord_pair in range(len(coord_pairs)):
-                    coord_pairs[coord_pair] = coord_pairs[coord_pair].split(',')
-                coordinates = np.array(coord_pairs, dtype=float)
-                poly = Polygon(coordinates, label=simpledata, facecolor=polygon_colors['fill'], edgecolor=polygon_colors['outline'], linewidth=0.7, zorder=zorder, transform=ccrs.PlateCarree(), linestyle='--')
-                ax.add_patch(poly)
-
-    plot_background([233, 295, 20, 50], ax=ax)  # Plot background on main subplot containing fronts and probabilities
+    plot_background(extent, ax=ax)  # Plot background on main subplot containing fronts and probabilities
 
     # Add labels to the legend
     handles.extend([utils.poly_ELEVATED]), labels.extend(['Elevated'])
@@ -782,8 +611,76 @@ def fire_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir
     plt.legend(handles=handles, labels=labels, loc='lower right', ncol=2, fontsize=5, framealpha=1, title='Fire outlook legend', title_fontsize=6).set_zorder(10)
     ####################################################################################################################
 
-    title_text = f'{year}-%02d-%02d %04d UTC Day {outlook_day} Fire Weather Outlook' % (month, day, time)
-
     plt.title(title_text)
-    plt.savefig(f'{image_dir}/firewx_day{outlook_day}otlk_{year}%02d%02d_%04d.png' % (month, day, time), bbox_inches='tight', dpi=1000)
-    plt.close()
+    return fingerprint.save_figure(map_fingerprint, image_base, 'fire', profiles)
+
+
+@instrument.render('convective')
+def render_convective_products(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, products=('cat', 'torn', 'wind', 'hail'),
+    include_reports=False, filtered_reports=False, remove_unknowns=False, profiles=None, region=None, folders=None):
+    """
+    Plots and saves several products from one SPC convective outlook, downloading and parsing the kmz file only once.
+    Storm reports are also loaded once and shared between the products.
+
+    Parameters
+    ----------
+    outlook_day: int
+        Outlook day.
+    year: int
+        YYYY
+    month: int
+        MM
+    day: int
+        DD
+    time: int
+        Time in UTC. HHMM
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    image_dir: str
+        Directory where the images will be stored.
+    products: iterable of str
+        Products to plot: any of 'cat', 'torn', 'wind', 'hail'.
+    include_reports: bool
+        Include storm reports on top of the outlooks.
+    filtered_reports: bool
+        Use filtered storm reports for the categorical and wind outlooks.
+    remove_unknowns: bool
+        Remove wind reports with unknown speeds from the categorical and wind outlooks.
+    profiles: iterable of str or None
+        Render profiles (settings.render_profiles) to save. If None, each product's default profiles are used.
+    region: str, iterable with 4 floats, or None
+        Region or extent of the maps (see categorical_convective_outlook).
+    folders: list of kml.Folder, outlook.Outlook, or None
+        Already parsed outlook. If None, the outlook is downloaded (if needed) and parsed.
+
+    Returns
+    -------
+    paths: list of str
+        Paths of the saved images.
+
+    Raises
+    ------
+    ValueError
+        - If an unknown product is requested.
+    """
+    unknown_products = set(products) - {'cat', 'torn', 'wind', 'hail'}
+    if len(unknown_products) > 0:
+        raise ValueError(f"Unknown convective outlook products: {', '.join(sorted(unknown_products))}")
+
+    hazard_outlook = _as_outlook(folders, 'convective', outlook_day, year, month, day, time, outlook_kmz_dir)
+    storm_reports = utils.StormReports(year, month, day) if include_reports else None
+
+    paths = []
+    if 'cat' in products:
+        paths += categorical_convective_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=include_reports,
+            filtered_reports=filtered_reports, remove_unknowns=remove_unknowns, folders=hazard_outlook, storm_reports=storm_reports, profiles=profiles, region=region)
+    if 'torn' in products:
+        paths += tornado_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=include_reports, folders=hazard_outlook,
+            storm_reports=storm_reports, profiles=profiles, region=region)
+    if 'wind' in products:
+        paths += wind_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=include_reports, remove_unknowns=remove_unknowns,
+            filtered_reports=filtered_reports, folders=hazard_outlook, storm_reports=storm_reports, profiles=profiles, region=region)
+    if 'hail' in products:
+        paths += hail_outlook(outlook_day, year, month, day, time, outlook_kmz_dir, image_dir, include_reports=include_reports, folders=hazard_outlook,
+            storm_reports=storm_reports, profiles=profiles, region=region)
+    return paths
@@ -0,0 +1,231 @@
+"""
+Practically perfect hindcasts: the probabilities a forecaster who knew where every storm report would occur would have drawn.
+
+Each day's reports are gridded onto the 80 km grid (a cell is 1 if it holds at least one report), then smoothed with a
+Gaussian kernel (sigma = settings.practically_perfect_sigma_km, 120 km by default) through an FFT convolution.
+"""
+
+import datetime
+import functools
+import numpy as np
+import cartopy.crs as ccrs
+import matplotlib.pyplot as plt
+import outlook
+import plot_outlooks
+import rasterize
+import render
+import settings
+import utils
+
+HAZARDS = ('torn', 'wind', 'hail')
+HAZARD_NAMES = dict(torn='Tornado', wind='Wind', hail='Hail')
+_REPORT_LOADERS = dict(torn='load_tornado_reports', wind='load_wind_reports', hail='load_hail_reports')
+
+
+def grid_reports(lons, lats, grid):
+    """
+    Marks the grid cells holding at least one report.
+
+    Parameters
+    ----------
+    lons, lats: np.ndarray
+        Report coordinates.
+    grid: rasterize.Grid
+
+    Returns
+    -------
+    binary: np.ndarray of float32
+        (ny, nx) array, 1 in cells with reports and 0 elsewhere. Reports outside the grid are ignored.
+    """
+    binary = np.zeros(grid.shape, dtype=np.float32)
+    if len(lons) == 0:
+        return binary
+    xy = grid.project(lons, lats)
+    dx = grid.spacing * 1000.
+    j = np.round((xy[:, 0] - grid.x[0]) / dx).astype(np.int64)
+    i = np.round((xy[:, 1] - grid.y[0]) / dx).astype(np.int64)
+    on_grid = (i >= 0) & (i < grid.shape[0]) & (j >= 0) & (j < grid.shape[1])
+    binary[i[on_grid], j[on_grid]] = 1
+    return binary
+
+
+@functools.lru_cache(maxsize=4)
+def _kernel_fft(shape, spacing, sigma):
+    """
+    Returns the real FFT of the normalized Gaussian kernel for a grid shape, zero-padded so the convolution does not wrap
+    around the grid edges, along with the padded shape. Computed once per grid and sigma.
+    """
+    radius = int(np.ceil(4 * sigma / spacing))  # The kernel is truncated 4 sigmas away from its center
+    offsets = np.arange(-radius, radius + 1) * spacing
+    kernel = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma ** 2))
+    kernel /= 2 * np.pi * (sigma / spacing) ** 2  # Normalized like the continuous Gaussian, so an isolated report peaks at the usual value
+
+    padded_shape = (shape[0] + 2 * radius, shape[1] + 2 * radius)
+    padded_kernel = np.zeros(padded_shape)
+    padded_kernel[:2 * radius + 1, :2 * radius + 1] = kernel
+    padded_kernel = np.roll(padded_kernel, (-radius, -radius), axis=(0, 1))  # Center the kernel on the origin
+    return np.fft.rfft2(padded_kernel), padded_shape
+
+
+def smooth(binary, grid, sigma=settings.practically_perfect_sigma_km):
+    """
+    Smooths gridded reports with a Gaussian kernel using FFT convolution.
+
+    Parameters
+    ----------
+    binary: np.ndarray
+        (ny, nx) or (num days, ny, nx) array from grid_reports. Stacked days are transformed together.
+    grid: rasterize.Grid
+    sigma: float
+        Standard deviation of the kernel in km.
+
+    Returns
+    -------
+    probabilities: np.ndarray of float32
+        Array of the same shape as 'binary', between 0 and 1.
+    """
+    kernel_fft, padded_shape = _kernel_fft(grid.shape, grid.spacing, sigma)
+    smoothed = np.fft.irfft2(np.fft.rfft2(binary, s=padded_shape) * kernel_fft, s=padded_shape)
+    smoothed = smoothed[..., :grid.shape[0], :grid.shape[1]]
+    return np.clip(smoothed, 0, 1).astype(np.float32)
+
+
+def _report_points(storm_reports, hazard, filtered):
+    reports = getattr(storm_reports, _REPORT_LOADERS[hazard])(filtered=filtered)
+    return reports['Lon'].values, reports['Lat'].values
+
+
+def practically_perfect(year, month, day, hazard, grid=None, filtered=True, storm_reports=None):
+    """
+    Returns the practically perfect probabilities of one hazard on one day.
+
+    Parameters
+    ----------
+    year: int
+        YYYY
+    month: int
+        MM
+    day: int
+        DD
+    hazard: str
+        'torn', 'wind' or 'hail'.
+    grid: rasterize.Grid or None
+        If None, the default grid (rasterize.get_grid()) is used.
+    filtered: bool
+        Use SPC's filtered storm reports.
+    storm_reports: utils.StormReports or None
+        Reports of the day, if they were already loaded.
+
+    Returns
+    -------
+    probabilities: np.ndarray of float32
+        (ny, nx) array between 0 and 1.
+    """
+    if grid is None:
+        grid = rasterize.get_grid()
+    if storm_reports is None:
+        storm_reports = utils.StormReports(year, month, day)
+    return smooth(grid_reports(*_report_points(storm_reports, hazard, filtered), grid), grid)
+
+
+def practically_perfect_range(start_date, end_date, hazards=HAZARDS, grid=None, filtered=True, batch_size=64):
+    """
+    Computes practically perfect probabilities for every day in a date range (inclusive), e.g. a whole year.
+
+    Days are gridded one at a time and smoothed in batches of 'batch_size' days with a single stacked FFT.
+
+    Parameters
+    ----------
+    start_date, end_date: datetime.date
+    hazards: iterable of str
+        Any of 'torn', 'wind', 'hail'.
+    grid: rasterize.Grid or None
+        If None, the default grid (rasterize.get_grid()) is used.
+    filtered: bool
+        Use SPC's filtered storm reports.
+    batch_size: int
+        Number of days smoothed together.
+
+    Returns
+    -------
+    dates: list of datetime.date
+        Days with storm report files. Days SPC has no report file for are left out.
+    probabilities: dict
+        Maps each hazard to a (num dates, ny, nx) float32 array between 0 and 1.
+    """
+    if grid is None:
+        grid = rasterize.get_grid()
+
+    dates = []
+    binary = {hazard: [] for hazard in hazards}
+    date = start_date
+    while date <= end_date:
+        storm_reports = utils.StormReports(date.year, date.month, date.day)
+        try:
+            points = {hazard: _report_points(storm_reports, hazard, filtered) for hazard in hazards}
+        except FileNotFoundError:
+            date += datetime.timedelta(days=1)
+            continue
+        dates.append(date)
+        for hazard in hazards:
+            binary[hazard].append(grid_reports(*points[hazard], grid))
+        date += datetime.timedelta(days=1)
+
+    probabilities = dict({})
+    for hazard in hazards:
+        probabilities[hazard] = np.empty((len(dates), ) + grid.shape, dtype=np.float32)
+        for start in range(0, len(dates), batch_size):
+            probabilities[hazard][start:start + batch_size] = smooth(np.stack(binary[hazard][start:start + batch_size]), grid)
+    return dates, probabilities
+
+
+def plot_practically_perfect(probabilities, hazard, year, month, day, image_dir, grid=None, profiles=None):
+    """
+    Draws practically perfect probabilities with the contour levels and colors of the probabilistic outlooks.
+
+    Parameters
+    ----------
+    probabilities: np.ndarray
+        (ny, nx) array between 0 and 1, e.g. from practically_perfect.
+    hazard: str
+        'torn', 'wind' or 'hail'.
+    year: int
+        YYYY
+    month: int
+        MM
+    day: int
+        DD
+    image_dir: str
+        Directory where the image will be stored.
+    grid: rasterize.Grid or None
+        Grid of the probabilities. If None, the default grid (rasterize.get_grid()) is used.
+    profiles: iterable of str or None
+        Render profiles (settings.render_profiles) to save. If None, settings.product_render_profiles['pph'] is used.
+
+    Returns
+    -------
+    paths: list of str
+        Paths of the saved images.
+    """
+    if grid is None:
+        grid = rasterize.get_grid()
+
+    percents = outlook.PROBABILITIES[hazard]
+    level_names = [f'{outlook.LEVEL_PREFIXES[hazard]}{percent}' for percent in percents]
+
+    crs = ccrs.Miller(central_longitude=250)
+    fig, ax = plt.subplots(1, 1, subplot_kw={'projection': crs})
+
+    levels = [percent / 100 for percent in percents] + [1.01]
+    ax.contourf(grid.x, grid.y, probabilities, levels=levels, colors=[settings.colors[name]['fill'] for name in level_names], transform=grid.projection)
+    ax.contour(grid.x, grid.y, probabilities, levels=levels[:-1], colors=[settings.colors[name]['outline'] for name in level_names], linewidths=0.5,
+               transform=grid.projection)
+
+    plot_outlooks.plot_background([233, 295, 20, 50], ax=ax)
+
+    handles = [getattr(utils, f'poly_{name}') for name in level_names]
+    labels = [f'{percent}%' for percent in percents]
+    plt.legend(handles=handles, labels=labels, loc='lower right', ncol=4, fontsize=5, framealpha=1, title='Practically perfect probability', title_fontsize=6).set_zorder(10)
+
+    plt.title(f'{year}-%02d-%02d Practically Perfect Hindcast: {HAZARD_NAMES[hazard]}' % (month, day))
+    return render.save_figure(f'{image_dir}/pph_{year}%02d%02d_{hazard}' % (month, day), 'pph', profiles)
@@ -0,0 +1,203 @@
+"""
+Risk at arbitrary points.
+
+Each issuance gets an OutlookIndex: its rings, grouped by product and level, plus a grid of lon/lat buckets that lists
+the rings overlapping each bucket. A batch of points is sorted by bucket once, so each ring is only tested against the
+points of the buckets under its bounding box. Indexes are cached per issuance, so repeated queries only pay for the
+point-in-polygon tests.
+
+Results use the field names and codes of rasterize.py ('cat', 'torn', 'torn_sig', ..., 'fire', 'dryt').
+"""
+
+import datetime
+import functools
+import numpy as np
+from matplotlib.path import Path
+import outlook
+import rasterize
+import settings
+
+
+class _RingIndex:
+    """ Rings of one set of levels with their paths and the buckets they overlap. """
+    __slots__ = ('paths', 'codes', 'bucket_bounds')
+
+    def __init__(self, ring_codes, bucket_size):
+        """
+        ring_codes: list of (np.ndarray, int) tuples
+            Each (lon, lat) ring with the code given to the points inside it. Rings are stored in order, so later rings override earlier ones.
+        """
+        rings = [(ring[:, :2], code) for ring, code in ring_codes if len(ring) >= 3]
+        self.paths = [Path(ring) for ring, _ in rings]
+        self.codes = np.array([code for _, code in rings], dtype=np.int16)
+        bounds = np.array([[ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max()] for ring, _ in rings]).reshape(-1, 4)
+        # Bucket rows (latitude) and columns (longitude) covered by each ring: [first row, last row, first column, last column]
+        self.bucket_bounds = np.column_stack([_bucket_row(bounds[:, 1], bucket_size), _bucket_row(bounds[:, 3], bucket_size),
+                                              _bucket_column(bounds[:, 0], bucket_size), _bucket_column(bounds[:, 2], bucket_size)])
+
+    def query(self, points, order, bucket_starts, num_columns, out):
+        """ Sets out[i] to the code of the last ring containing point i. 'order' sorts the points by bucket. """
+        for path, code, (row0, row1, column0, column1) in zip(self.paths, self.codes, self.bucket_bounds):
+            if row1 < 0 or row0 >= len(bucket_starts) // num_columns or column1 < 0 or column0 >= num_columns:
+                continue
+            row0, row1 = max(row0, 0), min(row1, len(bucket_starts) // num_columns - 1)
+            column0, column1 = max(column0, 0), min(column1, num_columns - 1)
+            # Buckets of one row are contiguous in the sorted points, so each row of the ring's bounding box is one slice
+            candidates = np.concatenate([order[bucket_starts[row * num_columns + column0]:bucket_starts[row * num_columns + column1 + 1]]
+                                         for row in range(row0, row1 + 1)])
+            if len(candidates) > 0:
+                out[candidates[path.contains_points(points[candidates])]] = code
+
+
+def _bucket_row(lats, bucket_size):
+    return np.floor((np.asarray(lats) + 90) / bucket_size).astype(np.int64)
+
+
+def _bucket_column(lons, bucket_size):
+    return np.floor((np.asarray(lons) + 180) / bucket_size).astype(np.int64)
+
+
+class OutlookIndex:
+    """
+    Spatial index of the risk areas of one parsed outlook.
+
+    Build one with OutlookIndex(folders) from parsed folders, or get a cached one with issuance_index.
+    """
+    __slots__ = ('products', 'bucket_size', '_levels', '_significant')
+
+    def __init__(self, folders, products=rasterize.CONVECTIVE_PRODUCTS, bucket_size=settings.point_query_bucket_degrees):
+        """
+        folders: list of kml.Folder
+            Parsed convective or fire weather outlook.
+        products: iterable of str
+            Any of 'cat', 'torn', 'wind', 'hail' for convective outlooks, or 'fire' for fire weather outlooks.
+        bucket_size: float
+            Size of the index buckets in degrees.
+        """
+        self.products = tuple(products)
+        self.bucket_size = bucket_size
+        self._levels = dict({})  # field name -> _RingIndex of its levels, lowest first so higher levels override them
+        self._significant = dict({})  # field name -> _RingIndex of the significant severe area
+        for product in self.products:
+            levels, significant_rings = outlook.risk_levels(folders, product)
+            if product == 'fire':
+                self._levels['fire'] = self._ring_index({level: levels[level] for level in outlook.FIRE_LEVELS})
+                self._levels['dryt'] = self._ring_index({level: levels[level] for level in outlook.DRY_THUNDER_LEVELS})
+            else:
+                self._levels[product] = self._ring_index(levels)
+                if product != 'cat':
+                    self._significant[f'{product}_sig'] = _RingIndex([(ring, 1) for ring in significant_rings], bucket_size)
+
+    def _ring_index(self, levels):
+        return _RingIndex([(ring, code) for code, rings in enumerate(levels.values(), start=1) for ring in rings], self.bucket_size)
+
+    def query(self, lons, lats):
+        """
+        Returns the risk at a batch of points.
+
+        Parameters
+        ----------
+        lons, lats: np.ndarray
+            Point coordinates. Longitudes may be given in either [-180, 180] or [0, 360].
+
+        Returns
+        -------
+        fields: dict
+            Maps each field name to an array with one value per point: level codes for 'cat', 'fire' and 'dryt' (0 outside
+            every level), percentages for 'torn', 'wind' and 'hail', and bools for the significant severe areas.
+        """
+        lons = (np.asarray(lons, dtype=np.float64) + 180) % 360 - 180
+        lats = np.asarray(lats, dtype=np.float64)
+        points = np.column_stack([lons, lats])
+
+        num_rows, num_columns = int(np.ceil(180 / self.bucket_size)), int(np.ceil(360 / self.bucket_size))
+        buckets = np.clip(_bucket_row(lats, self.bucket_size), 0, num_rows - 1) * num_columns + np.clip(_bucket_column(lons, self.bucket_size), 0, num_columns - 1)
+        order = np.argsort(buckets, kind='stable')
+        bucket_starts = np.searchsorted(buckets[order], np.arange(num_rows * num_columns + 1))
+
+        fields = dict({})
+        for name, ring_index in list(self._levels.items()) + list(self._significant.items()):
+            codes = np.zeros(len(lons), dtype=np.int16)
+            ring_index.query(points, order, bucket_starts, num_columns, codes)
+            fields[name] = codes
+        for name in list(fields):
+            if name in outlook.PROBABILITIES:
+                fields[name] = np.array((0, ) + outlook.PROBABILITIES[name], dtype=np.uint8)[fields[name]]
+            elif name.endswith('_sig'):
+                fields[name] = fields[name].astype(bool)
+            else:
+                fields[name] = fields[name].astype(np.int8)
+        return {name: fields[name] for name in rasterize.field_names(self.products)}
+
+
+@functools.lru_cache(maxsize=settings.point_query_index_cache_size)
+def issuance_index(outlook_day, date, time, outlook_kmz_dir, products=rasterize.CONVECTIVE_PRODUCTS):
+    """
+    Returns the OutlookIndex of an issuance, building it only the first time it is requested in this process.
+
+    Parameters
+    ----------
+    outlook_day: int
+        Outlook day.
+    date: datetime.date
+        Issuance date.
+    time: int
+        Issuance time in UTC. HHMM
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    products: tuple of str
+        Convective products, or ('fire', ) for a fire weather outlook.
+    """
+    load = outlook.load_fire_outlook if 'fire' in products else outlook.load_convective_outlook
+    return OutlookIndex(load(outlook_day, date.year, date.month, date.day, time, outlook_kmz_dir), products)
+
+
+def query_points(lons, lats, outlook_day, date, time, outlook_kmz_dir, products=rasterize.CONVECTIVE_PRODUCTS):
+    """ Returns the risk at a batch of points for one issuance. See OutlookIndex.query and issuance_index. """
+    return issuance_index(outlook_day, date, time, outlook_kmz_dir, tuple(products)).query(lons, lats)
+
+
+def query_range(lons, lats, start_date, end_date, outlook_kmz_dir, outlook_day=1, times=None, products=rasterize.CONVECTIVE_PRODUCTS):
+    """
+    Returns the risk at a batch of points for every issuance in a date range (inclusive).
+
+    Parameters
+    ----------
+    lons, lats: np.ndarray
+        Point coordinates.
+    start_date, end_date: datetime.date
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    outlook_day: int
+        Outlook day.
+    times: iterable of ints or None
+        Issuance times (HHMM UTC) to include. If None, every valid time of the outlook day is included.
+    products: iterable of str
+        Convective products, or ('fire', ) for fire weather outlooks.
+
+    Returns
+    -------
+    issuances: np.ndarray of rasterize.ISSUANCE_DTYPE
+        Issuances found in the SPC archive. Missing issuances are left out.
+    fields: dict
+        Maps each field name to a (num issuances, num points) array.
+    """
+    products = tuple(products)
+    valid_times = (settings.valid_fire_outlook_times if 'fire' in products else settings.valid_convective_outlook_times)[outlook_day - 1]
+
+    issuances, results = [], []
+    date = start_date
+    while date <= end_date:
+        for time in valid_times:
+            if times is not None and time not in times:
+                continue
+            try:
+                results.append(query_points(lons, lats, outlook_day, date, time, outlook_kmz_dir, products))
+            except FileNotFoundError:
+                continue
+            issuances.append((outlook_day, date.year * 10000 + date.month * 100 + date.day, time))
+        date += datetime.timedelta(days=1)
+
+    fields = {name: np.stack([result[name] for result in results]) if results else np.empty((0, len(lons)), dtype=rasterize.field_dtype(name))
+              for name in rasterize.field_names(products)}
+    return np.array(issuances, dtype=rasterize.ISSUANCE_DTYPE), fields
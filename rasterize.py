@@ -0,0 +1,430 @@
+"""
+Outlooks burned onto a fixed grid.
+
+Grids are regular in a Lambert conformal projection (settings.raster_projection) and cover settings.raster_extent. Each
+product becomes one or two fields:
+
+    cat         int8    Categorical level code: 0 outside every level, then 1 (TSTM) to 6 (HIGH)
+    torn        uint8   Tornado probability in percent (0 outside every level); likewise 'wind' and 'hail'
+    torn_sig    bool    Inside the hatched significant severe area; likewise 'wind_sig' and 'hail_sig'
+    fire        int8    Fire weather level code: 0, then 1 (Elevated) to 3 (Extreme)
+    dryt        int8    Dry thunderstorm level code: 0, then 1 (isolated) or 2 (scattered)
+
+A cell takes the highest level whose polygons contain its center.
+"""
+
+import datetime
+import functools
+import json
+import os
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyproj
+from matplotlib.path import Path
+import outlook
+import settings
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+CUBE_FORMAT_VERSION = 1
+
+ISSUANCE_DTYPE = np.dtype([('outlook_day', '<i1'), ('date', '<i4'), ('time', '<i2')])  # date is YYYYMMDD
+
+CONVECTIVE_PRODUCTS = ('cat', 'torn', 'wind', 'hail')
+
+_grids = dict({})  # In-memory cache: (spacing, extent) -> Grid
+
+
+class Grid:
+    """
+    Regular grid in the raster projection.
+
+    x and y are the projected coordinates (m) of the cell centers along each axis, and lons / lats the (ny, nx) geographic
+    coordinates of every cell center. Coordinates are transformed with pyproj, so rasterizing never loads cartopy.
+    """
+    __slots__ = ('spacing', 'extent', 'x', 'y', 'lons', 'lats')
+
+    def __init__(self, spacing, extent, x, y, lons, lats):
+        self.spacing = spacing
+        self.extent = extent
+        self.x = x
+        self.y = y
+        self.lons = lons
+        self.lats = lats
+
+    @property
+    def shape(self):
+        return len(self.y), len(self.x)
+
+    @property
+    def projection(self):
+        """ Cartopy projection of the grid, to plot fields with. """
+        return raster_projection()
+
+    def project(self, lons, lats):
+        """ Returns the (n, 2) projected coordinates (m) of points. """
+        return _project(lons, lats)
+
+    def __repr__(self):
+        return f'Grid({self.spacing} km, {self.shape[0]} x {self.shape[1]})'
+
+
+def raster_projection():
+    """ Returns the cartopy projection of the outlook grids. """
+    import cartopy.crs as ccrs  # Imported here so rasterizing in worker processes never loads cartopy
+    return ccrs.LambertConformal(**settings.raster_projection)
+
+
+def raster_proj4():
+    """ Returns the PROJ string of settings.raster_projection, with cartopy's defaults for the parameters it leaves out. """
+    projection = dict(dict(central_longitude=-96., central_latitude=39., false_easting=0., false_northing=0.,
+                           standard_parallels=(33, 45)), **settings.raster_projection)
+    lat_1, lat_2 = (tuple(projection['standard_parallels']) * 2)[:2]
+    return ('+ellps=WGS84 +proj=lcc +lon_0=%s +lat_0=%s +x_0=%s +y_0=%s +lat_1=%s +lat_2=%s +no_defs' %
+            (projection['central_longitude'], projection['central_latitude'], projection['false_easting'], projection['false_northing'], lat_1, lat_2))
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer(inverse=False):
+    """ Transforms geographic coordinates to the raster projection, or back if inverse. """
+    crs = (pyproj.CRS.from_proj4(raster_proj4()), pyproj.CRS.from_epsg(4326))
+    return pyproj.Transformer.from_crs(*(crs if inverse else crs[::-1]), always_xy=True)
+
+
+def _project(lons, lats):
+    x, y = _transformer().transform(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+    return np.column_stack([np.ravel(x), np.ravel(y)])
+
+
+def get_grid(spacing=settings.raster_grid_spacing, extent=settings.raster_extent):
+    """
+    Returns the grid with a given spacing that covers an extent. Grids are built once per process.
+
+    Parameters
+    ----------
+    spacing: int
+        Grid spacing in km (e.g. 80 or 40).
+    extent: iterable with 4 floats
+        Area the grid must cover, in the format of [min lon, max lon, min lat, max lat].
+
+    Returns
+    -------
+    grid: Grid
+    """
+    key = (spacing, tuple(extent))
+    grid = _grids.get(key)
+    if grid is None:
+        min_lon, max_lon, min_lat, max_lat = extent
+
+        # The projected bounding box of the extent's edges, which are curved in a conic projection
+        edge = np.linspace(0, 1, 101)
+        edge_lons = np.concatenate([min_lon + (max_lon - min_lon) * edge, np.full(101, max_lon), max_lon - (max_lon - min_lon) * edge, np.full(101, min_lon)])
+        edge_lats = np.concatenate([np.full(101, min_lat), min_lat + (max_lat - min_lat) * edge, np.full(101, max_lat), max_lat - (max_lat - min_lat) * edge])
+        edge_xy = _project(edge_lons, edge_lats)
+
+        dx = spacing * 1000.
+        x = np.arange(np.floor(edge_xy[:, 0].min() / dx), np.ceil(edge_xy[:, 0].max() / dx)) * dx + dx / 2
+        y = np.arange(np.floor(edge_xy[:, 1].min() / dx), np.ceil(edge_xy[:, 1].max() / dx)) * dx + dx / 2
+
+        xx, yy = np.meshgrid(x, y)
+        lons, lats = _transformer(inverse=True).transform(xx, yy)
+        grid = Grid(spacing, tuple(extent), x, y, lons, lats)
+        _grids[key] = grid
+    return grid
+
+
+def burn_rings(grid, rings, out=None, value=True):
+    """
+    Sets the cells whose centers are inside any of the rings.
+
+    The rings are projected in one transform. Each ring is then only tested against the block of cells under its
+    bounding box, which is a plain slice since the grid is regular in the projection.
+
+    Parameters
+    ----------
+    grid: Grid
+    rings: list of np.ndarray
+        Rings of (lon, lat) coordinates.
+    out: np.ndarray or None
+        (ny, nx) array to burn into. If None, a new bool array is returned.
+    value: scalar
+        Value given to the cells inside the rings.
+
+    Returns
+    -------
+    out: np.ndarray
+    """
+    if out is None:
+        out = np.zeros(grid.shape, dtype=bool)
+    rings = [ring for ring in rings if len(ring) >= 3]
+    if len(rings) == 0:
+        return out
+
+    vertices = np.concatenate([ring[:, :2] for ring in rings])
+    projected = grid.project(vertices[:, 0], vertices[:, 1])
+    for xy in np.split(projected, np.cumsum([len(ring) for ring in rings])[:-1]):
+        i0, i1 = np.searchsorted(grid.y, [xy[:, 1].min(), xy[:, 1].max()])
+        j0, j1 = np.searchsorted(grid.x, [xy[:, 0].min(), xy[:, 0].max()])
+        if i0 == i1 or j0 == j1:
+            continue
+        xx, yy = np.meshgrid(grid.x[j0:j1], grid.y[i0:i1])
+        inside = Path(xy).contains_points(np.column_stack([xx.ravel(), yy.ravel()])).reshape(xx.shape)
+        out[i0:i1, j0:j1][inside] = value
+    return out
+
+
+def burn_levels(grid, levels, dtype=np.int8):
+    """
+    Burns risk levels, from the lowest to the highest, so every cell ends up with the code of the highest level containing it.
+
+    Parameters
+    ----------
+    grid: Grid
+    levels: dict
+        Levels from outlook.risk_levels.
+    dtype: np.dtype
+
+    Returns
+    -------
+    codes: np.ndarray
+        (ny, nx) array of level codes: 0 outside every level, otherwise the 1-based index of the level in 'levels'.
+    """
+    codes = np.zeros(grid.shape, dtype=dtype)
+    for code, rings in enumerate(levels.values(), start=1):
+        burn_rings(grid, rings, out=codes, value=code)
+    return codes
+
+
+def field_names(products):
+    """ Returns the names of the fields of a list of products, in order. """
+    names = []
+    for product in products:
+        if product == 'cat':
+            names.append('cat')
+        elif product in outlook.PROBABILITIES:
+            names.extend([product, f'{product}_sig'])
+        elif product == 'fire':
+            names.extend(['fire', 'dryt'])
+        else:
+            raise ValueError(f"Unknown product: {product}")
+    return names
+
+
+def field_dtype(name):
+    return np.dtype(bool) if name.endswith('_sig') else np.dtype(np.uint8) if name in outlook.PROBABILITIES else np.dtype(np.int8)
+
+
+def rasterize_outlook(folders, products=CONVECTIVE_PRODUCTS, grid=None):
+    """
+    Burns a parsed outlook onto a grid.
+
+    Parameters
+    ----------
+    folders: list of kml.Folder
+        Parsed convective or fire weather outlook.
+    products: iterable of str
+        Any of 'cat', 'torn', 'wind', 'hail' for convective outlooks, or 'fire' for fire weather outlooks.
+    grid: Grid or None
+        If None, the default grid (get_grid()) is used.
+
+    Returns
+    -------
+    fields: dict
+        Maps each field name (see the module docstring) to a (ny, nx) array.
+    """
+    if grid is None:
+        grid = get_grid()
+
+    fields = dict({})
+    for product in products:
+        levels, significant_rings = outlook.risk_levels(folders, product)
+        if product == 'cat':
+            fields['cat'] = burn_levels(grid, levels)
+        elif product == 'fire':
+            fields['fire'] = burn_levels(grid, {level: levels[level] for level in outlook.FIRE_LEVELS})
+            fields['dryt'] = burn_levels(grid, {level: levels[level] for level in outlook.DRY_THUNDER_LEVELS})
+        else:
+            percents = np.array((0, ) + outlook.PROBABILITIES[product], dtype=np.uint8)
+            fields[product] = percents[burn_levels(grid, levels)]
+            fields[f'{product}_sig'] = burn_rings(grid, significant_rings)
+    return fields
+
+
+def _rasterize_issuance(issuance, outlook_kmz_dir, products, spacing, extent):
+    """ Loads and rasterizes one issuance in a worker. Returns the fields, or None and the traceback if it failed. """
+    outlook_day, date, time = issuance
+    load = outlook.load_fire_outlook if 'fire' in products else outlook.load_convective_outlook
+    try:
+        folders = load(outlook_day, date.year, date.month, date.day, time, outlook_kmz_dir)
+        return rasterize_outlook(folders, products, get_grid(spacing, extent)), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _truncate_npy(path, length):
+    """ Shrinks the first axis of a .npy file to its first 'length' entries in place, keeping the size of its header. """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        header_start = f.tell()
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        data_start = f.tell()
+        header_length = data_start - header_start - (2 if version == (1, 0) else 4)  # After the header length field
+        header = repr(dict(descr=np.lib.format.dtype_to_descr(dtype), fortran_order=fortran_order, shape=(length, ) + shape[1:]))
+        f.seek(data_start - header_length)
+        f.write(header.ljust(header_length - 1).encode('latin1') + b'\n')
+        f.truncate(data_start + length * int(np.prod(shape[1:])) * dtype.itemsize)
+
+
+def build_cube(cube_dir, start_date, end_date, outlook_kmz_dir, outlook_day=1, times=None, products=CONVECTIVE_PRODUCTS,
+    spacing=settings.raster_grid_spacing, extent=settings.raster_extent, max_workers=settings.batch_max_workers):
+    """
+    Rasterizes every issuance in a date range (inclusive) into a time-stacked cube.
+
+    The cube is a directory with one (num issuances, ny, nx) .npy file per field, written through a memory map as the
+    issuances are rasterized across a process pool, so memory use does not grow with the length of the range. It also
+    holds the issuance of every time step (issuances.npy), the grid (grid.npz) and a small JSON header. Issuances that
+    are missing from the SPC archive are left out of the cube.
+
+    Parameters
+    ----------
+    cube_dir: str
+        Directory of the cube. An existing cube there is replaced.
+    start_date, end_date: datetime.date
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    outlook_day: int
+        Outlook day: 1 to 3 for convective outlooks, 1 or 2 for fire weather outlooks.
+    times: iterable of ints or None
+        Issuance times (HHMM UTC) to include. If None, every valid time of the outlook day is included.
+    products: iterable of str
+        Convective products ('cat', 'torn', 'wind', 'hail'), or ('fire', ) for a fire weather outlook cube.
+    spacing: int
+        Grid spacing in km.
+    extent: iterable with 4 floats
+        Area covered by the grid, [min lon, max lon, min lat, max lat].
+    max_workers: int or None
+        Number of worker processes. If None, one per CPU is used. If 1, the issuances are rasterized in this process.
+
+    Returns
+    -------
+    failures: list of (issuance, str) tuples
+        Issuances that could not be rasterized and their tracebacks.
+    """
+    products = tuple(products)
+    if 'fire' in products and products != ('fire', ):
+        raise ValueError("Fire weather outlooks cannot be stacked in the same cube as convective outlooks")
+    all_valid_times = settings.valid_fire_outlook_times if 'fire' in products else settings.valid_convective_outlook_times
+    if outlook_day not in range(1, len(all_valid_times) + 1):
+        raise ValueError(f"Invalid outlook day: {outlook_day}. Valid days for these products: 1 to {len(all_valid_times)}")
+    valid_times = all_valid_times[outlook_day - 1]
+
+    issuances = []
+    date = start_date
+    while date <= end_date:
+        issuances.extend((outlook_day, date, time) for time in valid_times if times is None or time in times)
+        date += datetime.timedelta(days=1)
+
+    grid = get_grid(spacing, extent)
+    names = field_names(products)
+    if os.path.isdir(cube_dir):
+        shutil.rmtree(cube_dir)
+    os.makedirs(cube_dir)
+
+    # Fields are allocated for every issuance, then truncated in place to the ones that exist once the run is over
+    cube = {name: np.lib.format.open_memmap(os.path.join(cube_dir, f'{name}.tmp.npy'), mode='w+', dtype=field_dtype(name),
+                                            shape=(len(issuances), ) + grid.shape) for name in names}
+    rasterize = functools.partial(_rasterize_issuance, outlook_kmz_dir=outlook_kmz_dir, products=products, spacing=spacing, extent=extent)
+
+    kept, failures = [], []
+    executor = None if max_workers == 1 else ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        results = map(rasterize, issuances) if executor is None else executor.map(rasterize, issuances, chunksize=8)
+        for issuance, (fields, failure) in zip(issuances, results):
+            if fields is None:
+                failures.append((issuance, failure))
+                continue
+            for name in names:
+                cube[name][len(kept)] = fields[name]
+            kept.append(issuance)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for name in names:
+        cube[name].flush()
+        del cube[name]
+        _truncate_npy(os.path.join(cube_dir, f'{name}.tmp.npy'), len(kept))
+        os.replace(os.path.join(cube_dir, f'{name}.tmp.npy'), os.path.join(cube_dir, f'{name}.npy'))
+
+    records = np.array([(day, date.year * 10000 + date.month * 100 + date.day, time) for day, date, time in kept], dtype=ISSUANCE_DTYPE)
+    np.save(os.path.join(cube_dir, 'issuances.npy'), records)
+    np.savez(os.path.join(cube_dir, 'grid.npz'), x=grid.x, y=grid.y, lons=grid.lons, lats=grid.lats)
+    with open(os.path.join(cube_dir, 'cube.json'), 'w') as f:
+        json.dump(dict(version=CUBE_FORMAT_VERSION, products=list(products), fields=names, spacing=spacing, extent=list(extent),
+                       projection=settings.raster_projection), f)
+    return failures
+
+
+def load_cube(cube_dir):
+    """
+    Opens a cube written by build_cube without reading it into memory.
+
+    Returns
+    -------
+    issuances: np.ndarray of ISSUANCE_DTYPE
+        Issuance of each time step.
+    fields: dict
+        Maps each field name to a read-only (num issuances, ny, nx) memory map.
+    grid: Grid
+    """
+    with open(os.path.join(cube_dir, 'cube.json'), 'r') as f:
+        header = json.load(f)
+    if header['version'] != CUBE_FORMAT_VERSION:
+        raise ValueError(f"{cube_dir} was written by an incompatible version of rasterize.py")
+
+    grid = get_grid(header['spacing'], header['extent'])
+    issuances = np.load(os.path.join(cube_dir, 'issuances.npy'))
+    fields = {name: np.load(os.path.join(cube_dir, f'{name}.npy'), mmap_mode='r') for name in header['fields']}
+    return issuances, fields, grid
+
+
+def cube_to_netcdf(cube_dir, netcdf_path):
+    """
+    Writes a cube as a NetCDF file with one (time, y, x) variable per field. Requires the netCDF4 package.
+
+    Parameters
+    ----------
+    cube_dir: str
+        Directory of a cube written by build_cube.
+    netcdf_path: str
+        Path of the NetCDF file to write.
+    """
+    if netCDF4 is None:
+        raise ImportError("Writing NetCDF files requires the netCDF4 package")
+
+    issuances, fields, grid = load_cube(cube_dir)
+    with netCDF4.Dataset(netcdf_path, 'w') as dataset:
+        dataset.createDimension('time', len(issuances))
+        dataset.createDimension('y', len(grid.y))
+        dataset.createDimension('x', len(grid.x))
+        dataset.setncattr('projection', raster_proj4())
+        dataset.setncattr('grid_spacing_km', grid.spacing)
+
+        for name in ISSUANCE_DTYPE.names:
+            dataset.createVariable(name, issuances[name].dtype, ('time', ))[:] = issuances[name]
+        dataset.createVariable('x', 'f8', ('x', ))[:] = grid.x
+        dataset.createVariable('y', 'f8', ('y', ))[:] = grid.y
+        dataset.createVariable('lon', 'f4', ('y', 'x'))[:] = grid.lons
+        dataset.createVariable('lat', 'f4', ('y', 'x'))[:] = grid.lats
+
+        for name, field in fields.items():
+            dtype = 'u1' if field.dtype == bool else field.dtype
+            variable = dataset.createVariable(name, dtype, ('time', 'y', 'x'), zlib=True, chunksizes=(1, len(grid.y), len(grid.x)))
+            for t in range(len(issuances)):
+                variable[t] = field[t]
@@ -0,0 +1,120 @@
+"""
+Map extents and clipping of outlook geometry to them.
+
+Extents use the [min lon, max lon, min lat, max lat] format of plot_background, with longitudes in either [-180, 180] or
+[0, 360]. Named regions are listed in settings.regions.
+"""
+
+import numpy as np
+import settings
+
+
+def resolve_region(region=None):
+    """
+    Returns the extent of a region and the suffix added to the names of its images.
+
+    Parameters
+    ----------
+    region: str, iterable with 4 floats, or None
+        Name of a region in settings.regions, or an extent. If None, settings.default_region is used.
+
+    Returns
+    -------
+    extent: list of 4 floats
+    suffix: str
+        '' for the default region, '_<name>' for other named regions, and '_<min lon>_<max lon>_<min lat>_<max lat>' for extents.
+
+    Raises
+    ------
+    ValueError
+        - If the region name is unknown or the extent is invalid.
+    """
+    if region is None:
+        return list(settings.regions[settings.default_region]), ''
+    if isinstance(region, str):
+        if region not in settings.regions:
+            raise ValueError(f"Unknown region: {region}. Valid regions: {', '.join(settings.regions)}")
+        return list(settings.regions[region]), '' if region == settings.default_region else f'_{region}'
+
+    extent = [float(value) for value in region]
+    if len(extent) != 4 or extent[0] >= extent[1] or extent[2] >= extent[3]:
+        raise ValueError(f"Invalid extent: {region}. Extents must be [min lon, max lon, min lat, max lat]")
+    return extent, '_%g_%g_%g_%g' % tuple(extent)
+
+
+def _normalized_lon_bounds(extent):
+    """ Returns the longitude bounds of an extent in [-180, 180), the convention of the outlook and report coordinates. """
+    min_lon = (extent[0] + 180) % 360 - 180
+    return min_lon, min_lon + (extent[1] - extent[0])
+
+
+def points_in_extent(lons, lats, extent):
+    """ Returns a mask of the points inside an extent. """
+    min_lon, max_lon = _normalized_lon_bounds(extent)
+    lons = (np.asarray(lons, dtype=np.float64) - min_lon) % 360 + min_lon  # Unwrapped so the extent may cross the antimeridian
+    lats = np.asarray(lats, dtype=np.float64)
+    return (lons >= min_lon) & (lons <= max_lon) & (lats >= extent[2]) & (lats <= extent[3])
+
+
+def _clip_edge(ring, axis, bound, keep_above):
+    """ Clips a closed ring against one side of a box (one Sutherland-Hodgman step, vectorized over the ring's edges). """
+    inside = ring[:, axis] >= bound if keep_above else ring[:, axis] <= bound
+    if inside.all() or not inside.any():
+        return ring if inside.all() else ring[:0]
+
+    following = np.roll(ring, -1, axis=0)
+    following_inside = np.roll(inside, -1)
+    crossing = inside != following_inside
+    t = (bound - ring[crossing, axis]) / (following[crossing, axis] - ring[crossing, axis])
+    intersections = ring[crossing] + t[:, None] * (following[crossing] - ring[crossing])
+
+    # Each vertex contributes itself if it is inside, followed by the intersection of its outgoing edge if that edge crosses the side
+    counts = inside.astype(np.int64) + crossing
+    output = np.empty((counts.sum(), ring.shape[1]))
+    positions = np.cumsum(counts) - counts
+    output[positions[inside]] = ring[inside]
+    output[positions[crossing] + inside[crossing]] = intersections
+    return output
+
+
+def clip_rings(rings, extent, padding=settings.region_clip_padding):
+    """
+    Clips outlook rings to a padded extent.
+
+    Rings whose bounding box is outside the padded extent are dropped without further work, rings inside it are kept as
+    they are, and only the rings crossing its sides are clipped. The padding keeps the clipped edges outside the map.
+
+    Parameters
+    ----------
+    rings: list of np.ndarray
+        Rings of (lon, lat) coordinates.
+    extent: iterable with 4 floats
+        [min lon, max lon, min lat, max lat].
+    padding: float
+        Fraction of the extent's width and height added on every side.
+
+    Returns
+    -------
+    rings: list of np.ndarray
+    """
+    if len(rings) == 0:
+        return rings
+    min_lon, max_lon = _normalized_lon_bounds(extent)
+    lon_padding, lat_padding = padding * (max_lon - min_lon), padding * (extent[3] - extent[2])
+    box = [min_lon - lon_padding, max_lon + lon_padding, extent[2] - lat_padding, extent[3] + lat_padding]
+
+    bounds = np.array([[ring[:, 0].min(), ring[:, 0].max(), ring[:, 1].min(), ring[:, 1].max()] if len(ring) > 0 else [np.nan] * 4 for ring in rings])
+    overlaps = (bounds[:, 1] >= box[0]) & (bounds[:, 0] <= box[1]) & (bounds[:, 3] >= box[2]) & (bounds[:, 2] <= box[3])
+    contained = (bounds[:, 0] >= box[0]) & (bounds[:, 1] <= box[1]) & (bounds[:, 2] >= box[2]) & (bounds[:, 3] <= box[3])
+
+    clipped = []
+    for ring, ring_overlaps, ring_contained in zip(rings, overlaps, contained):
+        if not ring_overlaps:
+            continue
+        if not ring_contained:
+            for axis, bound, keep_above in ((0, box[0], True), (0, box[1], False), (1, box[2], True), (1, box[3], False)):
+                ring = _clip_edge(ring, axis, bound, keep_above)
+            if len(ring) < 3:
+                continue
+        clipped.append(ring)
+    return clipped
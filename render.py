@@ -0,0 +1,200 @@
+"""
+Saving finished figures according to the render profiles in settings.py.
+
+A render profile picks the resolution, format and compression of one output image. When a product has several raster
+profiles (e.g. print, web and thumbnail), the figure is rasterized once at the highest resolution and the other images are
+resampled from that bitmap instead of being drawn again.
+"""
+
+import io
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+import instrument
+import settings
+
+RASTER_FORMATS = ('png', 'webp', 'jpeg')
+VECTOR_FORMATS = ('svg', 'pdf')
+EXTENSIONS = dict(png='png', webp='webp', jpeg='jpg', svg='svg', pdf='pdf')
+
+if settings.matplotlib_backend is not None:
+    matplotlib.use(settings.matplotlib_backend)  # Headless runs never probe for GUI toolkits
+matplotlib.rcParams['hatch.linewidth'] = settings.hatch_linewidth
+
+
+def product_profiles(product, profiles=None):
+    """
+    Returns the render profiles of a product.
+
+    Parameters
+    ----------
+    product: str
+        Key of settings.product_render_profiles (e.g. 'cat', 'torn', 'fire').
+    profiles: iterable of str or None
+        Names of profiles in settings.render_profiles. If None, the product's default profiles are used.
+
+    Returns
+    -------
+    profiles: dict
+        Maps each profile name to its settings.
+
+    Raises
+    ------
+    ValueError
+        - If a profile does not exist or has an unsupported format.
+    """
+    if profiles is None:
+        profiles = settings.product_render_profiles.get(product, settings.product_render_profiles['default'])
+    selected = dict({})
+    for name in profiles:
+        if name not in settings.render_profiles:
+            raise ValueError(f"Unknown render profile: {name}. Valid profiles: {', '.join(settings.render_profiles)}")
+        profile = settings.render_profiles[name]
+        if profile['format'] not in RASTER_FORMATS + VECTOR_FORMATS:
+            raise ValueError(f"Unsupported image format in render profile {name}: {profile['format']}")
+        selected[name] = profile
+    return selected
+
+
+def _pil_kwargs(profile):
+    if profile['format'] == 'png':
+        return dict(compress_level=profile.get('compress_level', 6))
+    kwargs = dict(quality=profile.get('quality', 90))
+    if profile['format'] == 'webp':
+        kwargs['method'] = profile.get('method', 4)  # Encoder effort, 0 (fast) to 6 (small)
+    return kwargs
+
+
+def save_figure(image_base, product, profiles=None, fig=None):
+    """
+    Saves a figure once per render profile, then closes it.
+
+    Parameters
+    ----------
+    image_base: str
+        Path of the image without its extension. Each profile appends its suffix and extension.
+    product: str
+        Product the figure shows, used to pick its default render profiles.
+    profiles: iterable of str or None
+        Names of the profiles to save. If None, the product's default profiles are used.
+    fig: matplotlib.figure.Figure or None
+        Figure to save. If None, the current figure is saved.
+
+    Returns
+    -------
+    paths: list of str
+        Paths of the saved images.
+    """
+    if fig is None:
+        fig = plt.gcf()
+    profiles = product_profiles(product, profiles)
+    paths = []
+    instrument.count_figure(fig)
+
+    with instrument.stage('savefig'):
+        raster_profiles = {name: profile for name, profile in profiles.items() if profile['format'] in RASTER_FORMATS}
+        if len(raster_profiles) == 1:
+            profile = next(iter(raster_profiles.values()))
+            path = f"{image_base}{profile.get('suffix', '')}.{EXTENSIONS[profile['format']]}"
+            fig.savefig(path, bbox_inches='tight', dpi=profile['dpi'], format=profile['format'], pil_kwargs=_pil_kwargs(profile))
+            paths.append(path)
+        elif len(raster_profiles) > 1:
+            max_dpi = max(profile['dpi'] for profile in raster_profiles.values())
+            buffer = io.BytesIO()
+            fig.savefig(buffer, bbox_inches='tight', dpi=max_dpi, format='png', pil_kwargs=dict(compress_level=0))  # Fastest lossless round trip
+            image = Image.open(buffer)
+            image.load()
+            for profile in raster_profiles.values():
+                path = f"{image_base}{profile.get('suffix', '')}.{EXTENSIONS[profile['format']]}"
+                scale = profile['dpi'] / max_dpi
+                resized = image if scale == 1 else image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+                if profile['format'] == 'jpeg':
+                    resized = resized.convert('RGB')
+                resized.save(path, format=profile['format'].upper(), dpi=(profile['dpi'], profile['dpi']), **_pil_kwargs(profile))
+                paths.append(path)
+
+        for profile in profiles.values():
+            if profile['format'] in VECTOR_FORMATS:
+                path = f"{image_base}{profile.get('suffix', '')}.{EXTENSIONS[profile['format']]}"
+                fig.savefig(path, bbox_inches='tight', format=profile['format'], dpi=profile.get('dpi', 300))  # dpi only applies to hatching and rasterized artists
+                paths.append(path)
+
+    plt.close(fig)
+    return paths
+
+
+def title_layout(fig=None):
+    """
+    Returns where the title of a figure lands in its saved images, so a new title can later be drawn over it (see retitle).
+
+    Parameters
+    ----------
+    fig: matplotlib.figure.Figure or None
+        Figure with a single titled map. If None, the current figure is used.
+
+    Returns
+    -------
+    layout: dict or None
+        'anchor': [x, y] position of the title's baseline center in inches from the top left corner of the image,
+        'band': height in inches of the strip above the map that only holds the title, 'fontsize' and 'fontweight' of the title.
+        None if the figure has no title.
+    """
+    if fig is None:
+        fig = plt.gcf()
+    ax = fig.axes[0]
+    if ax.get_title() == '':
+        return None
+    renderer = fig.canvas.get_renderer()
+    bbox = fig.get_tightbbox(renderer).padded(plt.rcParams['savefig.pad_inches'])  # Same box as bbox_inches='tight', in inches
+    x, y = ax.title.get_transform().transform(ax.title.get_position()) / fig.dpi
+    return dict(anchor=[x - bbox.x0, bbox.y1 - y], band=bbox.y1 - ax.bbox.y1 / fig.dpi, fontsize=ax.title.get_fontsize(), fontweight=ax.title.get_fontweight())
+
+
+def retitle(source_paths, paths, product, profiles, title, layout):
+    """
+    Copies the images of a figure with a new title drawn over the old one, instead of drawing the whole figure again.
+
+    Parameters
+    ----------
+    source_paths: list of str
+        Images saved by save_figure with the same product and profiles.
+    paths: list of str
+        Paths of the new images, in the same order.
+    product: str
+        Product of the images (see save_figure).
+    profiles: iterable of str or None
+        Render profiles of the images (see save_figure).
+    title: str
+        New title.
+    layout: dict
+        Title layout of the source figure (see title_layout).
+
+    Returns
+    -------
+    retitled: bool
+        False, without writing anything, if a profile is a vector format, which can not be edited this way.
+    """
+    profiles = product_profiles(product, profiles)
+    if any(profile['format'] in VECTOR_FORMATS for profile in profiles.values()):
+        return False
+
+    with instrument.stage('retitle'):
+        for profile, source_path, path in zip(profiles.values(), source_paths, paths):
+            dpi = profile['dpi']
+            image = Image.open(source_path)
+            image.load()
+            band_height = int(layout['band'] * dpi) - 1  # Leave the top edge of the map alone
+
+            strip = Figure(figsize=(image.width / dpi, band_height / dpi), dpi=dpi)
+            strip.text(layout['anchor'][0] * dpi / image.width, 1 - layout['anchor'][1] * dpi / band_height, title, ha='center', va='baseline',
+                       fontsize=layout['fontsize'], fontweight=layout['fontweight'])
+            canvas = FigureCanvasAgg(strip)
+            canvas.draw()
+            image.paste(Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba()).convert(image.mode), (0, 0))
+
+            if profile['format'] == 'jpeg':
+                image = image.convert('RGB')
+            image.save(path, format=profile['format'].upper(), dpi=(dpi, dpi), **_pil_kwargs(profile))
+    return True
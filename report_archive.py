@@ -0,0 +1,215 @@
+import datetime
+import os
+import traceback
+import numpy as np
+import pandas as pd
+import regions
+import utils
+
+HAZARDS = ('torn', 'wind', 'hail')
+
+# Fields of a report, each stored as its own column (see ReportArchive). Magnitudes are the tornado (E)F rating, the wind speed in mph, or the hail size in hundredths of an inch
+# (NaN when unknown). 'filtered' is True for reports that are also in SPC's filtered report set.
+REPORT_DTYPE = np.dtype([('date', '<i4'), ('time', '<i2'), ('lat', '<f4'), ('lon', '<f4'), ('magnitude', '<f4'), ('filtered', '?')])
+
+_MAGNITUDE_COLUMNS = {'torn': 'F_Scale', 'wind': 'Speed', 'hail': 'Size'}
+
+
+def _date_int(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def _to_records(raw_reports, filtered_reports, hazard, date):
+    """ Converts one day of raw and filtered reports of a hazard into REPORT_DTYPE records. """
+    magnitude_column = _MAGNITUDE_COLUMNS[hazard]
+    keys = ['Time', 'Lat', 'Lon']
+    merged = raw_reports.merge(filtered_reports[keys].drop_duplicates(), on=keys, how='left', indicator=True)
+
+    records = np.empty(len(merged), dtype=REPORT_DTYPE)
+    records['date'] = _date_int(date)
+    records['time'] = merged['Time'].values
+    records['lat'] = merged['Lat'].values
+    records['lon'] = merged['Lon'].values
+    records['magnitude'] = pd.to_numeric(merged[magnitude_column], errors='coerce').values
+    records['filtered'] = (merged['_merge'] == 'both').values
+    return records
+
+
+class ReportArchive:
+    """
+    Consolidated multi-year storm report store.
+
+    Each hazard is a column store: one flat binary file per field of REPORT_DTYPE (date.bin, lat.bin, ...), all sharing
+    the same row numbers and only ever appended to, plus a small index mapping every ingested date to the range of rows
+    holding its reports. Queries memory-map the columns and only read the rows of the requested dates, and only the
+    columns they filter on or return. There should be only one writer (ingest) at a time.
+    """
+
+    def __init__(self, archive_dir):
+        """
+        archive_dir: str
+            Directory holding one subdirectory of column and index files per hazard. It is created if it does not exist.
+        """
+        self.archive_dir = archive_dir
+        for hazard in HAZARDS:
+            os.makedirs(os.path.join(archive_dir, hazard), exist_ok=True)
+
+    def _column_path(self, hazard, column):
+        return os.path.join(self.archive_dir, hazard, f'{column}.bin')
+
+    def _index_path(self, hazard):
+        return os.path.join(self.archive_dir, hazard, 'index.npz')
+
+    def date_index(self, hazard):
+        """ Returns the sorted ingested dates (YYYYMMDD ints) of a hazard and the start and stop rows of each date. """
+        try:
+            with np.load(self._index_path(hazard)) as index:
+                return index['dates'], index['starts'], index['stops']
+        except FileNotFoundError:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    def _write_index(self, hazard, dates, starts, stops):
+        order = np.argsort(dates, kind='stable')
+        tmp_path = f'{self._index_path(hazard)}.tmp.npz'
+        np.savez(tmp_path, dates=dates[order], starts=starts[order], stops=stops[order])
+        os.replace(tmp_path, self._index_path(hazard))
+
+    def _column(self, hazard, column):
+        """ Memory-maps one column of every record of a hazard. """
+        column_path = self._column_path(hazard, column)
+        dtype = REPORT_DTYPE[column]
+        if not os.path.isfile(column_path) or os.path.getsize(column_path) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(column_path, dtype=dtype, mode='r')
+
+    def append_day(self, date, reports):
+        """
+        Appends one day of reports without rewriting the existing records.
+
+        Parameters
+        ----------
+        date: datetime.date
+        reports: dict
+            Maps each hazard to its REPORT_DTYPE records for the day.
+        """
+        for hazard in HAZARDS:
+            dates, starts, stops = self.date_index(hazard)
+            if _date_int(date) in dates:
+                continue
+            records = reports.get(hazard, np.empty(0, dtype=REPORT_DTYPE))
+            start = int(stops.max()) if len(stops) > 0 else 0  # Rows past the index were left by an interrupted append
+            for column in REPORT_DTYPE.names:
+                with open(self._column_path(hazard, column), 'ab') as f:
+                    f.truncate(start * REPORT_DTYPE[column].itemsize)
+                    f.write(np.ascontiguousarray(records[column]).tobytes())
+            self._write_index(hazard, np.append(dates, np.int32(_date_int(date))), np.append(starts, start), np.append(stops, start + len(records)))
+
+    def ingest(self, start_date, end_date, **storm_report_kwargs):
+        """
+        Adds every day in a date range (inclusive) that is not in the archive yet, loading reports through utils.StormReports.
+
+        Days SPC answers it has no reports for are recorded as empty so they are not requested again. Days whose reports
+        could not be loaded (not cached in offline mode, a failed download or a malformed report file) are left out, so a
+        later ingest retries them. So are today and yesterday, which SPC is still adding reports to.
+        **storm_report_kwargs are passed to utils.StormReports (cache_dir, offline, base_url).
+
+        Returns
+        -------
+        num_ingested: int
+            Number of days added.
+        failures: list of (datetime.date, str) tuples
+            Days whose reports failed to download or parse, and their tracebacks.
+        """
+        ingested_dates = set(self.date_index(HAZARDS[0])[0].tolist())
+        end_date = min(end_date, datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=2))  # Same cutoff as the report cache
+        num_ingested = 0
+        failures = []
+        date = start_date
+        while date <= end_date:
+            if _date_int(date) not in ingested_dates:
+                storm_reports = utils.StormReports(date.year, date.month, date.day, **storm_report_kwargs)
+                try:
+                    raw_reports = dict(torn=storm_reports.load_tornado_reports(filtered=False), wind=storm_reports.load_wind_reports(filtered=False),
+                                       hail=storm_reports.load_hail_reports(filtered=False))
+                    filtered_reports = dict(torn=storm_reports.load_tornado_reports(filtered=True), wind=storm_reports.load_wind_reports(filtered=True),
+                                            hail=storm_reports.load_hail_reports(filtered=True))
+                except FileNotFoundError:
+                    # In offline mode the reports are only missing from the cache, otherwise SPC has no report file for the day
+                    reports = None if storm_reports.offline else dict({})
+                except Exception:  # Failed download, or a report file that could not be parsed
+                    failures.append((date, traceback.format_exc()))
+                    reports = None
+                else:
+                    try:
+                        reports = {hazard: _to_records(raw_reports[hazard], filtered_reports[hazard], hazard, date) for hazard in HAZARDS}
+                    except Exception:
+                        failures.append((date, traceback.format_exc()))
+                        reports = None
+                if reports is not None:
+                    self.append_day(date, reports)
+                    num_ingested += 1
+            date += datetime.timedelta(days=1)
+        return num_ingested, failures
+
+    def reports(self, start_date, end_date, hazard, bbox=None, filtered=False, columns=None):
+        """
+        Returns the reports of a hazard between two dates (inclusive).
+
+        Parameters
+        ----------
+        start_date, end_date: datetime.date
+        hazard: str
+            'torn', 'wind' or 'hail'.
+        bbox: iterable with 4 floats or None
+            [min lon, max lon, min lat, max lat] to select reports in, with longitudes in [-180, 180] or [0, 360] like the
+            extents of settings.regions. If None, reports everywhere are returned.
+        filtered: bool
+            Only return reports in SPC's filtered report set.
+        columns: iterable of str or None
+            Fields of REPORT_DTYPE to return. If None, every field is returned. Columns that are neither returned nor
+            filtered on are never read.
+
+        Returns
+        -------
+        reports: np.ndarray
+            Records in date order, with the requested fields of REPORT_DTYPE.
+        """
+        if hazard not in HAZARDS:
+            raise ValueError(f"Unknown hazard: {hazard}. Valid hazards: {', '.join(HAZARDS)}")
+
+        dates, starts, stops = self.date_index(hazard)
+        first = np.searchsorted(dates, _date_int(start_date), side='left')
+        last = np.searchsorted(dates, _date_int(end_date), side='right')
+        starts, stops = starts[first:last], stops[first:last]
+
+        # Merge the row ranges of consecutive days stored next to each other, so a chronological archive needs one slice
+        ranges = []
+        for start, stop in zip(starts, stops):
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = stop
+            else:
+                ranges.append([start, stop])
+
+        columns = REPORT_DTYPE.names if columns is None else tuple(columns)
+        unknown_columns = set(columns) - set(REPORT_DTYPE.names)
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Unknown columns: {', '.join(sorted(unknown_columns))}. Valid columns: {', '.join(REPORT_DTYPE.names)}")
+
+        def read(column):
+            values = self._column(hazard, column)
+            if len(ranges) == 1:
+                return values[ranges[0][0]:ranges[0][1]]
+            return np.concatenate([values[start:stop] for start, stop in ranges] + [np.empty(0, dtype=values.dtype)])
+
+        rows = None  # Rows of the selected dates that pass the filters, or None for all of them
+        if bbox is not None or filtered:
+            mask = regions.points_in_extent(read('lon'), read('lat'), bbox) if bbox is not None else True
+            if filtered:
+                mask = mask & read('filtered')
+            rows = np.flatnonzero(mask)
+
+        selected = np.empty(sum(stop - start for start, stop in ranges) if rows is None else len(rows),
+                            dtype=np.dtype([(column, REPORT_DTYPE[column]) for column in columns]))
+        for column in columns:
+            selected[column] = read(column) if rows is None else read(column)[rows]
+        return selected
@@ -0,0 +1,444 @@
+"""
+Long-lived render server: renders outlook maps on request from warm worker processes and keeps recent images in memory.
+
+Maps are requested by path, e.g. /day1/20240426/1300/torn.png?reports=1&dpi=150 or /day1/20240426/1700/fire.webp?profile=webp.
+Query parameters:
+    reports=1         Include storm reports (convective products).
+    filtered=1        Use filtered storm reports (categorical and wind outlooks).
+    remove_unknowns=1 Remove wind reports with unknown speeds (categorical and wind outlooks).
+    region=<name>     Region in settings.regions. Custom extents are not served, since every extent caches its own basemap.
+    dpi=<int>         Resolution of the image. Defaults to settings.server_default_dpi.
+    profile=<name>    Render profile in settings.render_profiles, instead of 'dpi' and the extension.
+
+Web Mercator XYZ tiles (see tiles.py) are requested like /tiles/day1/20240426/1300/torn/5/7/12.png, and take the reports
+and filtered parameters. Tiles outside the outlook and its reports are transparent.
+
+Workers import the plotting stack and draw one background when they start, so a request only pays for its own map.
+Images are rendered into temporary directories that are deleted once their bytes are read, and kept in a least recently
+used cache bounded in bytes. Images with storm reports of the last couple of
+days, which SPC is still adding to, expire after settings.server_recent_ttl seconds.
+
+Run with: python server.py [--port 8080 | --socket /tmp/spc.sock]
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import settings
+
+PRODUCTS = ('cat', 'torn', 'wind', 'hail', 'fire')
+CONTENT_TYPES = dict(png='image/png', webp='image/webp', jpeg='image/jpeg', svg='image/svg+xml', pdf='application/pdf')
+FORMATS = dict(png='png', webp='webp', jpg='jpeg', jpeg='jpeg', svg='svg', pdf='pdf')  # Extension -> format
+
+
+class RenderRequest:
+    """ One map requested from the server. """
+    __slots__ = ('outlook_day', 'date', 'time', 'product', 'profile', 'include_reports', 'filtered_reports', 'remove_unknowns', 'region')
+
+    def __init__(self, outlook_day, date, time, product, profile, include_reports=False, filtered_reports=False, remove_unknowns=False, region=None):
+        """
+        outlook_day: int
+        date: datetime.date
+        time: int (HHMM)
+        product: str
+            'cat', 'torn', 'wind', 'hail' or 'fire'.
+        profile: dict
+            Render profile of the image (see settings.render_profiles).
+        include_reports, filtered_reports, remove_unknowns: bool
+        region: str or None
+            Name of a region in settings.regions.
+        """
+        self.outlook_day = outlook_day
+        self.date = date
+        self.time = time
+        self.product = product
+        self.profile = profile
+        self.include_reports = include_reports
+        self.filtered_reports = filtered_reports
+        self.remove_unknowns = remove_unknowns
+        self.region = region
+
+    @property
+    def key(self):
+        """ Hashable identity of the image, used as its cache key. """
+        return (self.outlook_day, self.date, self.time, self.product, tuple(sorted(self.profile.items())), self.include_reports, self.filtered_reports,
+                self.remove_unknowns, self.region)
+
+    @property
+    def recent(self):
+        """ Whether the image shows storm reports that may still change. """
+        return self.include_reports and self.date >= datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+
+    def __repr__(self):
+        return f"RenderRequest(day{self.outlook_day} {self.date:%Y-%m-%d} %04d UTC {self.product}, {self.profile['dpi']} dpi {self.profile['format']})" % self.time
+
+
+class TileRequest:
+    """ One XYZ tile requested from the server. """
+    __slots__ = ('outlook_day', 'date', 'time', 'product', 'tile', 'include_reports', 'filtered_reports', 'profile')
+
+    def __init__(self, outlook_day, date, time, product, tile, include_reports=False, filtered_reports=False):
+        """
+        outlook_day: int
+        date: datetime.date
+        time: int (HHMM)
+        product: str
+            'cat', 'torn', 'wind', 'hail' or 'fire'.
+        tile: tuple of 3 ints
+            (z, x, y) of the tile.
+        include_reports, filtered_reports: bool
+        """
+        self.outlook_day = outlook_day
+        self.date = date
+        self.time = time
+        self.product = product
+        self.tile = tile
+        self.include_reports = include_reports
+        self.filtered_reports = filtered_reports
+        self.profile = dict(format='png')
+
+    @property
+    def layers_key(self):
+        """ Identity of the layers the tile is drawn from, shared by every tile of the same outlook. """
+        return (self.outlook_day, self.date, self.time, self.product, self.include_reports, self.filtered_reports)
+
+    @property
+    def key(self):
+        return ('tile', ) + self.layers_key + (self.tile, )
+
+    @property
+    def recent(self):
+        return self.include_reports and self.date >= datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+
+    def __repr__(self):
+        return f"TileRequest(day{self.outlook_day} {self.date:%Y-%m-%d} %04d UTC {self.product}, tile %d/%d/%d)" % ((self.time, ) + self.tile)
+
+
+def _flag(query, name):
+    return query.get(name, ['0'])[-1].lower() in ('1', 'true', 'yes')
+
+
+def _parse_tile_request(parts, query):
+    """ Parses the parts of a tile path after /tiles, like day1/20240426/1300/torn/5/7/12.png. """
+    if len(parts) != 7 or not parts[0].startswith('day') or not parts[6].endswith('.png'):
+        raise ValueError('Tile paths must look like /tiles/day1/20240426/1300/torn/5/7/12.png')
+    product = parts[3]
+    if product not in PRODUCTS:
+        raise ValueError(f"Unknown product: {product}. Valid products: {', '.join(PRODUCTS)}")
+    try:
+        outlook_day = int(parts[0][3:])
+        date = datetime.datetime.strptime(parts[1], '%Y%m%d').date()
+        issuance_time = int(parts[2])
+        z, x, y = int(parts[4]), int(parts[5]), int(parts[6][:-4])
+    except ValueError:
+        raise ValueError('Tile paths must look like /tiles/day1/20240426/1300/torn/5/7/12.png')
+    if not 0 <= z <= settings.server_max_tile_zoom:
+        raise ValueError(f'Tile zoom levels must be between 0 and {settings.server_max_tile_zoom}')
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError(f'Tile {z}/{x}/{y} is outside the map')
+    return TileRequest(outlook_day, date, issuance_time, product, (z, x, y), include_reports=_flag(query, 'reports'),
+                       filtered_reports=_flag(query, 'filtered'))
+
+
+def parse_request(path):
+    """
+    Parses a request path like /day1/20240426/1300/torn.png?reports=1&dpi=150, or a tile path like
+    /tiles/day1/20240426/1300/torn/5/7/12.png.
+
+    Returns
+    -------
+    request: RenderRequest or TileRequest
+
+    Raises
+    ------
+    ValueError
+        - If the path or its parameters are invalid.
+    """
+    url = urlsplit(path)
+    parts = url.path.strip('/').split('/')
+    if parts[0] == 'tiles':
+        return _parse_tile_request(parts[1:], parse_qs(url.query))
+    if len(parts) != 4 or not parts[0].startswith('day') or '.' not in parts[3]:
+        raise ValueError('Request paths must look like /day1/20240426/1300/torn.png')
+    product, extension = parts[3].rsplit('.', 1)
+    if product not in PRODUCTS:
+        raise ValueError(f"Unknown product: {product}. Valid products: {', '.join(PRODUCTS)}")
+    if extension.lower() not in FORMATS:
+        raise ValueError(f"Unknown image format: {extension}. Valid formats: {', '.join(FORMATS)}")
+    try:
+        outlook_day = int(parts[0][3:])
+        date = datetime.datetime.strptime(parts[1], '%Y%m%d').date()
+        issuance_time = int(parts[2])
+    except ValueError:
+        raise ValueError('Request paths must look like /day1/20240426/1300/torn.png')
+
+    query = parse_qs(url.query)
+    if 'profile' in query:
+        name = query['profile'][-1]
+        if name not in settings.render_profiles:
+            raise ValueError(f"Unknown render profile: {name}. Valid profiles: {', '.join(settings.render_profiles)}")
+        profile = dict(settings.render_profiles[name])
+        if profile['format'] != FORMATS[extension.lower()]:
+            raise ValueError(f"Render profile {name} saves {profile['format']} images, not {extension}")
+    else:
+        dpi = int(query.get('dpi', [settings.server_default_dpi])[-1])
+        if not 0 < dpi <= settings.server_max_dpi:
+            raise ValueError(f'dpi must be between 1 and {settings.server_max_dpi}')
+        profile = dict(dpi=dpi, format=FORMATS[extension.lower()])
+    profile['suffix'] = ''
+
+    region = query.get('region', [None])[-1]
+    if region is not None and region not in settings.regions:
+        raise ValueError(f"Unknown region: {region}. Valid regions: {', '.join(settings.regions)}")
+
+    return RenderRequest(outlook_day, date, issuance_time, product, profile, include_reports=_flag(query, 'reports'), filtered_reports=_flag(query, 'filtered'),
+                         remove_unknowns=_flag(query, 'remove_unknowns'), region=region)
+
+
+def _init_worker():
+    """ Imports the plotting stack and draws one background, so every request renders with warm caches. """
+    global plot_outlooks, plt
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy.crs as ccrs
+    import matplotlib.pyplot as plt
+    import plot_outlooks
+    import regions
+
+    fig, ax = plt.subplots(1, 1, subplot_kw={'projection': ccrs.Miller(central_longitude=250)})
+    plot_outlooks.plot_background(regions.resolve_region()[0], ax=ax)
+    plt.close(fig)
+
+
+def render_image(request, outlook_kmz_dir, image_dir):
+    """
+    Renders a requested map in a worker process and returns the bytes of the image.
+
+    The image is saved through a render profile registered in this worker only, into a temporary subdirectory of
+    'image_dir' that is deleted once the image is read: the bytes live on in the server's ImageCache.
+    """
+    if 'plot_outlooks' not in globals():
+        _init_worker()
+    profile_name = f"server_{request.profile['format']}_{request.profile['dpi']}"
+    settings.render_profiles[profile_name] = request.profile
+    year, month, day = request.date.year, request.date.month, request.date.day
+
+    try:
+        with tempfile.TemporaryDirectory(dir=image_dir) as render_dir:
+            if request.product == 'fire':
+                paths = plot_outlooks.fire_outlook(request.outlook_day, year, month, day, request.time, outlook_kmz_dir, render_dir, profiles=[profile_name],
+                                                   region=request.region)
+            else:
+                paths = plot_outlooks.render_convective_products(request.outlook_day, year, month, day, request.time, outlook_kmz_dir, render_dir,
+                    products=(request.product, ), include_reports=request.include_reports, filtered_reports=request.filtered_reports,
+                    remove_unknowns=request.remove_unknowns, profiles=[profile_name], region=request.region)
+            with open(paths[0], 'rb') as f:
+                return f.read()
+    finally:
+        plt.close('all')  # A render that failed halfway leaves its figure open, which would pile up in a warm worker
+
+
+def render_tile(request, outlook_kmz_dir):
+    """
+    Renders a requested tile in a worker process and returns its PNG bytes. The worker keeps the figure of the last
+    outlook it drew tiles of (see tiles.py), so the tiles of a map that is being browsed only move the view.
+    """
+    global _tile_layers_key
+    import tiles
+    if 'plot_outlooks' not in globals():
+        _init_worker()
+    if globals().get('_tile_layers_key') != request.layers_key:
+        _tile_layers_key = None
+        year, month, day = request.date.year, request.date.month, request.date.day
+        layers, points = tiles.load_layers(request.outlook_day, year, month, day, request.time, outlook_kmz_dir, request.product,
+                                           request.include_reports, request.filtered_reports)
+        tiles._init_tile_worker(layers, points)
+        _tile_layers_key = request.layers_key
+    png = tiles._render_tiles([request.tile])[0][1]
+    return tiles.blank_tile() if png is None else png
+
+
+class ImageCache:
+    """ Thread-safe least recently used cache of images, bounded by their total size in bytes. """
+    __slots__ = ('max_bytes', 'num_bytes', '_entries', '_lock')
+
+    def __init__(self, max_bytes=settings.server_cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = collections.OrderedDict()  # key -> (image bytes, expiry time or None), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached image of a key, or None if it is not cached or has expired. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                self.num_bytes -= len(entry[0])
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, image, ttl=None):
+        """ Caches an image, for 'ttl' seconds if it is not None. Images larger than the whole cache are not kept. """
+        if len(image) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= len(self._entries.pop(key)[0])
+            self._entries[key] = (image, None if ttl is None else time.monotonic() + ttl)
+            self.num_bytes += len(image)
+            while self.num_bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.num_bytes -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RenderService:
+    """ Serves images from the cache, and renders the others on the worker pool. Concurrent requests for the same image share one render. """
+
+    def __init__(self, outlook_kmz_dir=settings.server_outlook_kmz_dir, image_dir=settings.server_image_dir, max_workers=settings.server_workers,
+                 cache_max_bytes=settings.server_cache_max_bytes):
+        self.outlook_kmz_dir = outlook_kmz_dir
+        self.image_dir = image_dir
+        self.cache = ImageCache(cache_max_bytes)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker)
+        self._pending = dict({})  # key -> Future of a render in progress
+        self._lock = threading.Lock()
+        os.makedirs(outlook_kmz_dir, exist_ok=True)
+        os.makedirs(image_dir, exist_ok=True)
+
+    def get(self, request):
+        """
+        Returns the image of a request and whether it came from the cache.
+
+        Raises
+        ------
+        FileNotFoundError
+            - If SPC does not have the outlook or storm reports.
+        ValueError
+            - If the outlook has no data for the product, or the request is invalid.
+        """
+        key = request.key
+        image = self.cache.get(key)
+        if image is not None:
+            return image, True
+
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                if isinstance(request, TileRequest):
+                    future = self.executor.submit(render_tile, request, self.outlook_kmz_dir)
+                else:
+                    future = self.executor.submit(render_image, request, self.outlook_kmz_dir, self.image_dir)
+                self._pending[key] = future
+        try:
+            image = future.result()
+        finally:
+            if owner:
+                with self._lock:
+                    del self._pending[key]
+        if owner:
+            self.cache.put(key, image, settings.server_recent_ttl if request.recent else None)
+        return image, False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """ Answers GET requests with images from the server's RenderService. """
+    server_version = 'SPCRender/1.0'
+
+    def do_GET(self):
+        try:
+            request = parse_request(self.path)
+            image, cached = self.server.service.get(request)
+        except FileNotFoundError as e:
+            self._send_error(HTTPStatus.NOT_FOUND, str(e))
+            return
+        except ValueError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        except OSError as e:  # Includes the network errors of requests, after download.py gave up retrying
+            self._send_error(HTTPStatus.BAD_GATEWAY, f'{type(e).__name__}: {e}')
+            return
+        except Exception as e:
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f'{type(e).__name__}: {e}')
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', CONTENT_TYPES[request.profile['format']])
+        self.send_header('Content-Length', str(len(image)))
+        self.send_header('Cache-Control', f'max-age={settings.server_recent_ttl}' if request.recent else 'max-age=86400')
+        self.send_header('X-Cache', 'hit' if cached else 'miss')
+        self.end_headers()
+        self.wfile.write(image)
+
+    def _send_error(self, status, message):
+        body = f'{message}\n'.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'  # Unix socket clients have no address
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server listening on a Unix socket. """
+    daemon_threads = True
+
+
+def make_server(service, port=settings.server_port, host=settings.server_host, socket_path=None):
+    """
+    Returns an HTTP server answering with a RenderService, listening on a Unix socket if 'socket_path' is given, or on
+    host:port otherwise. Call its serve_forever method to run it.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, RenderRequestHandler)
+    else:
+        httpd = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    httpd.service = service
+    return httpd
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve rendered SPC outlook maps over HTTP.')
+    parser.add_argument('--host', default=settings.server_host, help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=settings.server_port, help='Port to listen on.')
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port.')
+    parser.add_argument('--outlook_kmz_dir', default=settings.server_outlook_kmz_dir, help='Directory where the outlook kmz files will be stored.')
+    parser.add_argument('--image_dir', default=settings.server_image_dir, help='Directory where images are rendered before being cached in memory.')
+    parser.add_argument('--workers', type=int, default=settings.server_workers, help='Number of render worker processes.')
+    parser.add_argument('--cache_mb', type=float, default=settings.server_cache_max_bytes / 1024 ** 2, help='Size of the in-memory image cache in MB.')
+    args = parser.parse_args()
+
+    service = RenderService(args.outlook_kmz_dir, args.image_dir, max_workers=args.workers, cache_max_bytes=int(args.cache_mb * 1024 ** 2))
+    httpd = make_server(service, port=args.port, host=args.host, socket_path=args.socket)
+    print(f"Serving on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.shutdown()
@@ -1,6 +1,9 @@
-import matplotlib as mpl
+import os
+import sys
 
-mpl.rcParams['hatch.linewidth'] = 0.2
+# Plotting (applied by render.py, so importing settings never imports matplotlib)
+hatch_linewidth = 0.2  # Lines of the hatched significant severe areas
+matplotlib_backend = 'Agg' if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY') else None  # None lets matplotlib pick
 
 # Colors used in the SPC outlooks
 colors = dict({})
@@ -35,3 +38,113 @@ colors['Scattered DryT'] = dict({'outline': '#F10E16', 'fill': 'None'})  # Scatt
 
 valid_convective_outlook_times = [[1200, 1300, 1630, 2000, 100], [600, 1730], [730, ]]  # [[Day 1], [Day 2], [Day 3]]
 valid_fire_outlook_times = [[1200, 1700], [1200, 2000]]  # [[Day 1], [Day 2]]
+
+# Parsed outlook cache (see outlook_cache.py)
+parsed_outlook_cache_dir = '.parsed'  # Subdirectory of the outlook kmz directory where parsed outlooks are cached
+parsed_outlook_cache_max_bytes = 256 * 1024 ** 2  # Least recently used entries are evicted past this size
+
+# Basemap cache (see basemap.py)
+basemap_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'basemap')  # Projected coastlines, borders and states; None to only cache in memory
+basemap_memory_cache_size = 16  # Extents whose projected paths are kept in memory, least recently used first
+
+# Batch rendering (see batch.py)
+batch_max_workers = None  # Number of worker processes; None uses one per CPU
+pipeline_fetch_workers = 4  # Simultaneous outlook downloads in batch.render_pipeline
+pipeline_parse_workers = 1  # Parsing is light next to rendering, one thread keeps up with several render processes
+pipeline_queue_size = 16  # Outlooks waiting between two pipeline stages
+
+# Downloads (see download.py)
+spc_base_url = 'https://www.spc.noaa.gov'
+download_timeout = 30  # seconds
+download_retries = 4
+download_backoff_factor = 0.5  # Retries wait 0.5, 1, 2, 4... seconds
+download_max_workers = 8  # Connections kept open to the server, and simultaneous downloads in download.fetch_many
+download_lock_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'locks')  # Lock files of downloads, kept out of the data directories
+
+# Storm report cache (see utils.StormReports)
+storm_report_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'reports')  # None to always download reports
+storm_reports_offline = False  # Only read reports from the cache, never from the network
+
+# Outlook grids (see rasterize.py)
+raster_projection = dict(central_longitude=265, standard_parallels=(25, 25))  # Lambert conformal, like the NCEP 80 km and 40 km CONUS grids
+raster_extent = [233, 295, 20, 50]  # Area covered by the grids, [min lon, max lon, min lat, max lat]
+raster_grid_spacing = 80  # km
+
+# Practically perfect hindcasts (see practically_perfect.py)
+practically_perfect_sigma_km = 120  # Standard deviation of the Gaussian smoothing kernel
+
+# Point queries (see query.py)
+point_query_bucket_degrees = 1.0  # Size of the lon/lat buckets of the outlook spatial indexes
+point_query_index_cache_size = 256  # Issuance indexes kept in memory per process
+
+# Map tiles (see tiles.py)
+tile_size = 256  # pixels
+tile_zooms = range(3, 9)  # Zoom levels rendered by default
+tile_compress_level = 6  # PNG zlib level (0-9)
+
+# Render profiles (see render.py). 'suffix' is appended to the image name; formats: png, webp, jpeg, svg, pdf
+render_profiles = dict({})
+render_profiles['full'] = dict({'dpi': 1000, 'format': 'png', 'compress_level': 6, 'suffix': ''})  # Full resolution, as the maps were always saved
+render_profiles['print'] = dict({'dpi': 300, 'format': 'png', 'compress_level': 6, 'suffix': '_print'})
+render_profiles['web'] = dict({'dpi': 150, 'format': 'png', 'compress_level': 3, 'suffix': '_web'})
+render_profiles['webp'] = dict({'dpi': 150, 'format': 'webp', 'quality': 85, 'suffix': '_web'})
+render_profiles['thumbnail'] = dict({'dpi': 40, 'format': 'png', 'compress_level': 6, 'suffix': '_thumb'})
+render_profiles['svg'] = dict({'dpi': 300, 'format': 'svg', 'suffix': ''})
+render_profiles['pdf'] = dict({'dpi': 300, 'format': 'pdf', 'suffix': ''})
+
+# Render profiles saved for each product when none are requested
+product_render_profiles = dict({'default': ['full']})
+product_render_profiles['cat'] = ['full']
+product_render_profiles['torn'] = ['full']
+product_render_profiles['wind'] = ['full']
+product_render_profiles['hail'] = ['full']
+product_render_profiles['fire'] = ['full']
+product_render_profiles['pph'] = ['full']  # Practically perfect hindcasts
+product_render_profiles['climatology'] = ['full']
+
+# Polygon simplification (see simplify.py)
+lod_tolerance_pixels = 0.5  # Outlines move by at most this many pixels at the highest dpi saved; None to draw every vertex
+lod_cache_size = 512  # Simplified geometries kept in memory per process
+
+# Map regions (see regions.py), as [min lon, max lon, min lat, max lat]. Add CWAs or custom areas here to render them by name.
+regions = dict({})
+regions['CONUS'] = [233, 295, 20, 50]
+regions['Northwest'] = [233, 253, 40, 50]
+regions['Southwest'] = [236, 256, 30, 42.5]
+regions['NorthernPlains'] = [251, 266, 39.5, 49.5]
+regions['SouthernPlains'] = [252, 267, 25.5, 40.5]
+regions['Midwest'] = [262, 278, 36, 49.5]
+regions['Southeast'] = [268, 285, 24, 37.5]
+regions['Northeast'] = [279, 293, 37, 48]
+regions['TX'] = [253, 267, 25.5, 36.7]
+regions['OK'] = [256.8, 265.6, 33.4, 37.2]
+regions['KS'] = [257.8, 265.6, 36.8, 40.2]
+regions['NE'] = [255.8, 264.6, 39.8, 43.2]
+regions['IA'] = [263.5, 270, 40.2, 43.7]
+regions['MS'] = [268.2, 272, 30, 35.2]
+regions['AL'] = [271.4, 275.2, 30, 35.2]
+regions['FL'] = [272.4, 280.2, 24.3, 31.2]
+default_region = 'CONUS'  # Images of the default region have no region suffix in their names
+region_clip_padding = 0.1  # Polygons are clipped this fraction of the map's width and height outside its edges
+
+# Render deduplication (see fingerprint.py)
+render_dedupe = None  # Reuse unchanged maps: 'retitle' copies them with the new title, 'link' symlinks them (keeping the old title), None always draws
+render_manifest_filename = 'render_manifest.jsonl'  # Manifest of the saved images in each image directory
+
+# Render server (see server.py)
+server_host = '127.0.0.1'
+server_port = 8080
+server_workers = 2  # Warm render worker processes
+server_cache_max_bytes = 256 * 1024 ** 2  # Least recently used images are evicted past this size
+server_recent_ttl = 600  # Seconds before images with storm reports of the last couple of days are rendered again
+server_default_dpi = 150
+server_max_dpi = 1000
+server_max_tile_zoom = 12  # Deepest zoom level of the tiles rendered on request
+server_outlook_kmz_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'kmz')
+server_image_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'server')  # Images are only written there while they are rendered
+
+# Render instrumentation (see instrument.py)
+instrument_format = None  # None (disabled), 'jsonl' (one record per render) or 'prometheus' (one text file per process)
+instrument_dir = os.path.join(os.path.expanduser('~'), '.cache', 'SPC', 'metrics')
+instrument_jsonl_filename = 'render_metrics.jsonl'
+instrument_tracemalloc = False  # Also record the peak Python allocations of every stage, at the cost of much slower renders
@@ -0,0 +1,123 @@
+"""
+Level-of-detail simplification of projected outlook rings.
+
+Rings are simplified with a vectorized Douglas-Peucker pass: every ring of a drawing is processed at once, and each
+iteration splits all the spans whose farthest vertex is off by more than the tolerance. Vertices shared by several rings
+(where nested risk levels meet) are always kept, so shared boundaries are split at the same vertices and simplified the same
+way in every ring. Boundaries that are not shared move by less than the tolerance, which is kept below a pixel, so nested
+levels stay nested wherever they are drawn apart.
+
+Results are cached per geometry and tolerance. Tolerances are rounded down to a power of two so that nearby resolutions
+share cache entries.
+"""
+
+import collections
+import hashlib
+import numpy as np
+import settings
+
+_cache = collections.OrderedDict()  # (geometry hash, tolerance) -> simplified layers, least recently used first
+
+
+def _segment_distances(xy, starts, ends):
+    """ Distance from each point to the segment between its span's start and end points. """
+    a, b = xy[starts], xy[ends]
+    ab = b - a
+    length2 = np.einsum('ij,ij->i', ab, ab)
+    t = np.clip(np.einsum('ij,ij->i', xy - a, ab) / np.where(length2 > 0, length2, 1), 0, 1)
+    return np.hypot(*(xy - (a + t[:, None] * ab)).T)
+
+
+def _douglas_peucker(xy, keep, tolerance):
+    """
+    Marks the vertices to keep in concatenated polylines.
+
+    Parameters
+    ----------
+    xy: np.ndarray
+        (N, 2) concatenated vertices.
+    keep: np.ndarray of bools
+        Vertices that must be kept, which include the first and last vertex of every polyline. Updated in place.
+    tolerance: float
+        Maximum distance between a removed vertex and the simplified line.
+    """
+    indexes = np.arange(len(xy))
+    while True:
+        anchors = np.flatnonzero(keep)
+        span = np.searchsorted(anchors, indexes, side='right') - 1
+        span = np.minimum(span, len(anchors) - 2)
+        distances = _segment_distances(xy, anchors[span], anchors[span + 1])
+        distances[keep] = -1
+
+        # Farthest vertex of every span: sort by span, then by decreasing distance, and take the first vertex of each span
+        order = np.lexsort((-distances, span))
+        first = order[np.r_[True, span[order][1:] != span[order][:-1]]]
+        split = first[distances[first] > tolerance]
+        if len(split) == 0:
+            return keep
+        keep[split] = True
+
+
+def _shared_vertices(rings):
+    """ Returns, for the concatenated rings, which vertices also appear in another ring. """
+    vertices = np.concatenate(rings)
+    ring_ids = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+    _, vertex_ids = np.unique(vertices, axis=0, return_inverse=True)
+    vertex_ids = vertex_ids.ravel()
+    # Count the distinct rings each vertex appears in
+    pairs = np.unique(np.column_stack([vertex_ids, ring_ids]), axis=0)
+    ring_counts = np.bincount(pairs[:, 0], minlength=vertex_ids.max() + 1)
+    return ring_counts[vertex_ids] > 1
+
+
+def simplify_rings(layers, tolerance):
+    """
+    Simplifies the projected rings of several layers drawn together.
+
+    Parameters
+    ----------
+    layers: list of lists of np.ndarray
+        Rings of (x, y) projected coordinates of each layer (e.g. each risk level of a product).
+    tolerance: float or None
+        Maximum displacement of the outlines, in projected units. If None or 0, the rings are returned unchanged.
+
+    Returns
+    -------
+    layers: list of lists of np.ndarray
+        Simplified rings, in the same structure. Rings that would collapse below 3 distinct vertices are kept as they are.
+    """
+    rings = [ring for layer in layers for ring in layer]
+    if tolerance is None or tolerance <= 0 or len(rings) == 0:
+        return layers
+
+    tolerance = 2. ** np.floor(np.log2(tolerance))
+    sizes = [len(ring) for ring in rings]
+    digest = hashlib.sha1(np.asarray(sizes + [len(layer) for layer in layers], dtype=np.int64).tobytes())
+    for ring in rings:
+        digest.update(np.ascontiguousarray(ring, dtype=np.float64).tobytes())
+    key = (digest.hexdigest(), tolerance)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    xy = np.concatenate(rings).astype(np.float64)
+    starts = np.cumsum([0] + sizes[:-1])
+    keep = _shared_vertices(rings)
+    keep[starts] = True
+    keep[starts + np.array(sizes) - 1] = True
+    _douglas_peucker(xy, keep, tolerance)
+
+    simplified_rings = []
+    for ring, ring_xy, ring_keep in zip(rings, np.split(xy, starts[1:]), np.split(keep, starts[1:])):
+        kept = ring_xy[ring_keep]
+        # A closed ring repeats its first vertex at the end, so 3 kept vertices can still be a degenerate back-and-forth line
+        simplified_rings.append(kept if len(kept) >= 3 and len(np.unique(kept, axis=0)) >= 3 else ring)
+    simplified = []
+    for layer in layers:
+        simplified.append(simplified_rings[:len(layer)])
+        simplified_rings = simplified_rings[len(layer):]
+
+    _cache[key] = simplified
+    while len(_cache) > settings.lod_cache_size:
+        _cache.popitem(last=False)
+    return simplified
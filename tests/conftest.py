@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # The modules live at the top of the repository
+
+import matplotlib
+
+matplotlib.use('Agg')
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import kml
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('-99.5,36.25 -98,35', [[-99.5, 36.25], [-98, 35]]),
+    ('-99.5,36.25,0 -98,35,120.5', [[-99.5, 36.25, 0], [-98, 35, 120.5]]),
+    ('\n\t\t-99.5,36.25,0\n\t\t-98,35,0\n\t', [[-99.5, 36.25, 0], [-98, 35, 0]]),
+    ('-99.5, 36.25, 0   -98 ,35 , 0', [[-99.5, 36.25, 0], [-98, 35, 0]]),
+    ('-99.5,36.25\r\n-98,35', [[-99.5, 36.25], [-98, 35]]),
+])
+def test_parse_coordinates(text, expected):
+    coordinates = kml.parse_coordinates(text)
+    assert coordinates.dtype == np.float64
+    np.testing.assert_array_equal(coordinates, expected)
+
+
+@pytest.mark.parametrize('text', [None, '', ' \n\t'])
+def test_parse_empty_coordinates(text):
+    assert kml.parse_coordinates(text).shape == (0, 2)
@@ -0,0 +1,76 @@
+import zipfile
+import numpy as np
+import pytest
+import plot_outlooks
+import settings
+import utils
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+
+# Combined report csv of a day whose reports are all in Oklahoma, far from the Northeast region
+REPORTS_CSV = '''Time,F_Scale,Location,County,State,Lat,Lon,Comments
+2100,UNK,A,B,OK,36.1,-99.2,x
+Time,Speed,Location,County,State,Lat,Lon,Comments
+2110,UNK,A,B,OK,36.2,-99.1,x
+2120,80,A,B,OK,35.9,-98.9,x
+Time,Size,Location,County,State,Lat,Lon,Comments
+2130,100,A,B,OK,36.0,-99.0,x
+2140,250,A,B,OK,36.3,-98.8,x
+'''
+
+
+def _ring(lon, lat, radius):
+    angles = np.linspace(0, 2 * np.pi, 30)
+    points = np.column_stack([lon + radius * np.cos(angles), lat + radius * np.sin(angles)])
+    points[-1] = points[0]
+    return ' '.join('%.3f,%.3f' % tuple(point) for point in points)
+
+
+def _placemark(name, description, radius):
+    return (f'<Placemark><name>{name}</name><ExtendedData><SchemaData><SimpleData name="LABEL2">{description}</SimpleData></SchemaData></ExtendedData>'
+            f'<Polygon><outerBoundaryIs><LinearRing><coordinates>{_ring(-99, 36, radius)}</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>')
+
+
+def _folder(name, placemarks):
+    return f'<Folder><name>{name}</name>{"".join(placemarks)}</Folder>'
+
+
+@pytest.fixture
+def outlook_kmz_dir(tmp_path):
+    """ Directory holding a small day 1 convective outlook for 2024-04-26 1300 UTC, centered on Oklahoma. """
+    stem = 'day1otlk_20240426_1300'
+    folders = [_folder(f'{stem}_cat', [_placemark('TSTM', 'General Thunderstorms Risk', 6), _placemark('MRGL', '1: Marginal Risk', 4)]),
+               _folder(f'{stem}_torn', [_placemark('2 %', '2% Tornado Risk', 4)]), _folder(f'{stem}_sigtorn', []),
+               _folder(f'{stem}_wind', [_placemark('5 %', '5% Wind Risk', 4)]), _folder(f'{stem}_sigwind', []),
+               _folder(f'{stem}_hail', [_placemark('5 %', '5% Hail Risk', 4)]), _folder(f'{stem}_sighail', [])]
+    kml = f'<?xml version="1.0" encoding="UTF-8"?><kml xmlns="{KML_NAMESPACE}"><Document>{"".join(folders)}</Document></kml>'
+    with zipfile.ZipFile(tmp_path / f'{stem}.kmz', 'w') as kmz:
+        kmz.writestr(f'{stem}.kml', kml)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def storm_reports(tmp_path):
+    reports = utils.StormReports(2024, 4, 26, cache_dir=str(tmp_path / 'reports'), offline=True)
+    sections = utils._parse_combined_reports(REPORTS_CSV)
+    reports._write_cache('', sections)
+    reports._write_cache('_filtered', sections)
+    return reports
+
+
+@pytest.fixture(autouse=True)
+def small_images(monkeypatch):
+    monkeypatch.setitem(settings.render_profiles, 'test', dict({'dpi': 40, 'format': 'png', 'compress_level': 1, 'suffix': ''}))
+    monkeypatch.setattr(settings, 'render_dedupe', None)
+
+
+@pytest.mark.parametrize('product', ['cat', 'torn', 'wind', 'hail'])
+def test_region_without_reports(product, outlook_kmz_dir, storm_reports, tmp_path):
+    """ Products with storm reports render when every report of the day is outside the region. """
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    plot = dict(cat=plot_outlooks.categorical_convective_outlook, torn=plot_outlooks.tornado_outlook, wind=plot_outlooks.wind_outlook,
+                hail=plot_outlooks.hail_outlook)[product]
+    paths = plot(1, 2024, 4, 26, 1300, outlook_kmz_dir, str(image_dir), include_reports=True, storm_reports=storm_reports, profiles=['test'],
+                 region='Northeast')
+    assert len(paths) == 1 and paths[0].endswith(f'_{product}_Northeast.png')
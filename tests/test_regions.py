@@ -0,0 +1,45 @@
+import numpy as np
+import regions
+
+
+def _square(min_lon, max_lon, min_lat, max_lat):
+    return np.array([[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]], dtype=np.float64)
+
+
+def _area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+EXTENT = [-100, -90, 30, 40]
+
+
+def test_ring_inside_is_kept_as_is():
+    ring = _square(-98, -92, 32, 38)
+    clipped = regions.clip_rings([ring], EXTENT, padding=0)
+    assert len(clipped) == 1 and clipped[0] is ring
+
+
+def test_ring_outside_is_dropped():
+    assert regions.clip_rings([_square(-80, -70, 32, 38), _square(-98, -92, 45, 50)], EXTENT, padding=0) == []
+
+
+def test_straddling_ring_is_clipped_to_the_padded_extent():
+    clipped = regions.clip_rings([_square(-105, -95, 35, 45)], EXTENT, padding=0.1)
+    assert len(clipped) == 1
+    ring = clipped[0]
+    # Padded box: [-101, -89, 29, 41]
+    assert ring[:, 0].min() == -101 and ring[:, 0].max() == -95 and ring[:, 1].min() == 35 and ring[:, 1].max() == 41
+    assert np.isclose(_area(ring), 6 * 6)
+
+
+def test_ring_covering_the_extent_is_clipped_to_a_box():
+    clipped = regions.clip_rings([_square(-120, -70, 20, 50)], EXTENT, padding=0)
+    assert len(clipped) == 1
+    assert np.isclose(_area(clipped[0]), 10 * 10)
+
+
+def test_extent_in_0_360_longitudes():
+    ring = _square(-98, -92, 32, 38)
+    assert len(regions.clip_rings([ring], [260, 270, 30, 40], padding=0)) == 1
+    np.testing.assert_array_equal(regions.points_in_extent([-95, 265, -80], [35, 35, 35], [260, 270, 30, 40]), [True, True, False])
@@ -0,0 +1,106 @@
+import datetime
+import http.server
+import threading
+import numpy as np
+import pytest
+import report_archive
+import utils
+
+# Combined report csv of a day: 1 tornado, 2 wind and 2 hail reports. Only the first wind report is also filtered.
+REPORTS_CSV = '''Time,F_Scale,Location,County,State,Lat,Lon,Comments
+2100,1,A,B,OK,36.1,-99.2,x
+Time,Speed,Location,County,State,Lat,Lon,Comments
+2110,UNK,A,B,OK,36.2,-99.1,x
+2120,80,A,B,NY,42.9,-75.1,x
+Time,Size,Location,County,State,Lat,Lon,Comments
+2130,100,A,B,OK,36.0,-99.0,x
+2140,250,A,B,OK,36.3,-98.8,x
+'''
+FILTERED_CSV = '\n'.join(line for line in REPORTS_CSV.splitlines() if ',NY,' not in line) + '\n'
+
+
+def _records(date, lats):
+    records = np.zeros(len(lats), dtype=report_archive.REPORT_DTYPE)
+    records['date'] = report_archive._date_int(date)
+    records['lat'] = lats
+    records['lon'] = -99.
+    return records
+
+
+def _cache_reports(cache_dir, date):
+    reports = utils.StormReports(date.year, date.month, date.day, cache_dir=cache_dir, offline=True)
+    reports._write_cache('', utils._parse_combined_reports(REPORTS_CSV))
+    reports._write_cache('_filtered', utils._parse_combined_reports(FILTERED_CSV))
+
+
+def test_append_and_query(tmp_path):
+    archive = report_archive.ReportArchive(str(tmp_path))
+    days = [datetime.date(2024, 4, 25) + datetime.timedelta(days=n) for n in range(3)]
+    archive.append_day(days[2], dict(torn=_records(days[2], [40., 41.])))
+    archive.append_day(days[0], dict(torn=_records(days[0], [30.])))
+    archive.append_day(days[1], dict(torn=_records(days[1], [35., 36., 37.])))
+    archive.append_day(days[1], dict(torn=_records(days[1], [0.])))  # Already in the archive: ignored
+
+    torn = archive.reports(days[0], days[2], 'torn')
+    assert torn.dtype == report_archive.REPORT_DTYPE
+    np.testing.assert_array_equal(torn['lat'], [30., 35., 36., 37., 40., 41.])  # In date order, whatever the order of the appends
+    np.testing.assert_array_equal(archive.reports(days[1], days[2], 'torn', columns=['lat'])['lat'], [35., 36., 37., 40., 41.])
+    assert archive.reports(days[1], days[2], 'torn', columns=['lat']).dtype.names == ('lat', )
+    assert len(archive.reports(days[0], days[2], 'torn', bbox=[-100, -98, 34, 38])) == 3
+    assert len(archive.reports(days[0], days[2], 'hail')) == 0  # Hazards without reports are recorded as empty days
+    assert len(archive.reports(datetime.date(2020, 1, 1), datetime.date(2020, 12, 31), 'wind')) == 0
+    with pytest.raises(ValueError):
+        archive.reports(days[0], days[2], 'torn', columns=['speed'])
+
+
+def test_incremental_ingest(tmp_path):
+    cache_dir = str(tmp_path / 'reports')
+    days = [datetime.date(2024, 4, 26), datetime.date(2024, 4, 27)]
+    _cache_reports(cache_dir, days[0])
+    archive = report_archive.ReportArchive(str(tmp_path / 'archive'))
+
+    # Offline, the day that is not cached yet is left out rather than recorded as a day without reports
+    assert archive.ingest(days[0], days[1], cache_dir=cache_dir, offline=True) == (1, [])
+    np.testing.assert_array_equal(archive.date_index('wind')[0], [20240426])
+    wind = archive.reports(days[0], days[0], 'wind')
+    np.testing.assert_array_equal(wind['filtered'], [True, False])
+    assert np.isnan(wind['magnitude'][0]) and wind['magnitude'][1] == 80
+    np.testing.assert_array_equal(archive.reports(days[0], days[0], 'hail')['magnitude'], [100, 250])
+
+    _cache_reports(cache_dir, days[1])
+    assert archive.ingest(days[0], days[1], cache_dir=cache_dir, offline=True) == (1, [])  # Only the new day is added
+    assert len(archive.reports(days[0], days[1], 'wind')) == 4
+    assert len(archive.reports(days[0], days[1], 'wind', filtered=True)) == 2
+
+
+@pytest.fixture
+def malformed_report_server():
+    """ Local server answering every report request with a truncated combined csv. """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b'Time,F_Scale,Location,County,State,Lat,Lon,Comments\n2100,1,A,B,OK,36.1,-99.2,x\n'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_ingest_reports_malformed_days(tmp_path, malformed_report_server):
+    cache_dir = str(tmp_path / 'reports')
+    days = [datetime.date(2024, 4, 26), datetime.date(2024, 4, 27)]
+    _cache_reports(cache_dir, days[1])
+    archive = report_archive.ReportArchive(str(tmp_path / 'archive'))
+
+    num_ingested, failures = archive.ingest(days[0], days[1], cache_dir=cache_dir, offline=False, base_url=malformed_report_server)
+    assert num_ingested == 1
+    assert [date for date, _ in failures] == [days[0]] and "KeyError: 'wind'" in failures[0][1]
+    np.testing.assert_array_equal(archive.date_index('torn')[0], [20240427])  # The malformed day is retried by the next ingest
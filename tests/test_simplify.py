@@ -0,0 +1,38 @@
+import numpy as np
+import simplify
+
+
+def _circle(radius, num_vertices=200, center=(0., 0.)):
+    angles = np.linspace(0, 2 * np.pi, num_vertices)
+    ring = np.column_stack([center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)])
+    ring[-1] = ring[0]
+    return ring
+
+
+def test_shared_vertices_are_kept():
+    """ Vertices on a boundary shared by two rings survive in both, even where a single ring would drop them. """
+    outer = _circle(10.)
+    # The inner ring follows the outer one along its upper half, then closes along the x axis
+    inner = np.vstack([outer[:101], [[0., 0.]], outer[:1]])
+    simplified_outer, simplified_inner = [layer[0] for layer in simplify.simplify_rings([[outer], [inner]], 0.5)]
+
+    shared = {tuple(vertex) for vertex in outer[:101]}
+    kept_outer = {tuple(vertex) for vertex in simplified_outer} & shared
+    kept_inner = {tuple(vertex) for vertex in simplified_inner} & shared
+    assert kept_outer == kept_inner == shared
+    assert len(simplified_outer) < len(outer)
+
+
+def test_rings_keep_3_distinct_vertices():
+    """ Rings thinner than the tolerance are kept whole instead of collapsing to a back-and-forth line. """
+    sliver = np.array([[0., 0.], [5., 0.01], [10., 0.], [5., -0.01], [0., 0.]])
+    rings = [layer[0] for layer in simplify.simplify_rings([[sliver], [_circle(10.)]], 1.)]
+    for ring in rings:
+        assert len(np.unique(ring, axis=0)) >= 3
+    np.testing.assert_array_equal(rings[0], sliver)
+
+
+def test_no_tolerance_returns_the_rings():
+    layers = [[_circle(1.)]]
+    assert simplify.simplify_rings(layers, None) is layers
+    assert simplify.simplify_rings(layers, 0) is layers
@@ -0,0 +1,345 @@
+"""
+Outlooks as Web Mercator XYZ map tiles.
+
+Only tiles under the outlook polygons (and storm reports, if included) are rendered. Blank tiles are dropped and identical
+tiles (e.g. the solid tiles inside a large risk area) are stored once: as hard links in a tile directory, or as one row of
+the images table of an MBTiles file. The render server (see server.py) also renders single tiles on request.
+"""
+
+import functools
+import hashlib
+import io
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from PIL import Image
+import pyproj
+import outlook
+import settings
+import utils
+
+EARTH_HALF_CIRCUMFERENCE = 20037508.342789244  # Half the width of the Web Mercator world, in meters
+MAX_LATITUDE = 85.0511287798  # Latitude of the top edge of the Web Mercator world
+
+_REPORT_STYLES = dict(torn=dict(facecolor='red'), wind=dict(facecolor='blue'), hail=dict(facecolor='green'))
+_REPORT_LOADERS = dict(torn='load_tornado_reports', wind='load_wind_reports', hail='load_hail_reports')
+
+_figure = None  # Figure of a tile worker, with every layer already drawn on it
+
+
+@functools.lru_cache(maxsize=None)
+def _transformer(inverse=False):
+    """ Transforms geographic coordinates to Web Mercator, or back if inverse. pyproj, so tile workers never load cartopy. """
+    crs = ('EPSG:3857', 'EPSG:4326')
+    return pyproj.Transformer.from_crs(*(crs if inverse else crs[::-1]), always_xy=True)
+
+
+def _to_mercator(lons, lats):
+    x, y = _transformer().transform(np.asarray(lons, dtype=np.float64), np.clip(np.asarray(lats, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    return np.column_stack([np.ravel(x), np.ravel(y)])
+
+
+def tile_bounds(z, x, y):
+    """ Returns the [min x, max x, min y, max y] Web Mercator bounds (m) of an XYZ tile. """
+    size = 2 * EARTH_HALF_CIRCUMFERENCE / 2 ** z
+    return [-EARTH_HALF_CIRCUMFERENCE + x * size, -EARTH_HALF_CIRCUMFERENCE + (x + 1) * size,
+            EARTH_HALF_CIRCUMFERENCE - (y + 1) * size, EARTH_HALF_CIRCUMFERENCE - y * size]
+
+
+def covering_tiles(bounds, zooms, pad_pixels=2):
+    """
+    Returns the XYZ tiles touched by a set of bounding boxes.
+
+    Parameters
+    ----------
+    bounds: np.ndarray
+        (N, 4) array of [min x, min y, max x, max y] Web Mercator bounding boxes.
+    zooms: iterable of ints
+        Zoom levels.
+    pad_pixels: int
+        Margin added around every box, in pixels at each zoom, so outlines and markers that spill over a tile edge are kept.
+
+    Returns
+    -------
+    tiles: list of (z, x, y) tuples
+    """
+    tiles = set()
+    for z in zooms:
+        size = 2 * EARTH_HALF_CIRCUMFERENCE / 2 ** z
+        pad = pad_pixels * size / settings.tile_size
+        x0 = np.floor((bounds[:, 0] - pad + EARTH_HALF_CIRCUMFERENCE) / size).astype(np.int64).clip(0, 2 ** z - 1)
+        x1 = np.floor((bounds[:, 2] + pad + EARTH_HALF_CIRCUMFERENCE) / size).astype(np.int64).clip(0, 2 ** z - 1)
+        y0 = np.floor((EARTH_HALF_CIRCUMFERENCE - bounds[:, 3] - pad) / size).astype(np.int64).clip(0, 2 ** z - 1)
+        y1 = np.floor((EARTH_HALF_CIRCUMFERENCE - bounds[:, 1] + pad) / size).astype(np.int64).clip(0, 2 ** z - 1)
+        for box in zip(x0, x1, y0, y1):
+            tiles.update((z, x, y) for x in range(box[0], box[1] + 1) for y in range(box[2], box[3] + 1))
+    return sorted(tiles)
+
+
+def outlook_layers(folders, product):
+    """
+    Returns the polygon layers of an outlook product in Web Mercator, styled like the plot_outlooks maps.
+
+    Returns
+    -------
+    layers: list of (list of np.ndarray, dict) tuples
+        Closed rings of each layer (lowest risk first) and the PathCollection styling of the layer.
+    """
+    levels, significant_rings = outlook.risk_levels(folders, product)
+    layers = []
+    for level, rings in levels.items():
+        style = dict(facecolor=settings.colors[level]['fill'], edgecolor=settings.colors[level]['outline'], linewidth=0.5)
+        if level in outlook.DRY_THUNDER_LEVELS:
+            style.update(linewidth=0.7, linestyle='--')
+        layers.append((rings, style))
+    if len(significant_rings) > 0:
+        layers.append((significant_rings, dict(facecolor='None', edgecolor='#000000', hatch='/////', linewidth=0.5)))
+
+    projected_layers = []
+    for rings, style in layers:
+        rings = [ring for ring in rings if len(ring) >= 3]
+        if len(rings) == 0:
+            continue
+        xy = _to_mercator(np.concatenate([ring[:, 0] for ring in rings]), np.concatenate([ring[:, 1] for ring in rings]))
+        projected_layers.append(([np.vstack([ring, ring[:1]]) for ring in np.split(xy, np.cumsum([len(ring) for ring in rings])[:-1])], style))
+    return projected_layers
+
+
+def report_points(storm_reports, product, filtered=False):
+    """ Returns the Web Mercator coordinates of the storm reports drawn over a product, with their marker styling. """
+    hazards = _REPORT_LOADERS if product == 'cat' else (product, )
+    points = []
+    for hazard in hazards:
+        reports = getattr(storm_reports, _REPORT_LOADERS[hazard])(filtered=filtered)
+        points.append((_to_mercator(reports['Lon'].values, reports['Lat'].values), _REPORT_STYLES[hazard]))
+    return points
+
+
+def load_layers(outlook_day, year, month, day, time, outlook_kmz_dir, product='cat', include_reports=False, filtered_reports=False,
+    folders=None, storm_reports=None):
+    """
+    Loads an outlook (and the storm reports of its day, if included) and returns its layers and report points in Web
+    Mercator. See render_tiles for the parameters.
+    """
+    if folders is None:
+        load = outlook.load_fire_outlook if product == 'fire' else outlook.load_convective_outlook
+        folders = load(outlook_day, year, month, day, time, outlook_kmz_dir)
+    layers = outlook_layers(folders, product)
+    points = []
+    if include_reports and product != 'fire':
+        if storm_reports is None:
+            storm_reports = utils.StormReports(year, month, day)
+        points = report_points(storm_reports, product, filtered_reports)
+    return layers, points
+
+
+def blank_tile():
+    """ Returns the PNG bytes of a transparent tile. """
+    png = io.BytesIO()
+    Image.new('RGBA', (settings.tile_size, settings.tile_size)).save(png, format='PNG')
+    return png.getvalue()
+
+
+def _init_tile_worker(layers, points):
+    """ Draws every layer once on a tile-sized transparent figure. Each tile then only moves the view and redraws. """
+    global _figure
+    matplotlib.rcParams['hatch.linewidth'] = settings.hatch_linewidth
+    inches = settings.tile_size / 72  # One point per pixel, so line widths match the full-size maps
+    _figure = Figure(figsize=(inches, inches), dpi=72)
+    _figure.patch.set_alpha(0)
+    FigureCanvasAgg(_figure)
+    ax = _figure.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    for zorder, (rings, style) in enumerate(layers):
+        ax.add_collection(PathCollection([Path(ring, closed=True) for ring in rings], zorder=zorder, **style), autolim=False)
+    for xy, style in points:
+        if len(xy) > 0:
+            ax.scatter(xy[:, 0], xy[:, 1], s=4, marker='o', edgecolor='black', linewidth=0.2, zorder=len(layers) + 1, **style)
+
+
+def _render_tiles(tiles):
+    """ Renders tiles on the worker figure. Returns (tile, PNG bytes) pairs, with None for blank tiles. """
+    ax = _figure.axes[0]
+    rendered = []
+    for tile in tiles:
+        x0, x1, y0, y1 = tile_bounds(*tile)
+        ax.set_xlim(x0, x1)
+        ax.set_ylim(y0, y1)
+        _figure.canvas.draw()
+        rgba = np.asarray(_figure.canvas.buffer_rgba())
+        if not rgba[..., 3].any():
+            rendered.append((tile, None))
+            continue
+        png = io.BytesIO()
+        Image.fromarray(rgba).save(png, format='PNG', optimize=False, compress_level=settings.tile_compress_level)
+        rendered.append((tile, png.getvalue()))
+    return rendered
+
+
+class _TileDirectory:
+    """
+    Writes tiles to <directory>/<z>/<x>/<y>.png, hard-linking duplicates to the first copy. The tiles of a previous
+    render into the same directory are removed first, so tiles that are now blank or off the outlook do not linger.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.paths = dict({})  # tile hash -> path of its first copy
+        if os.path.isdir(directory):
+            self._remove_tiles()
+
+    def _remove_tiles(self):
+        """ Removes the <z>/<x>/<y>.png files and the directories they leave empty. Anything else is left alone. """
+        for z in filter(str.isdigit, os.listdir(self.directory)):
+            z_dir = os.path.join(self.directory, z)
+            if not os.path.isdir(z_dir):
+                continue
+            for x in filter(str.isdigit, os.listdir(z_dir)):
+                x_dir = os.path.join(z_dir, x)
+                if not os.path.isdir(x_dir):
+                    continue
+                for name in os.listdir(x_dir):
+                    if name.endswith('.png') and name[:-4].isdigit():
+                        os.remove(os.path.join(x_dir, name))
+                if len(os.listdir(x_dir)) == 0:
+                    os.rmdir(x_dir)
+            if len(os.listdir(z_dir)) == 0:
+                os.rmdir(z_dir)
+
+    def write(self, tile, png, tile_hash):
+        path = os.path.join(self.directory, str(tile[0]), str(tile[1]), f'{tile[2]}.png')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        if tile_hash in self.paths:
+            try:
+                os.link(self.paths[tile_hash], path)
+                return
+            except OSError:
+                pass  # File systems without hard links get a copy
+        with open(path, 'wb') as f:
+            f.write(png)
+        self.paths.setdefault(tile_hash, path)
+
+    def close(self, metadata):
+        pass
+
+
+class _MBTiles:
+    """ Writes tiles to an MBTiles SQLite file, using the deduplicating map / images schema. """
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+            CREATE TABLE images (tile_data BLOB, tile_id TEXT);
+            CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+            CREATE UNIQUE INDEX images_id ON images (tile_id);
+            CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+                images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+
+    def write(self, tile, png, tile_hash):
+        z, x, y = tile
+        self.connection.execute('INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)', (png, tile_hash))
+        self.connection.execute('INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)', (z, x, 2 ** z - 1 - y, tile_hash))  # MBTiles rows count from the bottom
+
+    def close(self, metadata):
+        self.connection.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)', metadata.items())
+        self.connection.commit()
+        self.connection.close()
+
+
+def render_tiles(outlook_day, year, month, day, time, outlook_kmz_dir, output, product='cat', zooms=None, include_reports=False,
+    filtered_reports=False, folders=None, storm_reports=None, max_workers=settings.batch_max_workers):
+    """
+    Renders an outlook product as Web Mercator XYZ tiles.
+
+    Parameters
+    ----------
+    outlook_day: int
+        Outlook day.
+    year: int
+        YYYY
+    month: int
+        MM
+    day: int
+        DD
+    time: int
+        Time in UTC. HHMM
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    output: str
+        Tile directory (<output>/<z>/<x>/<y>.png), or MBTiles file if it ends with '.mbtiles'. Existing tiles are replaced.
+    product: str
+        'cat', 'torn', 'wind', 'hail' or 'fire'.
+    zooms: iterable of ints or None
+        Zoom levels to render. If None, settings.tile_zooms is used.
+    include_reports: bool
+        Draw the storm reports of the day over the outlook (not available for fire weather outlooks).
+    filtered_reports: bool
+        Use SPC's filtered storm reports.
+    folders: list of kml.Folder or None
+        Parsed outlook, if it was already loaded.
+    storm_reports: utils.StormReports or None
+        Reports of the day, if they were already loaded.
+    max_workers: int or None
+        Number of worker processes. If None, one per CPU is used. If 1, the tiles are rendered in this process.
+
+    Returns
+    -------
+    counts: dict
+        Number of tiles 'rendered', 'blank' (skipped) and 'duplicate' (stored once).
+    """
+    if zooms is None:
+        zooms = settings.tile_zooms
+    layers, points = load_layers(outlook_day, year, month, day, time, outlook_kmz_dir, product, include_reports, filtered_reports, folders, storm_reports)
+
+    bounds = [np.array([[ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max()] for rings, _ in layers for ring in rings]).reshape(-1, 4)]
+    bounds.extend(np.column_stack([xy, xy]) for xy, _ in points)
+    tiles = covering_tiles(np.concatenate(bounds), zooms)
+
+    writer = _MBTiles(output) if output.endswith('.mbtiles') else _TileDirectory(output)
+    counts = dict(rendered=0, blank=0, duplicate=0)
+    hashes = set()
+
+    batches = [tiles[start:start + 32] for start in range(0, len(tiles), 32)]
+    if max_workers == 1:
+        _init_tile_worker(layers, points)
+        results = map(_render_tiles, batches)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_tile_worker, initargs=(layers, points))
+        results = executor.map(_render_tiles, batches)
+
+    try:
+        for rendered in results:
+            for tile, png in rendered:
+                if png is None:
+                    counts['blank'] += 1
+                    continue
+                tile_hash = hashlib.sha1(png).hexdigest()
+                counts['duplicate' if tile_hash in hashes else 'rendered'] += 1
+                hashes.add(tile_hash)
+                writer.write(tile, png, tile_hash)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    lonlat_bounds = [-180, -MAX_LATITUDE, 180, MAX_LATITUDE]
+    if len(tiles) > 0:
+        corners = np.concatenate(bounds)
+        lons, lats = _transformer(inverse=True).transform(corners[:, [0, 2]].ravel(), corners[:, [1, 3]].ravel())
+        lonlat_bounds = [lons.min(), lats.min(), lons.max(), lats.max()]
+    writer.close(dict(name=f'day{outlook_day}otlk_{year}%02d%02d_%04d_{product}' % (month, day, time), format='png', type='overlay', version='1',
+                      minzoom=str(min(zooms)), maxzoom=str(max(zooms)), bounds=','.join('%.4f' % value for value in lonlat_bounds)))
+    return counts
@@ -1,67 +1,180 @@
+import datetime
+import io
+import os
 import pandas as pd
-from matplotlib.patches import Polygon
+import download
+import instrument
+import settings
 from settings import colors
 
-# Sample polygons that will be used to make outlook legends
-poly_TSTM = Polygon([[0, 0], [0, 0]], facecolor=colors['TSTM']['fill'], edgecolor=colors['TSTM']['outline'])  # General thunder
-poly_MRGL = Polygon([[0, 0], [0, 0]], facecolor=colors['MRGL']['fill'], edgecolor=colors['MRGL']['outline'])  # Marginal risk
-poly_SLGT = Polygon([[0, 0], [0, 0]], facecolor=colors['SLGT']['fill'], edgecolor=colors['SLGT']['outline'])  # Slight risk
-poly_ENH = Polygon([[0, 0], [0, 0]], facecolor=colors['ENH']['fill'], edgecolor=colors['ENH']['outline'])  # Enhanced risk
-poly_MDT = Polygon([[0, 0], [0, 0]], facecolor=colors['MDT']['fill'], edgecolor=colors['MDT']['outline'])  # Moderate risk
-poly_HIGH = Polygon([[0, 0], [0, 0]], facecolor=colors['HIGH']['fill'], edgecolor=colors['HIGH']['outline'])  # High risk
-poly_TOR2 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR2']['fill'], edgecolor=colors['TOR2']['outline'])  # 2% tornado risk
-poly_TOR5 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR5']['fill'], edgecolor=colors['TOR5']['outline'])  # 5% tornado risk
-poly_TOR10 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR10']['fill'], edgecolor=colors['TOR10']['outline'])  # 10% tornado risk
-poly_TOR15 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR15']['fill'], edgecolor=colors['TOR15']['outline'])  # 15% tornado risk
-poly_TOR30 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR30']['fill'], edgecolor=colors['TOR30']['outline'])  # 30% tornado risk
-poly_TOR45 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR45']['fill'], edgecolor=colors['TOR45']['outline'])  # 45% tornado risk
-poly_TOR60 = Polygon([[0, 0], [0, 0]], facecolor=colors['TOR60']['fill'], edgecolor=colors['TOR60']['outline'])  # 60% tornado risk
-poly_SIGTOR = Polygon([[0, 0], [0, 0]], facecolor='None', edgecolor='#000000', hatch='//////////////')  # Significant tornado risk (10% EF2+)
-poly_WIND5 = Polygon([[0, 0], [0, 0]], facecolor=colors['WIND5']['fill'], edgecolor=colors['WIND5']['outline'])  # 5% wind risk
-poly_WIND15 = Polygon([[0, 0], [0, 0]], facecolor=colors['WIND15']['fill'], edgecolor=colors['WIND15']['outline'])  # 15% wind risk
-poly_WIND30 = Polygon([[0, 0], [0, 0]], facecolor=colors['WIND30']['fill'], edgecolor=colors['WIND30']['outline'])  # 30% wind risk
-poly_WIND45 = Polygon([[0, 0], [0, 0]], facecolor=colors['WIND45']['fill'], edgecolor=colors['WIND45']['outline'])  # 45% wind risk
-poly_WIND60 = Polygon([[0, 0], [0, 0]], facecolor=colors['WIND60']['fill'], edgecolor=colors['WIND60']['outline'])  # 60% wind risk
-poly_SIGWIND = Polygon([[0, 0], [0, 0]], facecolor='None', edgecolor='#000000', hatch='//////////////')  # Significant wind risk (10% ≥75mphs)
-poly_HAIL5 = Polygon([[0, 0], [0, 0]], facecolor=colors['HAIL5']['fill'], edgecolor=colors['HAIL5']['outline'])  # 5% hail risk
-poly_HAIL15 = Polygon([[0, 0], [0, 0]], facecolor=colors['HAIL15']['fill'], edgecolor=colors['HAIL15']['outline'])  # 15% hail risk
-poly_HAIL30 = Polygon([[0, 0], [0, 0]], facecolor=colors['HAIL30']['fill'], edgecolor=colors['HAIL30']['outline'])  # 30% hail risk
-poly_HAIL45 = Polygon([[0, 0], [0, 0]], facecolor=colors['HAIL45']['fill'], edgecolor=colors['HAIL45']['outline'])  # 45% hail risk
-poly_HAIL60 = Polygon([[0, 0], [0, 0]], facecolor=colors['HAIL60']['fill'], edgecolor=colors['HAIL60']['outline'])  # 60% hail risk
-poly_SIGHAIL = Polygon([[0, 0], [0, 0]], facecolor='None', edgecolor='#000000', hatch='//////////////')  # Significant hail risk (10% ≥2in diameter)
-poly_ELEVATED = Polygon([[0, 0], [0, 0]], facecolor=colors['Elevated']['fill'], edgecolor=colors['Elevated']['outline'])  # Elevated fire risk
-poly_CRITICAL = Polygon([[0, 0], [0, 0]], facecolor=colors['Critical']['fill'], edgecolor=colors['Critical']['outline'])  # Critical fire risk
-poly_EXTREME = Polygon([[0, 0], [0, 0]], facecolor=colors['Extreme']['fill'], edgecolor=colors['Extreme']['outline'])  # Extreme fire risk
-poly_ISODRYT = Polygon([[0, 0], [0, 0]], facecolor=colors['Iso DryT']['fill'], edgecolor=colors['Iso DryT']['outline'], linestyle='--', linewidth=0.7)  # Isolated dry thunderstorm risk
-poly_SCATTEREDDRYT = Polygon([[0, 0], [0, 0]], facecolor=colors['Scattered DryT']['fill'], edgecolor=colors['Scattered DryT']['outline'], linestyle='--', linewidth=0.7)  # Scattered dry thunderstorm risk
+# Storm reports are cached as Feather files when pyarrow is available, and as pickles otherwise
+try:
+    import pyarrow
+except ImportError:
+    _REPORT_CACHE_FORMAT = 'pkl'
+    _read_report_cache = pd.read_pickle
+    _write_report_cache = pd.DataFrame.to_pickle
+else:
+    _REPORT_CACHE_FORMAT = 'feather'
+    _read_report_cache = pd.read_feather
+    _write_report_cache = pd.DataFrame.to_feather
+
+# Sample polygons used to make outlook legends. They are built on first use (see __getattr__), so reading storm reports never
+# imports matplotlib. Name -> (key of settings.colors or None, other Polygon keyword arguments)
+_LEGEND_POLYGONS = dict({})
+_LEGEND_POLYGONS['poly_TSTM'] = ('TSTM', dict({}))  # General thunder
+_LEGEND_POLYGONS['poly_MRGL'] = ('MRGL', dict({}))  # Marginal risk
+_LEGEND_POLYGONS['poly_SLGT'] = ('SLGT', dict({}))  # Slight risk
+_LEGEND_POLYGONS['poly_ENH'] = ('ENH', dict({}))  # Enhanced risk
+_LEGEND_POLYGONS['poly_MDT'] = ('MDT', dict({}))  # Moderate risk
+_LEGEND_POLYGONS['poly_HIGH'] = ('HIGH', dict({}))  # High risk
+_LEGEND_POLYGONS['poly_TOR2'] = ('TOR2', dict({}))  # 2% tornado risk
+_LEGEND_POLYGONS['poly_TOR5'] = ('TOR5', dict({}))  # 5% tornado risk
+_LEGEND_POLYGONS['poly_TOR10'] = ('TOR10', dict({}))  # 10% tornado risk
+_LEGEND_POLYGONS['poly_TOR15'] = ('TOR15', dict({}))  # 15% tornado risk
+_LEGEND_POLYGONS['poly_TOR30'] = ('TOR30', dict({}))  # 30% tornado risk
+_LEGEND_POLYGONS['poly_TOR45'] = ('TOR45', dict({}))  # 45% tornado risk
+_LEGEND_POLYGONS['poly_TOR60'] = ('TOR60', dict({}))  # 60% tornado risk
+_LEGEND_POLYGONS['poly_SIGTOR'] = (None, dict(facecolor='None', edgecolor='#000000', hatch='//////////////'))  # Significant tornado risk (10% EF2+)
+_LEGEND_POLYGONS['poly_WIND5'] = ('WIND5', dict({}))  # 5% wind risk
+_LEGEND_POLYGONS['poly_WIND15'] = ('WIND15', dict({}))  # 15% wind risk
+_LEGEND_POLYGONS['poly_WIND30'] = ('WIND30', dict({}))  # 30% wind risk
+_LEGEND_POLYGONS['poly_WIND45'] = ('WIND45', dict({}))  # 45% wind risk
+_LEGEND_POLYGONS['poly_WIND60'] = ('WIND60', dict({}))  # 60% wind risk
+_LEGEND_POLYGONS['poly_SIGWIND'] = (None, dict(facecolor='None', edgecolor='#000000', hatch='//////////////'))  # Significant wind risk (10% ≥75mphs)
+_LEGEND_POLYGONS['poly_HAIL5'] = ('HAIL5', dict({}))  # 5% hail risk
+_LEGEND_POLYGONS['poly_HAIL15'] = ('HAIL15', dict({}))  # 15% hail risk
+_LEGEND_POLYGONS['poly_HAIL30'] = ('HAIL30', dict({}))  # 30% hail risk
+_LEGEND_POLYGONS['poly_HAIL45'] = ('HAIL45', dict({}))  # 45% hail risk
+_LEGEND_POLYGONS['poly_HAIL60'] = ('HAIL60', dict({}))  # 60% hail risk
+_LEGEND_POLYGONS['poly_SIGHAIL'] = (None, dict(facecolor='None', edgecolor='#000000', hatch='//////////////'))  # Significant hail risk (10% ≥2in diameter)
+_LEGEND_POLYGONS['poly_ELEVATED'] = ('Elevated', dict({}))  # Elevated fire risk
+_LEGEND_POLYGONS['poly_CRITICAL'] = ('Critical', dict({}))  # Critical fire risk
+_LEGEND_POLYGONS['poly_EXTREME'] = ('Extreme', dict({}))  # Extreme fire risk
+_LEGEND_POLYGONS['poly_ISODRYT'] = ('Iso DryT', dict(linestyle='--', linewidth=0.7))  # Isolated dry thunderstorm risk
+_LEGEND_POLYGONS['poly_SCATTEREDDRYT'] = ('Scattered DryT', dict(linestyle='--', linewidth=0.7))  # Scattered dry thunderstorm risk
+
+
+def __getattr__(name):
+    """ Builds a legend polygon (poly_TSTM, poly_SIGTOR, ...) the first time it is used, then keeps it as a module attribute. """
+    if name not in _LEGEND_POLYGONS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from matplotlib.patches import Polygon
+    color_key, kwargs = _LEGEND_POLYGONS[name]
+    if color_key is not None:
+        kwargs = dict(facecolor=colors[color_key]['fill'], edgecolor=colors[color_key]['outline'], **kwargs)
+    polygon = Polygon([[0, 0], [0, 0]], **kwargs)
+    globals()[name] = polygon
+    return polygon
+
+
+def _parse_combined_reports(text):
+    """
+    Splits SPC's combined report csv into tornado, wind and hail DataFrames.
+
+    The combined file holds three csv tables one after another, each starting with its own header line
+    ('Time,F_Scale,...', 'Time,Speed,...' and 'Time,Size,...').
+    """
+    sections = dict({})
+    lines = text.splitlines()
+    header_rows = [i for i, line in enumerate(lines) if line.startswith('Time,')] + [len(lines)]
+    for start, end in zip(header_rows[:-1], header_rows[1:]):
+        column = lines[start].split(',')[1]
+        hazard = {'F_Scale': 'torn', 'Speed': 'wind', 'Size': 'hail'}[column]
+        sections[hazard] = pd.read_csv(io.StringIO('\n'.join(lines[start:end])))
+
+    # Parse the magnitudes: wind speeds are in mph with 'UNK' (unknown) stored as NaN, hail sizes are in hundredths of an inch
+    sections['wind']['Speed'] = pd.to_numeric(sections['wind']['Speed'], errors='coerce').astype('float64')
+    sections['hail']['Size'] = sections['hail']['Size'].astype('int64')
+    for hazard in sections:
+        sections[hazard]['Time'] = sections[hazard]['Time'].astype('int64')
+        sections[hazard][['Lat', 'Lon']] = sections[hazard][['Lat', 'Lon']].astype('float64')
+    return sections
 
 
 class StormReports:
-    def __init__(self, year, month, day):
+    def __init__(self, year, month, day, cache_dir=settings.storm_report_cache_dir, offline=settings.storm_reports_offline, base_url=None):
         """
         year: YYYY
         month: int
         day: int
+        cache_dir: str or None
+            Directory where each day's reports are cached. If None, reports are always downloaded.
+        offline: bool
+            Only read reports from the cache and never touch the network.
+        base_url: str or None
+            Server to download from. If None, settings.spc_base_url is used.
         """
-        self.base_link = 'https://www.spc.noaa.gov/climo/reports/%s%02d%02d_rpts' % (str(year)[2:], month, day)
+        self.date_string = '%s%02d%02d' % (str(year)[2:], month, day)
+        self.base_url = settings.spc_base_url if base_url is None else base_url
+        self.cache_dir = cache_dir
+        self.offline = offline
 
-    def load_tornado_reports(self, filtered=True):
-        """ Load tornado reports for the given day. """
+        # Reports for the last couple of days are still being added, so they are not written to the disk cache
+        self._cacheable = datetime.date(year, month, day) < datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+
+        self._loaded_reports = dict({})  # Reports already read, so one instance can be shared between several plots
+
+    def _cache_path(self, report_set, hazard):
+        return os.path.join(self.cache_dir, f'{self.date_string}_rpts{report_set}_{hazard}.{_REPORT_CACHE_FORMAT}')
+
+    def _read_cache(self, report_set):
+        """ Returns the cached tornado, wind and hail reports of a report set, or None if any of them is missing. """
+        if self.cache_dir is None:
+            return None
+        reports = dict({})
+        for hazard in ('torn', 'wind', 'hail'):
+            try:
+                reports[hazard] = _read_report_cache(self._cache_path(report_set, hazard))
+            except (OSError, ValueError):
+                return None
+        return reports
+
+    def _write_cache(self, report_set, reports):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for hazard, hazard_reports in reports.items():
+            cache_path = self._cache_path(report_set, hazard)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            _write_report_cache(hazard_reports, tmp_path)
+            os.replace(tmp_path, cache_path)
+
+    def _fetch(self, report_set):
+        """ Downloads all three report types of a report set with a single request for the combined csv. """
+        link = f'{self.base_url.rstrip("/")}/climo/reports/{self.date_string}_rpts{report_set}.csv'
+        with instrument.stage('fetch_reports'):
+            response = download.get_session().get(link, timeout=settings.download_timeout)
+        if response.status_code == 404:
+            raise FileNotFoundError(f'{link} not found')
+        if response.status_code != 200:  # Not an answer about the day's reports, so callers must not treat it as a day without them
+            raise ConnectionError(f'{link} returned HTTP {response.status_code}')
+        return _parse_combined_reports(response.text)
+
+    def _load_reports(self, hazard, filtered):
         report_set = ''  # raw report set
         if filtered:
             report_set = '_filtered'
-        return pd.read_csv(f'{self.base_link}{report_set}_torn.csv')
+
+        if report_set not in self._loaded_reports:
+            with instrument.stage('load_reports'):
+                reports = self._read_cache(report_set)
+            if reports is None:
+                if self.offline:
+                    raise FileNotFoundError(f'{self.date_string}_rpts{report_set} reports are not cached in {self.cache_dir} (offline mode)')
+                reports = self._fetch(report_set)
+                if self.cache_dir is not None and self._cacheable:
+                    self._write_cache(report_set, reports)
+            self._loaded_reports[report_set] = reports
+
+        return self._loaded_reports[report_set][hazard].copy()
+
+    def load_tornado_reports(self, filtered=True):
+        """ Load tornado reports for the given day. """
+        return self._load_reports('torn', filtered)
 
     def load_hail_reports(self, filtered=True):
-        """ Load hail reports for the given day. """
-        report_set = ''  # raw report set
-        if filtered:
-            report_set = '_filtered'
-        return pd.read_csv(f'{self.base_link}{report_set}_hail.csv')
+        """ Load hail reports for the given day. Sizes are integers in hundredths of an inch. """
+        return self._load_reports('hail', filtered)
 
     def load_wind_reports(self, filtered=True):
-        """ Load wind reports for the given day. """
-        report_set = ''  # raw report set
-        if filtered:
-            report_set = '_filtered'
-        return pd.read_csv(f'{self.base_link}{report_set}_wind.csv')
+        """ Load wind reports for the given day. Speeds are floats in mph, with unknown ('UNK') speeds as NaN. """
+        return self._load_reports('wind', filtered)
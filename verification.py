@@ -0,0 +1,197 @@
+import datetime
+import functools
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from matplotlib.path import Path
+import outlook
+import settings
+import utils
+
+VERIFIED_PRODUCTS = ('cat', 'torn', 'wind', 'hail')
+_REPORT_LOADERS = dict(torn='load_tornado_reports', wind='load_wind_reports', hail='load_hail_reports')
+
+
+def points_in_rings(lons, lats, rings):
+    """
+    Vectorized point-in-polygon test of many points against many rings.
+
+    Each ring is tested only against the points inside its bounding box, with one batched Path.contains_points call.
+
+    Parameters
+    ----------
+    lons, lats: np.ndarray
+        Point coordinates.
+    rings: list of np.ndarray
+        Rings of (lon, lat) coordinates.
+
+    Returns
+    -------
+    inside: np.ndarray of bools
+        True for points inside at least one ring.
+    """
+    inside = np.zeros(len(lons), dtype=bool)
+    if len(lons) == 0:
+        return inside
+    points = np.column_stack([lons, lats])
+    for ring in rings:
+        if len(ring) < 3:
+            continue
+        min_lon, min_lat = ring[:, :2].min(axis=0)
+        max_lon, max_lat = ring[:, :2].max(axis=0)
+        candidates = np.flatnonzero(~inside & (lons >= min_lon) & (lons <= max_lon) & (lats >= min_lat) & (lats <= max_lat))
+        if len(candidates) > 0:
+            inside[candidates[Path(ring[:, :2]).contains_points(points[candidates])]] = True
+    return inside
+
+
+def classify_points(lons, lats, levels):
+    """
+    Finds the highest risk level each point falls in.
+
+    Parameters
+    ----------
+    lons, lats: np.ndarray
+        Point coordinates.
+    levels: dict
+        Levels from outlook.risk_levels, ordered from the lowest to the highest risk.
+
+    Returns
+    -------
+    level_index: np.ndarray of ints
+        Index (in 'levels') of the highest level containing each point, or -1 for points outside every level.
+    """
+    level_index = np.full(len(lons), -1, dtype=np.int8)
+    for index, rings in enumerate(levels.values()):
+        level_index[points_in_rings(lons, lats, rings)] = index
+    return level_index
+
+
+def valid_report_date(outlook_day, date, time):
+    """
+    Returns the date of the storm report day (12 UTC - 12 UTC) an outlook is valid for.
+
+    Day 1 outlooks issued before 12 UTC (the 0100 UTC update) belong to the convective day that started the previous day.
+    """
+    if outlook_day == 1 and time < 1200:
+        return date - datetime.timedelta(days=1)
+    return date + datetime.timedelta(days=outlook_day - 1)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_report_points(report_date, filtered):
+    """ Longitudes and latitudes of each hazard's reports on a report day, shared by every issuance valid that day. """
+    storm_reports = utils.StormReports(report_date.year, report_date.month, report_date.day)
+    points = dict({})
+    for hazard, loader in _REPORT_LOADERS.items():
+        reports = getattr(storm_reports, loader)(filtered=filtered)
+        points[hazard] = (reports['Lon'].values.astype(np.float64), reports['Lat'].values.astype(np.float64))
+    return points
+
+
+def verify_issuance(outlook_day, date, time, outlook_kmz_dir, products=VERIFIED_PRODUCTS, filtered_reports=True):
+    """
+    Verifies one convective outlook issuance against the storm reports of the day it is valid for.
+
+    Parameters
+    ----------
+    outlook_day: int
+        Outlook day (1-3).
+    date: datetime.date
+        Issuance date.
+    time: int
+        Issuance time in UTC. HHMM
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    products: iterable of str
+        Products to verify: any of 'cat', 'torn', 'wind', 'hail'. The categorical outlook is verified against all reports.
+    filtered_reports: bool
+        Use SPC's filtered storm reports.
+
+    Returns
+    -------
+    rows: list of dicts
+        One row per product with the number of reports, the number whose highest level is each level ('n_<level>'),
+        the number outside every level ('n_outside'), the percentage of reports at or above SLGT for the categorical
+        outlook ('pct_slgt_plus') and the number inside the significant severe area for the probabilistic outlooks ('n_significant').
+    """
+    folders = outlook.load_convective_outlook(outlook_day, date.year, date.month, date.day, time, outlook_kmz_dir)
+    report_points = _load_report_points(valid_report_date(outlook_day, date, time), filtered_reports)
+
+    rows = []
+    for product in products:
+        hazards = _REPORT_LOADERS.keys() if product == 'cat' else (product, )
+        lons = np.concatenate([report_points[hazard][0] for hazard in hazards])
+        lats = np.concatenate([report_points[hazard][1] for hazard in hazards])
+
+        levels, significant_rings = outlook.risk_levels(folders, product)
+        level_index = classify_points(lons, lats, levels)
+        counts = np.bincount(level_index + 1, minlength=len(levels) + 1)
+
+        row = dict(outlook_day=outlook_day, date=date, time=time, product=product, n_reports=len(lons), n_outside=int(counts[0]))
+        row.update({f'n_{level}': int(count) for level, count in zip(levels, counts[1:])})
+        if product == 'cat':
+            row['pct_slgt_plus'] = 100 * np.sum(level_index >= outlook.CATEGORICAL_LEVELS.index('SLGT')) / len(lons) if len(lons) > 0 else np.nan
+        else:
+            row['n_significant'] = int(np.sum(points_in_rings(lons, lats, significant_rings)))
+        rows.append(row)
+    return rows
+
+
+def _verify_issuance_safe(issuance, outlook_kmz_dir, products, filtered_reports):
+    try:
+        return verify_issuance(*issuance, outlook_kmz_dir, products=products, filtered_reports=filtered_reports), None
+    except Exception:
+        return [], (issuance, traceback.format_exc())
+
+
+def verify_range(start_date, end_date, outlook_kmz_dir, outlook_days=(1, ), products=VERIFIED_PRODUCTS, filtered_reports=True,
+    max_workers=settings.batch_max_workers):
+    """
+    Verifies every convective outlook issuance in a date range (inclusive) across a process pool.
+
+    Issuances are handed to the workers in date order with a large chunk size, so each worker handles runs of
+    consecutive days and reuses the storm reports it already loaded.
+
+    Parameters
+    ----------
+    start_date, end_date: datetime.date
+    outlook_kmz_dir: str
+        Directory where the outlook kmz files will be stored.
+    outlook_days: iterable of ints
+        Outlook days to verify. Every valid issuance time of each day is verified.
+    products, filtered_reports
+        See verify_issuance.
+    max_workers: int or None
+        Number of worker processes. If None, one per CPU is used. If 1, the issuances are verified in this process.
+
+    Returns
+    -------
+    metrics: pd.DataFrame
+        One row per issuance and product (see verify_issuance).
+    failures: list of (issuance, str) tuples
+        Issuances that could not be verified (e.g. missing archive files) and their tracebacks.
+    """
+    issuances = []
+    date = start_date
+    while date <= end_date:
+        for outlook_day in outlook_days:
+            issuances.extend((outlook_day, date, time) for time in settings.valid_convective_outlook_times[outlook_day - 1])
+        date += datetime.timedelta(days=1)
+
+    verify = functools.partial(_verify_issuance_safe, outlook_kmz_dir=outlook_kmz_dir, products=products, filtered_reports=filtered_reports)
+    if max_workers == 1:
+        results = list(map(verify, issuances))
+    else:
+        num_workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(verify, issuances, chunksize=max(1, len(issuances) // (4 * num_workers))))
+
+    rows, failures = [], []
+    for issuance_rows, failure in results:
+        rows.extend(issuance_rows)
+        if failure is not None:
+            failures.append(failure)
+    return pd.DataFrame(rows), failures